@@ -0,0 +1,315 @@
+"""
+Benchmarks of polyviz on synthetic databases (see `synthetic.py`).
+
+Each benchmark is timed (best of `--repeat` runs, after a warm-up run)
+and its peak memory measured with `tracemalloc`, for each database size.
+Charts are benchmarked without rendering (`render=False`), so that the
+calculation does not depend on the version of `d3blocks`, and the rendering
+is benchmarked once, for the Sankey diagram.
+Results can be stored as a baseline, and compared against it:
+
+    python benchmarks/run.py --sizes 1000 5000 --save benchmarks/baseline.json
+    python benchmarks/run.py --sizes 1000 5000 --compare benchmarks/baseline.json
+
+The databases are written in the "polyviz-benchmarks" project,
+and only generated again if their parameters change.
+"""
+
+import argparse
+import json
+import logging
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import bw2data
+
+PROJECT = "polyviz-benchmarks"
+LEVEL = 4
+CUTOFF = 0.001
+# each iteration solves the (resampled) technosphere matrix
+ITERATIONS = 10
+
+
+def get_benchmarks(activity, method, directory: Path) -> dict:
+    """
+    Get the functions to benchmark, for an activity and a method.
+    Intermediate results needed by a benchmark are calculated beforehand,
+    so that only the benchmarked step is measured.
+    :param activity: a brightway2 activity
+    :param method: a tuple representing a brightway2 method
+    :param directory: directory to save the charts in
+    :return: a dictionary with a function to benchmark for each name
+    """
+    from polyviz import chord, choro, force, render, sankey, treemap, violin
+    from polyviz.cache import lca_cache
+    from polyviz.dataframe import (
+        distribute_region_impacts,
+        format_supply_chain_dataframe,
+        get_geo_distribution_of_impacts,
+    )
+    from polyviz.montecarlo import monte_carlo
+    from polyviz.utils import (
+        get_impacts_per_activity,
+        group_impacts_by_location,
+        recursive_calculation,
+    )
+
+    rows = recursive_calculation(activity, method, max_level=LEVEL, cutoff=CUTOFF)
+    impacts = get_impacts_per_activity(activity, method, cache="bypass")
+    by_location = group_impacts_by_location(*impacts, 0.0001)
+    sankey_data = sankey(
+        activity=activity, method=method, level=LEVEL, cutoff=CUTOFF, render=False
+    )
+
+    def lca():
+        lca_cache.clear()
+        lca_cache.get(activity, method)
+
+    def chart(function, **kwargs):
+        return lambda: function(
+            activity=activity, method=method, render=False, **kwargs
+        )
+
+    return {
+        "lca": lca,
+        "recursive_calculation": lambda: recursive_calculation(
+            activity, method, max_level=LEVEL, cutoff=CUTOFF
+        ),
+        "format_supply_chain_dataframe": lambda: format_supply_chain_dataframe(rows, 1),
+        "get_geo_distribution_of_impacts": lambda: get_geo_distribution_of_impacts(
+            activity, method, cache="bypass"
+        ),
+        "distribute_region_impacts": lambda: distribute_region_impacts(
+            by_location, 0.0001
+        ),
+        "monte_carlo": lambda: monte_carlo(
+            [activity], method, iterations=ITERATIONS, seed=42, workers=1
+        ),
+        "sankey": chart(sankey, level=LEVEL, cutoff=CUTOFF),
+        "chord": chart(chord, level=LEVEL, cutoff=CUTOFF),
+        "force": chart(force, level=LEVEL, cutoff=CUTOFF),
+        "treemap": chart(treemap),
+        "choro": chart(choro),
+        "violin": lambda: violin(
+            activities=[activity],
+            method=method,
+            iterations=ITERATIONS,
+            seed=42,
+            workers=1,
+            render=False,
+        ),
+        "render": lambda: render(sankey_data, filepath=directory / "sankey.html"),
+    }
+
+
+def measure(function, repeat: int = 3) -> dict:
+    """
+    Measure the run time and peak memory of a function.
+    :param function: function to measure, without arguments
+    :param repeat: number of timed runs
+    :return: a dictionary with the best run time, in seconds,
+    and the peak memory allocated, in bytes
+    """
+    # warm-up run, which also measures the peak memory
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    return {"time": min(times), "memory": peak}
+
+
+def run(sizes: list, repeat: int = 3, only: list = None) -> dict:
+    """
+    Run the benchmarks on synthetic databases of several sizes.
+    A benchmark that fails records its error instead of a measure.
+    :param sizes: numbers of activities of the synthetic databases
+    :param repeat: number of timed runs of each benchmark
+    :param only: names of the benchmarks to run (default: all)
+    :return: a dictionary of results, per size and per benchmark
+    """
+    from synthetic import METHOD, generate_database
+
+    from polyviz.cache import result_cache
+
+    bw2data.projects.set_current(PROJECT)
+    # results are calculated, not read from the on-disk cache
+    result_cache.enabled = False
+
+    results = {}
+
+    for size in sizes:
+        print(f"Generating a database of {size} activities...")
+        database = generate_database(f"synthetic {size}", activities=size)
+        activity = bw2data.get_activity((database, "activity 0"))
+
+        results[str(size)] = {}
+
+        with tempfile.TemporaryDirectory() as directory:
+            benchmarks = get_benchmarks(activity, METHOD, Path(directory))
+            for name, function in benchmarks.items():
+                if only and name not in only:
+                    continue
+                try:
+                    result = measure(function, repeat)
+                except Exception as err:
+                    result = {"error": f"{type(err).__name__}: {err}"}
+                results[str(size)][name] = result
+                print(f"{size:>6} {name:<32} {format_result(result)}")
+
+    return results
+
+
+def format_result(result: dict) -> str:
+    if "error" in result:
+        return f"failed ({result['error'][:60]})"
+    return f"{result['time']:9.4f} s {result['memory'] / 2**20:9.1f} MiB"
+
+
+def compare(
+    results: dict,
+    baseline: dict,
+    tolerance: float = 0.25,
+    noise: float = 0.02,
+    verbose: bool = True,
+) -> list:
+    """
+    Compare results against a baseline.
+    :param results: results, as returned by `run`
+    :param baseline: results of a previous run
+    :param tolerance: relative increase of time or memory above which
+    a benchmark is considered to regress
+    :param noise: increase of time, in seconds, below which a benchmark
+    is not considered to regress, whatever the relative increase
+    :param verbose: whether to print the ratios of each benchmark
+    :return: a list of (size, benchmark, measure, ratio) for each regression
+    """
+    regressions = []
+
+    if verbose:
+        print(f"\n{'size':>6} {'benchmark':<32} {'time':>8} {'memory':>8}")
+    for size, benchmarks in results.items():
+        for name, result in benchmarks.items():
+            previous = baseline.get(size, {}).get(name)
+            if previous is None or "error" in previous or "error" in result:
+                continue
+
+            ratios = {
+                key: result[key] / previous[key] if previous[key] else 1.0
+                for key in ("time", "memory")
+            }
+            if verbose:
+                print(
+                    f"{size:>6} {name:<32} "
+                    f"{ratios['time']:7.2f}x {ratios['memory']:7.2f}x"
+                )
+            # differences of a few milliseconds are noise
+            if result["time"] - previous["time"] < noise:
+                ratios["time"] = min(ratios["time"], 1.0)
+            regressions.extend(
+                (size, name, key, ratio)
+                for key, ratio in ratios.items()
+                if ratio > 1 + tolerance
+            )
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[1000, 5000],
+        help="numbers of activities of the synthetic databases",
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="number of timed runs")
+    parser.add_argument("--only", nargs="+", help="names of the benchmarks to run")
+    parser.add_argument("--save", type=Path, help="file to save the results in")
+    parser.add_argument("--compare", type=Path, help="baseline to compare against")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="relative increase above which a benchmark regresses",
+    )
+    parser.add_argument(
+        "--noise",
+        type=float,
+        default=0.02,
+        help="increase of time, in seconds, below which a benchmark does not regress",
+    )
+    args = parser.parse_args()
+
+    # silence progress messages, of polyviz and of the libraries it uses
+    logging.disable(logging.INFO)
+
+    results = run(args.sizes, args.repeat, args.only)
+
+    failed = [
+        f"{name} ({size} activities)"
+        for size, benchmarks in results.items()
+        for name, result in benchmarks.items()
+        if "error" in result
+    ]
+    if args.save and failed:
+        # a baseline with failed benchmarks would never check them
+        print(f"Not saving a baseline with failed benchmarks: {', '.join(failed)}")
+        sys.exit(1)
+
+    if args.save:
+        args.save.write_text(
+            json.dumps(
+                {
+                    "machine": platform.platform(),
+                    "python": platform.python_version(),
+                    "results": results,
+                },
+                indent=2,
+            )
+        )
+
+    if args.compare:
+        baseline = json.loads(args.compare.read_text())["results"]
+        regressions = compare(results, baseline, args.tolerance, args.noise)
+
+        # timings vary with the load of the machine: slower benchmarks
+        # are timed again, and only regress if they are still slower
+        slower = {}
+        for size, name, key, _ in regressions:
+            if key == "time":
+                slower.setdefault(size, []).append(name)
+        if slower:
+            print("\nTiming the slower benchmarks again...")
+            for size, names in slower.items():
+                again = run([int(size)], args.repeat, names)[size]
+                for name, result in again.items():
+                    if "error" not in result:
+                        results[size][name]["time"] = min(
+                            results[size][name]["time"], result["time"]
+                        )
+            regressions = compare(
+                results, baseline, args.tolerance, args.noise, verbose=False
+            )
+
+        for size, name, key, ratio in regressions:
+            print(f"Regression: {name} ({size} activities), {key} x{ratio:.2f}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""
+Generator of synthetic brightway2 databases, to benchmark polyviz
+on databases of realistic size without downloading one.
+
+Activities are ordered from final products to basic materials: each activity
+consumes a few activities further down the order, some of them "hubs"
+(energy, transport, etc.) consumed by many activities. A share of activities
+also consume an activity further up the order, which creates loops.
+Some activities are waste treatments (with a negative reference flow),
+and activities are located in countries and in regions, so that impacts
+have to be distributed from regions to countries.
+"""
+
+import bw2data
+import numpy as np
+
+from polyviz.utils import load_reference_data
+
+BIOSPHERE = "synthetic biosphere"
+METHOD = ("synthetic", "climate change")
+UNITS = ["kilogram", "kilowatt hour", "cubic meter", "megajoule", "unit"]
+
+
+def setup_biosphere(flows: int = 20, seed: int = 0):
+    """
+    Write the biosphere database and the impact assessment method
+    shared by all synthetic databases, if they do not exist yet.
+    :param flows: number of biosphere flows
+    :param seed: seed of the random characterization factors
+    """
+    if BIOSPHERE in bw2data.databases and METHOD in bw2data.methods:
+        return
+
+    rng = np.random.default_rng(seed)
+
+    bw2data.Database(BIOSPHERE).write(
+        {
+            (BIOSPHERE, f"flow {i}"): {
+                "name": f"flow {i}",
+                "unit": "kilogram",
+                "type": "emission",
+                "categories": ("air",),
+            }
+            for i in range(flows)
+        }
+    )
+
+    method = bw2data.Method(METHOD)
+    method.register(unit="kg CO2-eq.")
+    method.write(
+        [
+            ((BIOSPHERE, f"flow {i}"), float(factor))
+            for i, factor in enumerate(rng.lognormal(0, 1.5, flows))
+        ]
+    )
+
+
+def generate_database(
+    name: str,
+    activities: int = 1000,
+    inputs: float = 5,
+    loops: float = 0.05,
+    waste: float = 0.05,
+    uncertainty: float = 0.3,
+    seed: int = 0,
+) -> str:
+    """
+    Write a synthetic database in the current brightway2 project.
+    The database is only written again if it does not exist
+    or was generated with other parameters.
+    :param name: name of the database
+    :param activities: number of activities
+    :param inputs: average number of technosphere inputs per activity
+    :param loops: share of activities consuming an activity further up the order
+    :param waste: share of activities that are waste treatments
+    :param uncertainty: share of technosphere exchanges with an uncertainty distribution
+    (biosphere exchanges all have one)
+    :param seed: seed of the random generator
+    :return: the name of the database
+    """
+    parameters = {
+        "activities": activities,
+        "inputs": inputs,
+        "loops": loops,
+        "waste": waste,
+        "uncertainty": uncertainty,
+        "seed": seed,
+    }
+
+    setup_biosphere()
+
+    if name in bw2data.databases and (
+        bw2data.databases[name].get("synthetic") == parameters
+    ):
+        return name
+
+    rng = np.random.default_rng(seed)
+
+    countries = list(load_reference_data("GDP_countries"))
+    regions = list(load_reference_data("regions"))
+    # most activities are located in a country
+    locations = rng.choice(
+        countries + regions,
+        size=activities,
+        p=np.r_[
+            np.full(len(countries), 0.7 / len(countries)),
+            np.full(len(regions), 0.3 / len(regions)),
+        ],
+    )
+    units = rng.choice(UNITS, size=activities)
+    # the first activity, drawn by the benchmarks, is not a waste treatment
+    is_waste = rng.random(activities) < waste
+    is_waste[0] = False
+    # the last activities are consumed by many others
+    hubs = max(1, activities // 50)
+
+    def exchange(code: int, amount: float, uncertain: bool) -> dict:
+        data = {"input": (name, f"activity {code}"), "type": "technosphere"}
+        # waste is sent to treatment as a negative input
+        amount = -amount if is_waste[code] else amount
+        data["amount"] = float(amount)
+        if uncertain:
+            data.update(
+                {
+                    "uncertainty type": 2,
+                    "loc": float(np.log(abs(amount))),
+                    "scale": 0.1,
+                    "negative": bool(amount < 0),
+                }
+            )
+        return data
+
+    data = {}
+
+    for i in range(activities):
+        code = f"activity {i}"
+        exchanges = [
+            {
+                "input": (name, code),
+                "type": "production",
+                "amount": -1.0 if is_waste[i] else 1.0,
+            }
+        ]
+
+        # inputs are further down the order, half of them from the hubs
+        first_hub = max(i + 1, activities - hubs)
+        count = rng.poisson(inputs) if i < activities - 1 else 0
+        if count:
+            from_hubs = rng.binomial(count, 0.5) if first_hub > i + 1 else count
+            chosen = rng.integers(first_hub, activities, from_hubs)
+            if count > from_hubs:
+                chosen = np.r_[
+                    chosen, rng.integers(i + 1, first_hub, count - from_hubs)
+                ]
+            chosen = np.unique(chosen)
+            # the inputs of an activity add up to less than one unit,
+            # so that the technosphere matrix can be inverted
+            amounts = rng.uniform(0.05, 0.8, len(chosen)) / len(chosen)
+            exchanges.extend(
+                exchange(c, a, rng.random() < uncertainty)
+                for c, a in zip(chosen, amounts)
+            )
+
+        if i > 0 and rng.random() < loops:
+            exchanges.append(
+                exchange(
+                    rng.integers(0, i),
+                    rng.uniform(0.01, 0.1),
+                    rng.random() < uncertainty,
+                )
+            )
+
+        for flow in rng.choice(20, size=rng.integers(1, 4), replace=False):
+            amount = rng.lognormal(0, 1)
+            exchanges.append(
+                {
+                    "input": (BIOSPHERE, f"flow {flow}"),
+                    "type": "biosphere",
+                    "amount": float(amount),
+                    "uncertainty type": 2,
+                    "loc": float(np.log(amount)),
+                    "scale": float(rng.uniform(0.1, 0.3)),
+                }
+            )
+
+        data[(name, code)] = {
+            "name": f"{'treatment of' if is_waste[i] else 'production of'} product {i}",
+            "reference product": f"product {i}",
+            "unit": str(units[i]),
+            "location": str(locations[i]),
+            "exchanges": exchanges,
+        }
+
+    if name in bw2data.databases:
+        del bw2data.databases[name]
+
+    database = bw2data.Database(name)
+    database.register(synthetic=parameters)
+    database.write(data)
+
+    return name
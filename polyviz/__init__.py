@@ -1,7 +1,17 @@
 """
 PolyViz init
+
+Chart functions are imported lazily, on first access, so that
+``import polyviz`` does not import ``d3blocks``, ``bw2calc``, ``bw2data``
+or ``pandas`` before a chart is requested.
 """
 
+import logging
+import sys
+from importlib import import_module
+from types import ModuleType
+from typing import TYPE_CHECKING
+
 __version__ = (1, 0, 4)
 
 __all__ = (
@@ -11,11 +21,51 @@ __all__ = (
     "violin",
     "choro",
     "treemap",
+    "dashboard",
+    "batch",
+    "render",
 )
 
-from .chord import chord
-from .choro import choro
-from .force import force
-from .sankey import sankey
-from .treemap import treemap
-from .violin import violin
+# progress messages are sent to the "polyviz" logger, and follow the logging
+# configuration of the application. To print them, e.g.,
+# `logging.basicConfig(level=logging.INFO)`, or, for polyviz only,
+# `logging.basicConfig()` and `logging.getLogger("polyviz").setLevel(logging.INFO)`.
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+if TYPE_CHECKING:
+    from .batch import batch
+    from .chord import chord
+    from .choro import choro
+    from .dashboard import dashboard
+    from .force import force
+    from .render import render
+    from .sankey import sankey
+    from .treemap import treemap
+    from .violin import violin
+
+
+def __getattr__(name: str):
+    if name in __all__:
+        return getattr(import_module(f".{name}", __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
+
+
+class _PolyvizModule(ModuleType):
+    """
+    Chart functions have the same name as the submodules defining them.
+    When a submodule is imported, the import system sets it as an attribute
+    of the package: the chart function is set instead, so that e.g.
+    ``polyviz.sankey`` remains a function after ``import polyviz.sankey``.
+    """
+
+    def __setattr__(self, name, value):
+        if name in __all__ and isinstance(value, ModuleType):
+            value = getattr(value, name)
+        super().__setattr__(name, value)
+
+
+sys.modules[__name__].__class__ = _PolyvizModule
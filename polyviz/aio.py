@@ -0,0 +1,181 @@
+"""
+Asynchronous versions of the chart functions, for web services.
+
+Chart functions are blocking: the LCA calculation and the traversal of the
+supply chain would stall the event loop. The functions of this module run them
+in an executor (by default, the default executor of the event loop, a pool of
+threads), so that several charts can be generated concurrently::
+
+    from polyviz import aio
+
+    sankey, treemap = await asyncio.gather(
+        aio.sankey(activity, method), aio.treemap(activity, method)
+    )
+
+Identical calls in flight at the same time (same chart, same arguments) share
+a single calculation. A call can be cancelled: the calculation stops at
+the end of its current stage (see `polyviz.profiling`), unless other
+identical calls still wait for it.
+"""
+
+import asyncio
+import functools
+import threading
+from concurrent.futures import CancelledError, Executor, ProcessPoolExecutor
+from typing import Any, Callable, Hashable
+
+from .chord import chord as _chord
+from .choro import choro as _choro
+from .force import force as _force
+from .profiling import profile
+from .sankey import sankey as _sankey
+from .treemap import treemap as _treemap
+from .violin import violin as _violin
+
+try:
+    from bw2data.backends.peewee import Activity
+except ImportError:
+    from bw2data.backends import Activity
+
+_executor = None
+
+# calculations in flight, by event loop and by call
+_in_flight = {}
+
+
+class Call:
+    """
+    A calculation in flight, and the number of callers waiting for it.
+    """
+
+    __slots__ = ("future", "cancelled", "waiters")
+
+    def __init__(self, future: asyncio.Future, cancelled: threading.Event):
+        self.future = future
+        self.cancelled = cancelled
+        self.waiters = 0
+
+
+def set_executor(executor: Executor = None):
+    """
+    Set the executor in which charts are generated.
+    With a `ProcessPoolExecutor`, the arguments of chart functions should be
+    picklable, and a calculation that has started cannot be cancelled.
+    :param executor: a `concurrent.futures.Executor`, or None
+    for the default executor of the event loop
+    """
+    global _executor
+    _executor = executor
+
+
+def get_executor() -> Executor:
+    return _executor
+
+
+def make_key(function: Callable, args: tuple, kwargs: dict) -> Hashable:
+    """
+    Make the key identifying a call: activities are identified by their key,
+    and lists and dictionaries are converted to tuples.
+    :param function: chart function
+    :param args: positional arguments
+    :param kwargs: keyword arguments
+    :return: a hashable key, or None if an argument cannot be hashed
+    (e.g., a dataframe), in which case the call is not shared
+    """
+
+    def freeze(value):
+        if isinstance(value, Activity):
+            return "activity", value.key
+        if isinstance(value, (list, tuple)):
+            return tuple(freeze(item) for item in value)
+        if isinstance(value, dict):
+            return tuple(sorted((key, freeze(item)) for key, item in value.items()))
+        return value
+
+    try:
+        key = (function.__module__, function.__name__, freeze(args), freeze(kwargs))
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def call(function: Callable, args: tuple, kwargs: dict, cancelled: threading.Event):
+    """
+    Call a chart function, raising `CancelledError` at the end
+    of a stage if the call is cancelled.
+    """
+
+    def check(_):
+        if cancelled.is_set():
+            raise CancelledError()
+
+    with profile(callback=check):
+        return function(*args, **kwargs)
+
+
+async def run(function: Callable, *args, **kwargs) -> Any:
+    """
+    Run a chart function in the executor, sharing the calculation
+    with the identical calls in flight, if any.
+    :param function: chart function
+    :param args: positional arguments of the function
+    :param kwargs: keyword arguments of the function
+    :return: the result of the function
+    """
+    loop = asyncio.get_running_loop()
+    key = make_key(function, args, kwargs)
+    calls = _in_flight.get(loop, {})
+
+    current = calls.get(key) if key is not None else None
+    if current is None:
+        cancelled = threading.Event()
+        if isinstance(_executor, ProcessPoolExecutor):
+            task = functools.partial(function, *args, **kwargs)
+        else:
+            task = functools.partial(call, function, args, kwargs, cancelled)
+        current = Call(loop.run_in_executor(_executor, task), cancelled)
+
+        if key is not None:
+            calls = _in_flight.setdefault(loop, calls)
+            calls[key] = current
+
+            def forget(_):
+                if calls.get(key) is current:
+                    del calls[key]
+                if not calls:
+                    _in_flight.pop(loop, None)
+
+            current.future.add_done_callback(forget)
+
+    current.waiters += 1
+    try:
+        return await asyncio.shield(current.future)
+    except asyncio.CancelledError:
+        # the calculation is only cancelled when no caller waits for it anymore
+        if current.waiters == 1:
+            current.cancelled.set()
+            current.future.cancel()
+        raise
+    finally:
+        current.waiters -= 1
+
+
+def make_async(function: Callable) -> Callable:
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        return await run(function, *args, **kwargs)
+
+    wrapper.__doc__ = (
+        f"Asynchronous version of `polyviz.{function.__name__}`, "
+        f"run in the executor (see `set_executor`).\n{function.__doc__}"
+    )
+    return wrapper
+
+
+sankey = make_async(_sankey)
+chord = make_async(_chord)
+force = make_async(_force)
+treemap = make_async(_treemap)
+choro = make_async(_choro)
+violin = make_async(_violin)
@@ -0,0 +1,144 @@
+"""
+This module contains the function to generate charts for many activities
+in parallel, in a pool of processes.
+"""
+
+import logging
+import traceback
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Iterable, Iterator
+
+import bw2data
+
+from .dashboard import CHARTS, dashboard
+from .profiling import profile
+
+try:
+    from bw2data.backends.peewee import Activity
+except ImportError:
+    from bw2data.backends import Activity
+
+logger = logging.getLogger(__name__)
+
+BatchResult = namedtuple(
+    "BatchResult", ["activity", "filepaths", "error", "bytes_saved"], defaults=(0,)
+)
+BatchResult.__doc__ = """
+Charts generated for an activity: the key of the activity, a dictionary
+with the path to the HTML file of each chart, the traceback of
+the error raised while generating them, if any, and the number of bytes
+saved by writing compact HTML files (see `polyviz.compact`).
+"""
+
+
+def init_worker(project: str):
+    """
+    Open the brightway2 project in a worker process, once for all
+    the activities it renders. LCA objects are then kept warm
+    by the process-level cache (see `polyviz.cache`).
+    :param project: name of the brightway2 project
+    """
+    bw2data.projects.set_current(project)
+
+
+def render_activity(
+    key: tuple, method: tuple, charts: tuple, directory: str, options: dict
+) -> BatchResult:
+    """
+    Generate the charts of an activity, in a worker process.
+    Errors are returned rather than raised, so that they do not
+    interrupt the rendering of the other activities.
+    :param key: key of a brightway2 activity
+    :param method: tuple representing a brightway2 method
+    :param charts: charts to generate
+    :param directory: directory to save the HTML files in
+    :param options: other arguments passed to `dashboard`
+    :return: a `BatchResult`
+    """
+    try:
+        with profile() as result:
+            filepaths = dashboard(
+                activity=bw2data.get_activity(key),
+                method=method,
+                charts=charts,
+                directory=directory,
+                **options,
+            )
+        # the "dashboard" stage counts the bytes saved by all charts
+        saved = result.stages[0].calls["bytes saved"]
+        return BatchResult(key, filepaths, None, saved)
+    except Exception:
+        return BatchResult(key, {}, traceback.format_exc())
+
+
+def batch(
+    activities: Iterable,
+    method: tuple,
+    charts: tuple = tuple(CHARTS),
+    directory: str = None,
+    workers: int = None,
+    **options,
+) -> Iterator[BatchResult]:
+    """
+    Generate charts for many activities, in a pool of processes.
+    Results are yielded as soon as the charts of an activity are generated,
+    not in the order of `activities`. An activity whose charts cannot be
+    generated yields a result carrying the error, and does not interrupt the others.
+    Files are named after the title of the chart, the code of the activity,
+    the method and the chart type (see `check_filepath`), so that running
+    a batch again overwrites them.
+    :param activities: brightway2 activities, or their keys
+    :param method: tuple representing a brightway2 method
+    :param charts: charts to generate, among "sankey", "chord", "force", "treemap" and "choro"
+    :param directory: directory to save the HTML files in (default: current directory)
+    :param workers: number of worker processes (default: number of processors)
+    :param options: other arguments passed to `dashboard`, e.g., `level`, `cutoff`
+    or `compact`, in which case the total number of bytes saved is logged at the end
+    :return: an iterator of `BatchResult`
+    """
+
+    assert isinstance(method, tuple), "`method` should be a tuple."
+    assert all(
+        chart in CHARTS for chart in charts
+    ), f"`charts` should be among {', '.join(CHARTS)}."
+
+    # activities are sent to workers as keys, which are cheaper to pickle
+    keys = [
+        activity.key if isinstance(activity, Activity) else tuple(activity)
+        for activity in activities
+    ]
+    directory = str(Path(directory or Path.cwd()).resolve())
+
+    # process modified databases once, rather than in several workers at once,
+    # which would read the processed files of a database while another writes them
+    bw2data.databases.clean()
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=init_worker,
+        initargs=(bw2data.projects.current,),
+    ) as executor:
+        futures = [
+            executor.submit(
+                render_activity, key, method, tuple(charts), directory, options
+            )
+            for key in keys
+        ]
+
+        try:
+            saved = 0
+            for i, future in enumerate(as_completed(futures), start=1):
+                result = future.result()
+                status = "failed" if result.error else "done"
+                logger.info(f"{i}/{len(futures)} {result.activity}: {status}")
+                saved += result.bytes_saved
+                yield result
+
+            if options.get("compact"):
+                logger.info(f"Compact HTML: {saved / 2**20:.1f} MiB saved in total.")
+        finally:
+            # if the iteration is stopped early, do not start pending activities
+            for future in futures:
+                future.cancel()
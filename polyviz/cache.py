@@ -0,0 +1,629 @@
+"""
+Caches shared across polyviz calls.
+
+Building the technosphere and biosphere matrices and factorizing the
+technosphere matrix is the most expensive part of drawing a chart.
+The process-level cache keeps, for each (project, database, method), an LCA
+object with its matrices built and its technosphere matrix factorized, so that
+subsequent charts only need to solve for a new demand.
+
+Results (supply chains, impacts of activities) are also stored on disk,
+in the directory of the brightway2 project, so that they survive
+a restart of the Python process.
+"""
+
+import hashlib
+import os
+import pickle
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Any, Callable, Hashable
+
+import bw2calc
+import bw2data
+import numpy as np
+import pandas as pd
+from packaging.version import Version
+from scipy import sparse
+
+from .profiling import count, stage
+
+try:
+    from bw2data.backends.peewee import Activity
+except ImportError:
+    from bw2data.backends import Activity
+
+
+def is_bw25() -> bool:
+    """
+    Check if the installed version of bw2calc is 2.0 or above (Brightway 2.5).
+    :return: boolean
+    """
+    bw2calc_version = (
+        ".".join(map(str, bw2calc.__version__))
+        if isinstance(bw2calc.__version__, tuple)
+        else bw2calc.__version__
+    )
+    return Version(bw2calc_version) >= Version("2.0.DEV1")
+
+
+def get_demand_key(lca: bw2calc.LCA, activity: Activity):
+    """
+    Get the key under which an activity is known to an LCA object.
+    Brightway 2.5 uses integer ids, unless the dictionaries
+    of the LCA object have been remapped to (database, code) keys.
+    :param lca: a brightway2 LCA object
+    :param activity: a brightway2 activity
+    :return: an integer id or a (database, code) tuple
+    """
+    if is_bw25() and not getattr(lca, "_remapped", False):
+        return activity.id
+    return activity.key
+
+
+def get_database_dependencies(database: str) -> list:
+    """
+    Get a database and all the databases it depends on, directly or not.
+    :param database: name of a brightway2 database
+    :return: a sorted list of database names
+    """
+    to_visit, visited = [database], set()
+
+    while to_visit:
+        name = to_visit.pop()
+        if name not in visited:
+            visited.add(name)
+            to_visit.extend(bw2data.databases.get(name, {}).get("depends", []))
+
+    return sorted(visited)
+
+
+def get_database_fingerprint(database: str) -> tuple:
+    """
+    Get a fingerprint of a database and of the databases it depends on,
+    which changes whenever one of them is modified or processed.
+    :param database: name of a brightway2 database
+    :return: a tuple
+    """
+    fingerprint = []
+    for name in get_database_dependencies(database):
+        metadata = bw2data.databases.get(name, {})
+        fingerprint.append((name, metadata.get("modified"), metadata.get("processed")))
+
+    return tuple(fingerprint)
+
+
+def get_method_fingerprint(method: tuple):
+    """
+    Get a fingerprint of an LCIA method, which changes
+    whenever its characterization factors are processed again.
+    :param method: a tuple representing a brightway2 method
+    :return: modification time of the processed method, or None
+    """
+    try:
+        return os.path.getmtime(bw2data.Method(method).filepath_processed())
+    except (OSError, AttributeError, TypeError):
+        return None
+
+
+def get_size(obj: Any) -> int:
+    """
+    Estimate the memory footprint of an object held in the cache, in bytes.
+    :param obj: a numpy array, a sparse matrix, a pandas object, bytes, a string
+    or a container of those
+    :return: number of bytes
+    """
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, (bytes, str)):
+        return len(obj)
+    if sparse.issparse(obj):
+        obj = obj.tocsr() if not hasattr(obj, "indptr") else obj
+        return obj.data.nbytes + obj.indices.nbytes + obj.indptr.nbytes
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        return int(obj.memory_usage(deep=True).sum())
+    if isinstance(obj, dict):
+        return sum(get_size(value) for value in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(get_size(value) for value in obj)
+    return 0
+
+
+def get_lca_size(lca: bw2calc.LCA) -> int:
+    """
+    Estimate the memory footprint of an LCA object: its matrices,
+    its result arrays and the factorization of its technosphere matrix.
+    :param lca: a brightway2 LCA object
+    :return: number of bytes
+    """
+    size = sum(
+        get_size(getattr(lca, attribute, None))
+        for attribute in (
+            "technosphere_matrix",
+            "biosphere_matrix",
+            "characterization_matrix",
+            "inventory",
+            "characterized_inventory",
+            "supply_array",
+            "demand_array",
+        )
+    )
+    # the factorization (SuperLU) stores values and row indices of L and U
+    factorization = getattr(getattr(lca, "solver", None), "__self__", None)
+    size += getattr(factorization, "nnz", 0) * 12
+
+    return size
+
+
+class CacheEntry:
+    """
+    An LCA object held in the cache, together with
+    the values derived from it (e.g., unit scores).
+    """
+
+    def __init__(self, lca: bw2calc.LCA, fingerprint: tuple):
+        self.lca = lca
+        self.fingerprint = fingerprint
+        self.derived = {}
+
+    @property
+    def size(self) -> int:
+        return get_lca_size(self.lca) + get_size(self.derived)
+
+
+class LCACache:
+    """
+    LRU cache of LCA objects keyed by project, database and method,
+    with a cap on the number of entries and on the memory they use.
+    Entries are invalidated when the database (or one of its dependencies)
+    or the method is modified.
+
+    LCA objects are shared: `lock` should be held from the moment an LCA object
+    is calculated for a demand until its results are read, when charts are
+    generated in several threads (see `polyviz.aio`).
+    """
+
+    def __init__(self, max_entries: int = 16, max_memory: int = 2 * 1024**3):
+        """
+        :param max_entries: maximum number of LCA objects to keep
+        :param max_memory: maximum memory, in bytes, used by the cached LCA objects
+        """
+        self.max_entries = max_entries
+        self.max_memory = max_memory
+        self._entries = OrderedDict()
+        self.lock = threading.RLock()
+        self._counters = dict.fromkeys(
+            ["hits", "misses", "evictions", "invalidations"], 0
+        )
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def make_key(
+        activity: Activity, method: tuple, use_distributions: bool = False
+    ) -> tuple:
+        return (
+            bw2data.projects.current,
+            activity["database"],
+            tuple(method),
+            use_distributions,
+        )
+
+    def _get_entry(
+        self, activity: Activity, method: tuple, use_distributions: bool = False
+    ) -> CacheEntry:
+        key = self.make_key(activity, method, use_distributions)
+        fingerprint = (
+            get_database_fingerprint(activity["database"]),
+            get_method_fingerprint(method),
+        )
+
+        with self.lock:
+            entry = self._entries.get(key)
+
+            if entry is not None and entry.fingerprint != fingerprint:
+                del self._entries[key]
+                self._counters["invalidations"] += 1
+                entry = None
+
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._counters["hits"] += 1
+                return entry
+
+            self._counters["misses"] += 1
+            with stage("lca"):
+                if use_distributions:
+                    lca = bw2calc.LCA({activity: 1}, method, use_distributions=True)
+                else:
+                    lca = bw2calc.LCA({activity: 1}, method)
+                # factorizing is pointless if the matrices are resampled
+                lca.lci(factorize=not use_distributions)
+                lca.lcia()
+                count("lci")
+
+            entry = CacheEntry(lca, fingerprint)
+            self._entries[key] = entry
+            self._evict()
+
+            return entry
+
+    def _evict(self):
+        """
+        Remove the least recently used entries until the number of entries
+        and the memory used are below their caps. The most recent entry is kept.
+        """
+        while len(self._entries) > 1 and (
+            len(self._entries) > self.max_entries or self.memory > self.max_memory
+        ):
+            self._entries.popitem(last=False)
+            self._counters["evictions"] += 1
+
+    def get(
+        self,
+        activity: Activity,
+        method: tuple,
+        amount: float = 1,
+        use_distributions: bool = False,
+    ) -> bw2calc.LCA:
+        """
+        Get an LCA object for a given activity and method, with the LCI and
+        LCIA calculated for `amount` of `activity`.
+        :param activity: a brightway2 activity
+        :param method: a tuple representing a brightway2 method
+        :param amount: amount of the activity
+        :param use_distributions: whether the LCA object samples the uncertainty distributions
+        :return: a brightway2 LCA object
+        """
+        with self.lock:
+            lca = self._get_entry(activity, method, use_distributions).lca
+            lca.redo_lcia({get_demand_key(lca, activity): amount})
+            count("redo_lcia")
+
+        return lca
+
+    def get_derived(
+        self,
+        activity: Activity,
+        method: tuple,
+        name: Hashable,
+        func: Callable[[bw2calc.LCA], Any],
+    ) -> Any:
+        """
+        Get a value derived from the LCA object of an activity's database and a method,
+        calculating it with `func` only if it is not already in the cache.
+        :param activity: a brightway2 activity
+        :param method: a tuple representing a brightway2 method
+        :param name: name under which the value is cached
+        :param func: function calculating the value from the LCA object
+        :return: the derived value
+        """
+        with self.lock:
+            entry = self._get_entry(activity, method)
+            if name not in entry.derived:
+                entry.derived[name] = func(entry.lca)
+                self._evict()
+
+            return entry.derived[name]
+
+    @property
+    def memory(self) -> int:
+        """
+        Estimated memory used by the cached LCA objects, in bytes.
+        """
+        with self.lock:
+            return sum(entry.size for entry in self._entries.values())
+
+    def clear(self):
+        """
+        Empty the cache.
+        """
+        with self.lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """
+        Get statistics about the use of the cache.
+        :return: a dictionary with the number of hits, misses, evictions,
+        invalidations and entries, and the memory used
+        """
+        with self.lock:
+            return {
+                **self._counters,
+                "entries": len(self._entries),
+                "memory": self.memory,
+                "max_entries": self.max_entries,
+                "max_memory": self.max_memory,
+            }
+
+
+class ResultCache:
+    """
+    Persistent cache of results, stored as pickle files in the directory
+    of the current brightway2 project. Results are keyed on the activity,
+    the methods, the parameters of the calculation and the fingerprints
+    of the database and of the methods, so that they are calculated again
+    when one of those changes. The least recently used results are removed
+    when the files exceed a maximum size.
+    """
+
+    # version of the layout of the cached results, part of their key, so that
+    # results written by another version of polyviz are calculated again
+    version = 2
+
+    def __init__(self, max_size: int = 512 * 1024**2, enabled: bool = True):
+        """
+        :param max_size: maximum size, in bytes, of the cached results
+        :param enabled: whether results are read from and written to the cache
+        """
+        self.max_size = max_size
+        self.enabled = enabled
+        self._counters = dict.fromkeys(["hits", "misses", "evictions"], 0)
+
+    @property
+    def directory(self) -> Path:
+        """
+        Directory of the cache, in the directory of the current brightway2 project.
+        """
+        return Path(bw2data.projects.dir) / "polyviz"
+
+    def get_filepath(
+        self, name: str, activity: Activity, methods: list, **params
+    ) -> Path:
+        """
+        Get the path of the file in which a result is cached.
+        :param name: name of the result
+        :param activity: a brightway2 activity
+        :param methods: brightway2 methods
+        :param params: parameters of the calculation
+        :return: a filepath
+        """
+        key = (
+            self.version,
+            name,
+            activity["database"],
+            activity["code"],
+            [tuple(method) for method in methods],
+            sorted(params.items()),
+            # processing a database does not change the results
+            [
+                (database, modified)
+                for database, modified, _ in get_database_fingerprint(
+                    activity["database"]
+                )
+            ],
+            [get_method_fingerprint(method) for method in methods],
+        )
+        digest = hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+
+        return self.directory / f"{name}-{digest}.pickle"
+
+    def get(
+        self,
+        name: str,
+        activity: Activity,
+        methods: list,
+        func: Callable[[], Any],
+        mode: str = "use",
+        **params,
+    ) -> Any:
+        """
+        Get a result from the cache, calculating it with `func`
+        (and storing it) if it is not already in the cache.
+        :param name: name of the result
+        :param activity: a brightway2 activity
+        :param methods: brightway2 methods
+        :param func: function calculating the result
+        :param mode: "use" the cache, "refresh" it (calculate and store the result
+        even if it is in the cache) or "bypass" it (calculate the result without storing it)
+        :param params: parameters of the calculation
+        :return: the result
+        """
+        assert mode in (
+            "use",
+            "refresh",
+            "bypass",
+        ), "`mode` should be 'use', 'refresh' or 'bypass'."
+
+        if not self.enabled or mode == "bypass":
+            return func()
+
+        filepath = self.get_filepath(name, activity, methods, **params)
+
+        if mode == "use":
+            try:
+                with open(filepath, "rb") as file:
+                    result = pickle.load(file)
+                # mark the result as recently used
+                os.utime(filepath)
+                self._counters["hits"] += 1
+                count("result cache hits")
+                return result
+            except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+                pass
+
+        self._counters["misses"] += 1
+        count("result cache misses")
+        result = func()
+
+        try:
+            filepath.parent.mkdir(parents=True, exist_ok=True)
+            # write to a temporary file first, so that other processes
+            # (or threads) never read a partially written file
+            tmp_filepath = filepath.with_suffix(
+                f".{os.getpid()}.{threading.get_ident()}.tmp"
+            )
+            with open(tmp_filepath, "wb") as file:
+                pickle.dump(result, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_filepath, filepath)
+            self._evict()
+        except (OSError, pickle.PicklingError):
+            pass
+
+        return result
+
+    def _evict(self):
+        """
+        Remove the least recently used results until the files
+        are below the maximum size. The most recent result is kept.
+        """
+        files = []
+        for filepath in self.directory.glob("*.pickle"):
+            try:
+                stat = filepath.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, filepath))
+        files.sort()
+
+        size = sum(file_size for _, file_size, _ in files)
+        for _, file_size, filepath in files[:-1]:
+            if size <= self.max_size:
+                break
+            filepath.unlink(missing_ok=True)
+            size -= file_size
+            self._counters["evictions"] += 1
+
+    @property
+    def size(self) -> int:
+        """
+        Size of the cached results, in bytes.
+        """
+        return sum(
+            filepath.stat().st_size for filepath in self.directory.glob("*.pickle")
+        )
+
+    def clear(self):
+        """
+        Remove all the cached results of the current project.
+        """
+        for filepath in self.directory.glob("*.pickle"):
+            filepath.unlink(missing_ok=True)
+
+    def stats(self) -> dict:
+        """
+        Get statistics about the use of the cache.
+        :return: a dictionary with the number of hits, misses, evictions
+        and entries, and the size of the cached results
+        """
+        return {
+            **self._counters,
+            "entries": len(list(self.directory.glob("*.pickle"))),
+            "size": self.size,
+            "max_size": self.max_size,
+        }
+
+
+class MemoryCache:
+    """
+    LRU cache of values held in memory (e.g., supply chains or rendered charts),
+    with a cap on the memory they use. The most recent value is always kept.
+    A value requested by several threads at once is only calculated once.
+    """
+
+    def __init__(self, max_memory: int = 256 * 1024**2):
+        """
+        :param max_memory: maximum memory, in bytes, used by the cached values
+        """
+        self.max_memory = max_memory
+        self.memory = 0
+        self._entries = OrderedDict()
+        self.lock = threading.RLock()
+        # values being calculated, by key
+        self._in_flight = {}
+        self._counters = dict.fromkeys(["hits", "misses", "evictions"], 0)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(
+        self,
+        key: Hashable,
+        func: Callable[[], Any],
+        size: Callable[[Any], int] = get_size,
+    ) -> Any:
+        """
+        Get a value from the cache, calculating it with `func`
+        (and storing it) if it is not already in the cache.
+        The lock is not held while the value is calculated: other threads
+        requesting the same value wait for its calculation, and share
+        its result (or its error).
+        :param key: key of the value
+        :param func: function calculating the value
+        :param size: function estimating the memory used by the value, in bytes
+        :return: the value
+        """
+        with self.lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self._counters["hits"] += 1
+                return self._entries[key][0]
+            future = self._in_flight.get(key)
+            calculating = future is None
+            if calculating:
+                self._counters["misses"] += 1
+                future = self._in_flight[key] = Future()
+            else:
+                self._counters["hits"] += 1
+
+        if not calculating:
+            return future.result()
+
+        try:
+            value = func()
+            value_size = size(value)
+        except BaseException as err:
+            with self.lock:
+                del self._in_flight[key]
+            future.set_exception(err)
+            raise
+
+        with self.lock:
+            del self._in_flight[key]
+            if key in self._entries:
+                self.memory -= self._entries.pop(key)[1]
+            self._entries[key] = (value, value_size)
+            self.memory += value_size
+            self._evict()
+        future.set_result(value)
+
+        return value
+
+    def _evict(self):
+        """
+        Remove the least recently used values until the memory used is below its cap.
+        """
+        while len(self._entries) > 1 and self.memory > self.max_memory:
+            _, (_, value_size) = self._entries.popitem(last=False)
+            self.memory -= value_size
+            self._counters["evictions"] += 1
+
+    def clear(self):
+        """
+        Empty the cache.
+        """
+        with self.lock:
+            self._entries.clear()
+            self.memory = 0
+
+    def stats(self) -> dict:
+        """
+        Get statistics about the use of the cache.
+        :return: a dictionary with the number of hits, misses, evictions
+        and entries, and the memory used
+        """
+        with self.lock:
+            return {
+                **self._counters,
+                "entries": len(self._entries),
+                "memory": self.memory,
+                "max_memory": self.max_memory,
+            }
+
+
+# caches shared by all polyviz functions
+lca_cache = LCACache()
+result_cache = ResultCache()
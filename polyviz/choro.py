@@ -2,20 +2,29 @@
 Module that contains code to produce a Choropleth diagram.
 """
 
+import logging
 from typing import Union
 
 import bw2data
-from d3blocks import D3Blocks
 
 from .dataframe import distribute_region_impacts
-from .utils import check_filepath, get_geo_distribution_of_impacts_for_choro_graph
+from .profiling import stage
+from .render import ChartData
+from .render import render as render_chart
+from .utils import (
+    get_geo_distribution_of_impacts_for_choro_graph,
+    group_impacts_by_location,
+)
 
 try:
     from bw2data.backends.peewee import Activity
 except ImportError:
     from bw2data.backends import Activity
 
+logger = logging.getLogger(__name__)
 
+
+@stage("choro")
 def choro(
     activity: Activity,
     method: tuple,
@@ -24,7 +33,9 @@ def choro(
     title: str = None,
     notebook: bool = False,
     figsize: tuple = (1000, 500),
-) -> str:
+    impacts: tuple = None,
+    render: bool = True,
+) -> Union[str, ChartData]:
     """
     Generate a choropleth diagram for a given activity and method.
     :param activity: Brightway2 activity
@@ -34,11 +45,14 @@ def choro(
     :param title: Title of the plot
     :param notebook: Whether to display the plot in a notebook
     :param figsize: Size of the plot
-    :return: Path to the generated HTML file
+    :param impacts: direct impacts of activities and LCIA score, as returned by
+    `get_impacts_per_activity`, to use instead of calculating them again
+    :param render: If False, the chart is not rendered, and its data is returned
+    instead (see `polyviz.render`)
+    :return: Path to the generated HTML file, or the data of the chart if `render` is False
     """
 
     title = title or f"{activity['name']} ({activity['unit']}, {activity['location']})"
-    filepath = check_filepath(filepath, title, "choro", method)
 
     assert isinstance(method, tuple), "`method` should be a tuple."
     assert isinstance(activity, Activity), "`activity` should be a Brightway activity."
@@ -46,25 +60,21 @@ def choro(
     # fetch unit of method
     unit = bw2data.Method(method).metadata["unit"]
 
-    dataframe = get_geo_distribution_of_impacts_for_choro_graph(
-        activity, method, cutoff
-    )
+    if impacts is None:
+        dataframe = get_geo_distribution_of_impacts_for_choro_graph(
+            activity, method, cutoff
+        )
+    else:
+        dataframe = group_impacts_by_location(*impacts, cutoff)
     dataframe = distribute_region_impacts(dataframe, cutoff=cutoff)
     dataframe["unit"] = unit
 
-    if len(dataframe) > 0:
-        # Create a new D3Blocks object
-        d3_graph = D3Blocks()
-        d3_graph.choro(
-            df=dataframe,
-            title=title,
-            filepath=filepath,
-            notebook=notebook,
-            figsize=figsize,
-        )
+    if len(dataframe) == 0:
+        logger.warning("No data to plot.")
+        return None
 
-        return str(filepath)
+    data = ChartData("choro", dataframe, title, unit, method, None, figsize)
+    if not render:
+        return data
 
-    else:
-        print("No data to plot.")
-        return None
+    return render_chart(data, filepath, notebook)
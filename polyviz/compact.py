@@ -0,0 +1,276 @@
+"""
+This module contains the code to write charts as compact HTML files.
+
+D3Blocks writes self-contained HTML files, which embed the data of the chart,
+the JavaScript libraries, the styles and the images. With a low cutoff,
+each file grows to tens of MB. In compact mode, the HTML file written
+by D3Blocks is split in:
+
+* a side file, `<chart>.data.js`, with the data of the chart, in which lists
+  of records are stored as columns and repeated strings (node labels, colors,
+  etc.) are dictionary-encoded, so that links are arrays of numbers;
+* content-addressed files in an `assets` directory, next to the HTML file,
+  with the code of the scripts, the styles and the images. They are shared
+  by all the charts of the directory, and written once.
+
+The HTML file only references these files, and still works when opened
+from the file system.
+"""
+
+import hashlib
+import html
+import json
+import logging
+import os
+import re
+import tempfile
+from base64 import b64decode
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+ASSETS = "assets"
+
+# start of the data of a chart, assigned in the script of D3Blocks templates,
+# e.g., `const data = {"nodes": [...], "links": [...]}`
+DATA = re.compile(r'=\s*(\{\s*"(?:nodes|links)"\s*:)')
+SCRIPT = re.compile(r"<script([^>]*)>(.*?)</script>", re.S)
+STYLE = re.compile(r"<style[^>]*>(.*?)</style>", re.S)
+DATA_URI = re.compile(r"data:image/([\w+.-]+);base64,([A-Za-z0-9+/=]+)")
+TITLE = re.compile(r"<title>(.*?)</title>", re.S)
+# a JSON string, or a comma before a closing bracket
+TRAILING_COMMA = re.compile(r'("(?:[^"\\]|\\.)*")|,(\s*[\]}])')
+
+# placeholder of the title of the chart in the code of scripts
+TITLE_PLACEHOLDER = "{{polyviz title}}"
+
+# decodes the data of a chart, and runs the script of the chart with it
+RUNTIME = """\
+var polyviz = (window.polyviz = window.polyviz || { code: {} });
+
+polyviz.decode = function decode(value) {
+  if (Array.isArray(value)) return value.map(decode);
+  if (value === null || typeof value !== "object") return value;
+  var result = {};
+  if ("$columns" in value) {
+    var keys = Object.keys(value.$columns);
+    var columns = keys.map(function (key) {
+      var column = value.$columns[key];
+      if (Array.isArray(column)) return column.map(decode);
+      return column.$codes.map(function (code) {
+        return column.$values[code];
+      });
+    });
+    result = [];
+    for (var i = 0; i < value.$length; i++) {
+      var row = {};
+      for (var j = 0; j < keys.length; j++) row[keys[j]] = columns[j][i];
+      result.push(row);
+    }
+    return result;
+  }
+  Object.keys(value).forEach(function (key) {
+    result[key] = decode(value[key]);
+  });
+  return result;
+};
+
+polyviz.run = function (code, rest, title) {
+  var script = document.createElement("script");
+  code = polyviz.code[code].split("{{polyviz title}}").join(title);
+  script.text = code + "polyviz.decode(polyvizData)" + rest;
+  document.currentScript.after(script);
+};
+"""
+
+
+def encode(value):
+    """
+    Encode the data of a chart: lists of records with the same keys
+    are stored as columns, and columns of strings with repeated values
+    as a list of distinct values and the index of the value of each record.
+    :param value: data of a chart, as decoded from JSON
+    :return: encoded data, to be decoded by `polyviz.decode` in the browser
+    """
+    if isinstance(value, dict):
+        return {key: encode(item) for key, item in value.items()}
+
+    if not isinstance(value, list):
+        return value
+
+    if not value or not all(isinstance(item, dict) for item in value):
+        return [encode(item) for item in value]
+
+    keys = list(value[0])
+    if any(list(item) != keys for item in value):
+        return [encode(item) for item in value]
+
+    columns = {}
+    for key in keys:
+        column = [item[key] for item in value]
+        values = (
+            list(dict.fromkeys(column))
+            if all(isinstance(item, str) for item in column)
+            else None
+        )
+        if values is not None and len(values) < len(column):
+            codes = {item: code for code, item in enumerate(values)}
+            columns[key] = {"$values": values, "$codes": [codes[i] for i in column]}
+        else:
+            columns[key] = [encode(item) for item in column]
+
+    return {"$length": len(value), "$columns": columns}
+
+
+def find_data(script: str) -> tuple:
+    """
+    Find the data of a chart in a script of a D3Blocks template.
+    :param script: code of the script
+    :return: the start and the end of the data in the script, and the data,
+    or None if the script holds no data
+    """
+    match = DATA.search(script)
+    if match is None:
+        return None
+
+    start = match.start(1)
+    depth, in_string, escaped = 0, False, False
+    for end in range(start, len(script)):
+        char = script[end]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "{[":
+            depth += 1
+        elif char in "}]":
+            depth -= 1
+            if depth == 0:
+                break
+    else:
+        return None
+
+    # templates may leave a comma after the last item of a list
+    text = TRAILING_COMMA.sub(
+        lambda m: m.group(1) or m.group(2), script[start : end + 1]
+    )
+    try:
+        return start, end + 1, json.loads(text)
+    except json.JSONDecodeError:
+        logger.debug("The data of the chart could not be decoded.")
+        return None
+
+
+def write_asset(directory: Path, content: bytes, extension: str) -> tuple:
+    """
+    Write a file in the assets directory, named after the hash of its content,
+    unless it was already written (e.g., for another chart).
+    :param directory: directory of the HTML file
+    :param content: content of the file
+    :param extension: extension of the file
+    :return: the path to the file, relative to `directory`,
+    and the number of bytes written
+    """
+    name = f"{hashlib.sha256(content).hexdigest()[:16]}.{extension}"
+    path = directory / ASSETS / name
+
+    written = 0
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # charts rendered in parallel may write the same asset
+        with tempfile.NamedTemporaryFile(dir=path.parent, delete=False) as file:
+            file.write(content)
+        os.replace(file.name, path)
+        written = len(content)
+
+    return f"{ASSETS}/{name}", written
+
+
+def script_string(text: str) -> str:
+    # a JavaScript string, which can be embedded in an HTML script element
+    return json.dumps(text).replace("</", "<\\/")
+
+
+def compact_html(filepath: str) -> int:
+    """
+    Split an HTML file written by D3Blocks in a compact HTML file,
+    a side file with the data of the chart and shared assets.
+    :param filepath: Path to the HTML file, which is overwritten
+    :return: number of bytes saved, counting the side file
+    and the assets written for this chart
+    """
+    filepath = Path(filepath)
+    directory = filepath.parent
+    page = filepath.read_text(encoding="utf-8")
+    original = len(page.encode("utf-8"))
+    written = 0
+    title = TITLE.search(page)
+    title = html.unescape(title.group(1).strip()) if title else ""
+
+    def image(match) -> str:
+        nonlocal written
+        path, n = write_asset(directory, b64decode(match.group(2)), match.group(1))
+        written += n
+        return path
+
+    def style(match) -> str:
+        nonlocal written
+        # paths in styles are relative to the assets directory
+        css = DATA_URI.sub(lambda m: Path(image(m)).name, match.group(1))
+        path, n = write_asset(directory, css.encode("utf-8"), "css")
+        written += n
+        return f'<link rel="stylesheet" href="{path}">'
+
+    def script(match) -> str:
+        nonlocal written
+        attributes, code = match.groups()
+        if "src=" in attributes or not code.strip():
+            return match.group(0)
+
+        found = find_data(code)
+        if found is None:
+            path, n = write_asset(directory, code.encode("utf-8"), "js")
+            written += n
+            return f'<script src="{path}"></script>'
+
+        start, end, data = found
+        data_path = filepath.with_suffix(".data.js")
+        data_path.write_text(
+            "var polyvizData = "
+            + json.dumps(encode(data), separators=(",", ":"))
+            + ";\n",
+            encoding="utf-8",
+        )
+        written += data_path.stat().st_size
+
+        runtime, n = write_asset(directory, RUNTIME.encode("utf-8"), "js")
+        written += n
+        # the code before the data is the same for all charts of a type,
+        # except for their title
+        library = (
+            code[:start].replace(title, TITLE_PLACEHOLDER) if title else code[:start]
+        )
+        name = hashlib.sha256(library.encode("utf-8")).hexdigest()[:16]
+        library = f"polyviz.code[{json.dumps(name)}] = {json.dumps(library)};\n"
+        path, n = write_asset(directory, library.encode("utf-8"), "js")
+        written += n
+
+        return (
+            f'<script src="{data_path.name}"></script>\n'
+            f'<script src="{runtime}"></script>\n'
+            f'<script src="{path}"></script>\n'
+            f"<script>polyviz.run({json.dumps(name)}, "
+            f"{script_string(code[end:])}, {script_string(title)});</script>"
+        )
+
+    page = STYLE.sub(style, page)
+    page = SCRIPT.sub(script, page)
+    page = DATA_URI.sub(image, page)
+    filepath.write_text(page, encoding="utf-8")
+
+    return original - len(page.encode("utf-8")) - written
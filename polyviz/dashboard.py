@@ -0,0 +1,208 @@
+"""
+This module contains the function to generate all the charts of an activity
+from a single calculation.
+"""
+
+import html
+import logging
+import tempfile
+from pathlib import Path
+from typing import Union
+
+from .chord import chord
+from .choro import choro
+from .force import force
+from .profiling import stage
+from .sankey import sankey
+from .treemap import treemap
+from .utils import (
+    calculate_supply_chain,
+    check_filepath,
+    get_impacts_per_activity,
+)
+
+try:
+    from bw2data.backends.peewee import Activity
+except ImportError:
+    from bw2data.backends import Activity
+
+logger = logging.getLogger(__name__)
+
+CHARTS = {
+    "sankey": sankey,
+    "chord": chord,
+    "force": force,
+    "treemap": treemap,
+    "choro": choro,
+}
+
+
+@stage("dashboard")
+def dashboard(
+    activity: Activity,
+    method: tuple,
+    charts: tuple = tuple(CHARTS),
+    level: int = 3,
+    cutoff: float = 0.01,
+    geo_cutoff: float = 0.001,
+    filepath: str = None,
+    directory: str = None,
+    title: str = None,
+    compact: bool = False,
+    max_nodes: int = None,
+) -> Union[str, dict]:
+    """
+    Generate several charts for a given activity and method.
+    The supply chain is traversed once for the Sankey, Chord and Force-directed
+    diagrams, and the impacts of activities are calculated once for the
+    tree map and the choropleth map.
+    :param activity: Brightway2 activity
+    :param method: tuple representing a Brightway2 method
+    :param charts: charts to generate, among "sankey", "chord", "force", "treemap" and "choro"
+    :param level: number of levels of the supply chain to display
+    :param cutoff: cutoff value for the supply chain
+    :param geo_cutoff: cutoff value for the tree map and the choropleth map
+    :param filepath: Path to save the HTML page gathering all charts
+    :param directory: Directory to save one HTML file per chart in, instead of a single page
+    :param title: Title of the charts
+    :param compact: Whether to write the data of the Sankey, Chord and Force-directed
+    diagrams in side files, and their scripts and styles in assets shared by the charts
+    of the directory (only with `directory`, see `polyviz.compact`)
+    :param max_nodes: maximum number of activities of the Chord and Force-directed
+    diagrams, the others being folded into one node per consumer (see `keep_largest_nodes`)
+    :return: Path to the generated HTML page, or, if `directory` is given,
+    a dictionary with the path to the HTML file of each chart
+    """
+
+    assert isinstance(method, tuple), "`method` should be a tuple."
+    assert isinstance(activity, Activity), "`activity` should be a brightway2 activity."
+    assert all(
+        chart in CHARTS for chart in charts
+    ), f"`charts` should be among {', '.join(CHARTS)}."
+    assert (
+        directory is not None or not compact
+    ), "`compact` is only available with `directory`."
+
+    title = title or f"{activity['name']} ({activity['unit']}, {activity['location']})"
+
+    options = {}
+
+    if any(chart in ("sankey", "chord", "force") for chart in charts):
+        if level < 2:
+            raise ValueError("The level of recursion should be at least 2.")
+
+        supply_chain, _ = calculate_supply_chain(activity, [method], level, cutoff)
+        for chart in ("sankey", "chord", "force"):
+            options[chart] = {
+                "level": level,
+                "cutoff": cutoff,
+                "supply_chain": supply_chain,
+                "compact": compact,
+            }
+        for chart in ("chord", "force"):
+            options[chart]["max_nodes"] = max_nodes
+
+    if any(chart in ("treemap", "choro") for chart in charts):
+        logger.info("Calculating LCIA score...")
+        impacts = get_impacts_per_activity(activity, method)
+        for chart in ("treemap", "choro"):
+            options[chart] = {"cutoff": geo_cutoff, "impacts": impacts}
+
+    if directory is None:
+        with tempfile.TemporaryDirectory() as tmp:
+            filepaths = render_charts(activity, method, charts, options, tmp, title)
+            pages = {
+                chart: Path(path).read_text(encoding="utf-8")
+                for chart, path in filepaths.items()
+            }
+
+        filepath = check_filepath(
+            filepath, title, "dashboard", method, code=activity["code"]
+        )
+        filepath.write_text(make_dashboard_page(title, pages), encoding="utf-8")
+
+        logger.info("Dashboard generated.")
+
+        return str(filepath)
+
+    return render_charts(activity, method, charts, options, directory, title)
+
+
+def render_charts(
+    activity: Activity,
+    method: tuple,
+    charts: tuple,
+    options: dict,
+    directory: str,
+    title: str,
+) -> dict:
+    """
+    Render charts in a directory.
+    :param activity: Brightway2 activity
+    :param method: tuple representing a Brightway2 method
+    :param charts: charts to generate
+    :param options: keyword arguments of each chart function
+    :param directory: directory to save the HTML files in
+    :param title: Title of the charts
+    :return: a dictionary with the path to the HTML file of each chart,
+    for the charts that could be generated
+    """
+
+    filepaths = {}
+
+    for chart in charts:
+        filepath = check_filepath(
+            None, title, chart, method, directory=directory, code=activity["code"]
+        )
+        result = CHARTS[chart](
+            activity=activity,
+            method=method,
+            filepath=filepath,
+            title=title,
+            **options[chart],
+        )
+
+        # `sankey` also returns the dataframe it plotted
+        if isinstance(result, tuple):
+            result = result[0]
+
+        if result is not None:
+            filepaths[chart] = result
+
+    return filepaths
+
+
+def make_dashboard_page(title: str, pages: dict) -> str:
+    """
+    Gather the HTML pages of several charts in a single HTML page.
+    Each chart is embedded in its own frame, so that the scripts
+    and styles of a chart do not interfere with those of the others.
+    :param title: Title of the page
+    :param pages: a dictionary with the HTML page of each chart
+    :return: an HTML page
+    """
+
+    frames = "\n".join(
+        f'<section id="{chart}">\n'
+        f"<h2>{chart.capitalize()}</h2>\n"
+        f'<iframe srcdoc="{html.escape(page, quote=True)}"></iframe>\n'
+        f"</section>"
+        for chart, page in pages.items()
+    )
+
+    return f"""<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{html.escape(title)}</title>
+<style>
+body {{ font-family: sans-serif; margin: 2em; }}
+iframe {{ border: none; width: 100%; height: 800px; }}
+</style>
+</head>
+<body>
+<h1>{html.escape(title)}</h1>
+{frames}
+</body>
+</html>
+"""
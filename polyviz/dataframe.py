@@ -3,27 +3,41 @@ This module contains functions to format the result of
 the recursive calculation into a pandas dataframe.
 """
 
-from collections import defaultdict
-from typing import List, Union
+import logging
+from typing import Iterable, List, Union
 
-import bw2data
 import numpy as np
 import pandas as pd
 
-from .utils import calculate_lcia_score, get_gdp_per_country, get_region_definitions
+from .profiling import stage
+from .utils import (
+    ACTIVITY,
+    BELOW_CUTOFF,
+    LOSS,
+    OTHER,
+    get_impacts_per_activity,
+    get_region_to_country_matrix,
+)
 
 try:
     from bw2data.backends.peewee import Activity
 except ImportError:
     from bw2data.backends import Activity
 
+logger = logging.getLogger(__name__)
 
+# label of the node of the other suppliers of an activity (see `keep_largest_nodes`)
+OTHER_LABEL = "other suppliers of "
+
+
+@stage("dataframe")
 def format_supply_chain_dataframe(
-    results: List[List], amount: int = 1, flow_type: str = None
+    results: Iterable[List], amount: int = 1, flow_type: str = None
 ) -> pd.DataFrame:
     """
     Format the result of the recursive calculation into a pandas dataframe.
-    :param result: string containing the result of the recursive calculation
+    :param results: rows of the supply chain, as a list or an iterator
+    (see `iterate_supply_chain`), consumed as they are calculated
     :param amount: reference amount
     :param flow_type: if not None, only keep flows with a matching unit
     :return: a pandas dataframe
@@ -64,6 +78,101 @@ def format_supply_chain_dataframe(
     dataframe = dataframe.replace("market for", "m. for", regex=True)
     dataframe = dataframe.replace("market group for", "m. gr. for", regex=True)
 
+    return aggregate_supply_chain_dataframe(dataframe, amount, flow_type)
+
+
+@stage("dataframe")
+def format_supply_chain_table(
+    table: np.ndarray,
+    metadata: pd.DataFrame,
+    amount: int = 1,
+    flow_type: str = None,
+) -> pd.DataFrame:
+    """
+    Format a supply chain, as a structured array (see `SupplyChain.to_array`),
+    into a pandas dataframe. Same as `format_supply_chain_dataframe`, but labels
+    are made once per activity rather than once per row.
+    :param table: a numpy structured array
+    :param metadata: metadata of the activities of the supply chain, by matrix column
+    :param amount: reference amount
+    :param flow_type: if not None, only keep flows with a matching unit
+    :return: a pandas dataframe
+    """
+
+    columns, inverse = np.unique(table["column"], return_inverse=True)
+    names = metadata["name"].to_numpy()[columns]
+    locations = metadata["location"].to_numpy()[columns]
+
+    # labels of the activities as sources and as targets of flows
+    sources = np.array(
+        [
+            f"{name} ({location})" if location else name
+            for name, location in zip(names, locations)
+        ],
+        dtype=object,
+    )
+    targets = np.array(
+        [f"{name} ({location})" for name, location in zip(names, locations)],
+        dtype=object,
+    )
+    sources, targets = (
+        pd.Series(labels, dtype=object)
+        .replace("market for", "m. for", regex=True)
+        .replace("market group for", "m. gr. for", regex=True)
+        .to_numpy()
+        for labels in (sources, targets)
+    )
+
+    source = sources[inverse]
+    source[table["flag"] == BELOW_CUTOFF] = "activities below cutoff"
+    source[table["flag"] == LOSS] = "loss"
+
+    # flows go to the parent of each node, or to the node itself for the root
+    target = np.where(
+        table["parent"] >= 0,
+        targets[inverse[np.maximum(table["parent"], 0)]],
+        targets[inverse],
+    )
+
+    # other activities, folded by `keep_largest_nodes`, in one node per parent
+    is_other = table["flag"] == OTHER
+    source[is_other] = OTHER_LABEL + target[is_other].astype(object)
+
+    dataframe = pd.DataFrame(
+        {
+            "source": source,
+            "target": target,
+            "weight": table["amount"] if flow_type else table["score"],
+            "level": table["level"].astype(np.int64),
+        }
+    )
+
+    if flow_type:
+        units = metadata["unit"].to_numpy()[columns][inverse]
+        dataframe = dataframe.loc[
+            (table["flag"] == ACTIVITY) & (units == flow_type)
+        ].reset_index(drop=True)
+
+    # as with `format_supply_chain_dataframe`, the amount of the last row
+    # decides whether negative flows are dropped or reversed
+    if len(table):
+        amount = table["amount"][-1]
+
+    return aggregate_supply_chain_dataframe(dataframe, amount, flow_type)
+
+
+def aggregate_supply_chain_dataframe(
+    dataframe: pd.DataFrame, amount: int = 1, flow_type: str = None
+) -> pd.DataFrame:
+    """
+    Sum duplicate flows of a supply chain dataframe, handle negative flows
+    and add rows representing emissions.
+    :param dataframe: a pandas dataframe with `source`, `target`, `weight` and `level` columns
+    :param amount: reference amount
+    :param flow_type: if not None, flows are amounts of this unit rather than impacts
+    :return: a pandas dataframe
+    """
+
     # sum duplicate rows
     dataframe = dataframe.groupby(["source", "target", "level"]).sum().reset_index()
 
@@ -78,38 +187,7 @@ def format_supply_chain_dataframe(
 
     # add rows representing emissions
     if not flow_type:
-        for level in dataframe["level"].unique():
-            for i, row in dataframe.loc[dataframe["level"] == level].iterrows():
-                if (
-                    row["source"]
-                    not in ["loss", "activities below cutoff", "emissions"]
-                    and level + 1 in dataframe["level"].unique()
-                ):
-                    sum_emissions = row["weight"]
-                    downstream_emissions = find_downstream_emissions(
-                        dataframe, row["source"], level
-                    )
-
-                    if downstream_emissions < sum_emissions:
-                        # insert a row with the missing emissions
-                        dataframe = pd.concat(
-                            [
-                                dataframe,
-                                pd.DataFrame(
-                                    {
-                                        "source": "emissions",
-                                        "target": row["source"],
-                                        "weight": sum_emissions - downstream_emissions,
-                                        "level": level + 1,
-                                    },
-                                    index=[0],
-                                ),
-                            ],
-                            ignore_index=True,
-                        )
-
-        # reorder by level and target
-        dataframe = dataframe.sort_values(by=["level", "target"])
+        dataframe = add_emission_rows(dataframe)
 
     # drop the `level` column
     dataframe = dataframe.drop(labels="level", axis=1)
@@ -117,6 +195,57 @@ def format_supply_chain_dataframe(
     return dataframe
 
 
+def add_emission_rows(dataframe: pd.DataFrame) -> pd.DataFrame:
+    """
+    Add, for each supplier, a row representing its direct emissions, i.e.,
+    the part of its impact not accounted for by its own suppliers
+    at the next level.
+    :param dataframe: a pandas dataframe with `source`, `target`, `weight` and `level` columns
+    :return: a pandas dataframe
+    """
+
+    candidates = dataframe.loc[
+        ~dataframe["source"].isin(["loss", "activities below cutoff", "emissions"])
+        & ~dataframe["source"].str.startswith(OTHER_LABEL)
+        & (dataframe["level"] + 1).isin(dataframe["level"].unique())
+    ]
+
+    # sum of the impacts of the suppliers of each source, one level down
+    downstream = (
+        dataframe.assign(level=dataframe["level"] - 1)
+        .groupby(["target", "level"])["weight"]
+        .sum()
+        .reindex(pd.MultiIndex.from_arrays([candidates["source"], candidates["level"]]))
+        .fillna(0)
+    )
+
+    # when a source appears several times at the same level, the emission
+    # rows of the previous occurrences count as downstream impacts
+    groups = [candidates["source"], candidates["level"]]
+    previous = candidates["weight"].groupby(groups).cummax().groupby(groups).shift()
+    downstream = np.fmax(downstream.to_numpy(), previous.to_numpy())
+
+    missing = candidates["weight"].to_numpy() - downstream
+    mask = missing > 0
+
+    if not mask.any():
+        return dataframe
+
+    emissions = pd.DataFrame(
+        {
+            "source": "emissions",
+            "target": candidates.loc[mask, "source"].to_numpy(),
+            "weight": missing[mask],
+            "level": candidates.loc[mask, "level"].to_numpy() + 1,
+        }
+    )
+
+    dataframe = pd.concat([dataframe, emissions], ignore_index=True)
+
+    # reorder by level and target
+    return dataframe.sort_values(by=["level", "target"])
+
+
 def find_downstream_emissions(
     dataframe: pd.DataFrame,
     target: str,
@@ -141,39 +270,26 @@ def add_country_column(dataframe: pd.DataFrame) -> pd.DataFrame:
     return dataframe
 
 
-def get_geo_distribution_of_impacts(
-    activity: Activity,
-    method: tuple,
-    cutoff: float = 0.0001,
-):
+@stage("dataframe")
+def group_impacts_by_location_and_activity(
+    impacts: pd.DataFrame, score: float, cutoff: float = 0.0001
+) -> pd.DataFrame:
     """
-    Get a pandas dataframe with the distribution of impacts per country.
-    :param activity: a brightway2 activity
-    :param method: a tuple representing a brightway2 method
+    Sum the direct impacts of activities per location and activity name.
+    :param impacts: direct impacts of activities, from `get_impacts_per_activity`
+    :param score: the LCIA score
     :param cutoff: a cutoff value for the impact
     :return: a pandas dataframe
     """
 
-    score, c_matrix, rev = calculate_lcia_score(activity, method)
-
-    results = defaultdict(dict)
-    for nz_idx in np.argwhere(c_matrix > cutoff * score):
-        act = bw2data.get_activity(rev[nz_idx[1]])
-
-        if act["name"] not in results[act["location"]]:
-            results[act["location"]][act["name"]] = 0
+    impacts = impacts.loc[impacts["weight"] > cutoff * score]
+    dataframe = impacts.groupby(["location", "name"], sort=False, dropna=False).sum()
 
-        results[act["location"]][act["name"]] += c_matrix[0, nz_idx[1]]
-
-    countries = []
-    activities = []
-
-    for country, value in results.items():
-        countries.append(country)
-        activities.append(pd.DataFrame.from_dict(value, orient="index"))
-
-    dataframe = pd.concat(activities, keys=countries)
+    # group rows by country, in order of first appearance
     dataframe = dataframe.reset_index()
+    dataframe = dataframe.iloc[
+        np.argsort(pd.factorize(dataframe["location"])[0], kind="stable")
+    ].reset_index(drop=True)
 
     # rename columns
     dataframe.columns = ["country", "activity", "weight"]
@@ -190,6 +306,58 @@ def get_geo_distribution_of_impacts(
     return dataframe
 
 
+def get_geo_distribution_of_impacts(
+    activity: Activity,
+    method: tuple,
+    cutoff: float = 0.0001,
+    cache: str = "use",
+):
+    """
+    Get a pandas dataframe with the distribution of impacts per country.
+    :param activity: a brightway2 activity
+    :param method: a tuple representing a brightway2 method
+    :param cutoff: a cutoff value for the impact
+    :param cache: "use" (default), "refresh" or "bypass" the on-disk cache of results
+    :return: a pandas dataframe
+    """
+
+    logger.info("Calculating LCIA score...")
+    impacts, score = get_impacts_per_activity(activity, method, cache)
+
+    return group_impacts_by_location_and_activity(impacts, score, cutoff)
+
+
+def distribute_impacts_to_countries(impacts: pd.DataFrame) -> pd.DataFrame:
+    """
+    Distribute the impacts of regions to the countries of the regions, based
+    on their GDP, for several impact vectors (e.g., methods or activities) at once.
+    Locations that are not regions are left untouched.
+    :param impacts: pandas dataframe indexed by location, with one column per impact vector
+    :return: pandas dataframe indexed by country, with one column per impact vector
+    """
+
+    matrix, regions, countries = get_region_to_country_matrix()
+
+    # unknown locations are kept, as in `group_impacts_by_location`
+    impacts = impacts.groupby(level=0, dropna=False).sum()
+    is_region = impacts.index.isin(regions)
+    region_impacts = impacts.loc[is_region]
+
+    distributed = pd.DataFrame(
+        matrix[regions.get_indexer(region_impacts.index)].T
+        @ region_impacts.to_numpy(dtype=float),
+        index=countries,
+        columns=impacts.columns,
+    )
+    distributed = distributed.loc[(distributed != 0).any(axis=1)]
+
+    return (
+        pd.concat([impacts.loc[~is_region], distributed])
+        .groupby(level=0, dropna=False)
+        .sum()
+    )
+
+
 def distribute_region_impacts(dataframe, cutoff):
     """
     Distribute the impacts of a region to the countries of the region.
@@ -198,42 +366,10 @@ def distribute_region_impacts(dataframe, cutoff):
     :return: pandas dataframe
     """
 
-    regions = get_region_definitions()
-    gdp = get_gdp_per_country()
-
-    for i, row in dataframe.loc[dataframe["country"].isin(regions)].iterrows():
-        # find the counrties of the region
-        # and distirbute the impact of the region to the countries
-        # based on their GDP
-        countries = regions.get(row["country"], [])
-
-        if countries:
-            # sum of gdp
-            gdp_sum = 0
-            for country in countries:
-                gdp_sum += gdp.get(country, 0)
-
-            # distribute the impact
-            for country in countries:
-                if country in gdp:
-                    # add a row for the country
-                    dataframe = pd.concat(
-                        [
-                            dataframe,
-                            pd.DataFrame(
-                                {
-                                    "country": country,
-                                    "weight": row["weight"]
-                                    * gdp.get(country, 0)
-                                    / gdp_sum,
-                                },
-                                index=[0],
-                            ),
-                        ]
-                    )
-
-    # remove the rows of the regions
-    dataframe = dataframe.loc[~dataframe["country"].isin(regions)]
+    dataframe = distribute_impacts_to_countries(
+        dataframe.set_index("country")[["weight"]]
+    )
+    dataframe = dataframe.rename_axis("country").reset_index()
 
     # remove the rows with a weight inferior to 1%
     # of the sum
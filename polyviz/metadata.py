@@ -0,0 +1,286 @@
+"""
+Bulk-loaded metadata of activities and of their technosphere exchanges.
+
+Instead of querying the database for each node of a supply chain
+(``bw2data.get_activity``, ``activity.technosphere()``, ``exc.input``, etc.),
+all activities and exchanges of a database and of its dependencies are
+loaded in one query each, and cached for the lifetime of the process.
+"""
+
+from functools import lru_cache
+
+import bw2calc
+import bw2data
+import numpy as np
+import pandas as pd
+
+from .cache import (
+    get_database_dependencies,
+    get_database_fingerprint,
+    is_bw25,
+    lca_cache,
+)
+from .profiling import count, stage
+
+try:
+    from bw2data.backends.peewee import Activity, ActivityDataset, ExchangeDataset
+except ImportError:
+    from bw2data.backends import Activity, ActivityDataset, ExchangeDataset
+
+try:
+    from bw2data.configuration import labels
+
+    PRODUCTION_TYPES = [
+        kind
+        for kind in labels.technosphere_positive_edge_types
+        if kind not in labels.substitution_edge_types
+    ]
+    CONSUMPTION_TYPES = list(labels.technosphere_negative_edge_types)
+except ImportError:
+    PRODUCTION_TYPES = ["production"]
+    CONSUMPTION_TYPES = ["technosphere"]
+
+
+@lru_cache(maxsize=8)
+@stage("metadata")
+def load_database_metadata(
+    project: str, databases: tuple, fingerprint: tuple
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Load the activities and technosphere exchanges of several databases,
+    with one query for each. `project` and `fingerprint` are only used
+    as cache keys, so that the data is loaded again when they change.
+    :param project: name of the current brightway2 project
+    :param databases: names of the databases to load
+    :param fingerprint: fingerprint of the databases
+    :return: a dataframe of activities indexed by (database, code),
+    and a dataframe of technosphere exchanges
+    """
+
+    activities = pd.DataFrame(
+        [
+            (
+                act_id,
+                database,
+                code,
+                name,
+                product,
+                location,
+                data.get("unit"),
+            )
+            for act_id, database, code, name, product, location, data in (
+                ActivityDataset.select(
+                    ActivityDataset.id,
+                    ActivityDataset.database,
+                    ActivityDataset.code,
+                    ActivityDataset.name,
+                    ActivityDataset.product,
+                    ActivityDataset.location,
+                    ActivityDataset.data,
+                )
+                .where(ActivityDataset.database << list(databases))
+                .tuples()
+            )
+        ],
+        columns=["id", "database", "code", "name", "product", "location", "unit"],
+    )
+
+    exchanges = pd.DataFrame(
+        [
+            (output_database, output_code, input_database, input_code, kind, data)
+            for output_database, output_code, input_database, input_code, kind, data in (
+                ExchangeDataset.select(
+                    ExchangeDataset.output_database,
+                    ExchangeDataset.output_code,
+                    ExchangeDataset.input_database,
+                    ExchangeDataset.input_code,
+                    ExchangeDataset.type,
+                    ExchangeDataset.data,
+                )
+                .where(
+                    (ExchangeDataset.output_database << list(databases))
+                    & (ExchangeDataset.type << PRODUCTION_TYPES + CONSUMPTION_TYPES)
+                )
+                .order_by(ExchangeDataset.id)
+                .tuples()
+            )
+        ],
+        columns=[
+            "output_database",
+            "output_code",
+            "input_database",
+            "input_code",
+            "type",
+            "data",
+        ],
+    )
+    exchanges["amount"] = [data["amount"] for data in exchanges.pop("data")]
+    count("queries", 2)
+
+    # an activity is a waste treatment if its reference flow is negative
+    production = exchanges.loc[exchanges["type"].isin(PRODUCTION_TYPES)]
+    waste = production.loc[
+        production["amount"] < 0, ["output_database", "output_code"]
+    ].drop_duplicates()
+    activities = activities.set_index(["database", "code"])
+    activities["waste"] = activities.index.isin(
+        pd.MultiIndex.from_frame(waste, names=["database", "code"])
+    )
+
+    exchanges = exchanges.loc[exchanges["type"].isin(CONSUMPTION_TYPES)].reset_index(
+        drop=True
+    )
+
+    return activities, exchanges
+
+
+def get_database_metadata(database: str) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Get the activities and technosphere exchanges of a database
+    and of the databases it depends on.
+    :param database: name of a brightway2 database
+    :return: a dataframe of activities indexed by (database, code),
+    and a dataframe of technosphere exchanges
+    """
+    return load_database_metadata(
+        bw2data.projects.current,
+        tuple(get_database_dependencies(database)),
+        get_database_fingerprint(database),
+    )
+
+
+def get_column_keys(lca: bw2calc.LCA) -> list:
+    """
+    Get the keys of the activities of an LCA object, ordered by matrix column.
+    Keys are integer ids, or (database, code) tuples with Brightway 2
+    or if the dictionaries of the LCA object have been remapped.
+    :param lca: a brightway2 LCA object
+    :return: a list of keys
+    """
+    mapping = lca.dicts.activity if is_bw25() else lca.activity_dict
+    keys = [None] * len(mapping)
+    for key, column in mapping.items():
+        keys[column] = key
+    return keys
+
+
+def build_activity_metadata(lca: bw2calc.LCA, database: str) -> pd.DataFrame:
+    """
+    Build the metadata table of the activities of an LCA object.
+    :param lca: a brightway2 LCA object, with inventory data loaded
+    :param database: name of the database the LCA object was built for
+    :return: a dataframe indexed by matrix column, with the name, product,
+    location, unit and waste flag of each activity, its database and code,
+    its key in the LCA object and the row index of its product
+    """
+    activities, _ = get_database_metadata(database)
+    keys = get_column_keys(lca)
+
+    if keys and isinstance(keys[0], tuple):
+        metadata = activities.reindex(pd.MultiIndex.from_tuples(keys)).reset_index()
+        metadata.columns = ["database", "code"] + list(metadata.columns[2:])
+    else:
+        metadata = activities.reset_index().set_index("id").reindex(keys)
+        metadata = metadata.reset_index(drop=True)
+
+    metadata["key"] = keys
+    products = lca.dicts.product if is_bw25() else lca.product_dict
+    metadata["row"] = [products[key] for key in keys]
+
+    return metadata[
+        [
+            "name",
+            "product",
+            "location",
+            "unit",
+            "waste",
+            "database",
+            "code",
+            "key",
+            "row",
+        ]
+    ]
+
+
+def get_activity_column(metadata: pd.DataFrame, activity: Activity) -> int:
+    """
+    Get the matrix column of an activity from a metadata table.
+    :param metadata: metadata table of an LCA object
+    :param activity: a brightway2 activity
+    :return: column index
+    """
+    (column,) = np.flatnonzero(
+        (metadata["database"].to_numpy() == activity["database"])
+        & (metadata["code"].to_numpy() == activity["code"])
+    )
+    return int(column)
+
+
+def build_technosphere_exchanges(
+    database: str, metadata: pd.DataFrame
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Build the technosphere exchanges of the activities of an LCA object,
+    in a compressed sparse row layout: the inputs of the activity of column j are
+    `inputs[indptr[j]:indptr[j + 1]]`, in the amounts `amounts[indptr[j]:indptr[j + 1]]`.
+    Unlike in the technosphere matrix, exchanges are neither summed nor netted
+    with the production exchange, and keep their order in the database.
+    :param database: name of the database the LCA object was built for
+    :param metadata: metadata table of the LCA object
+    :return: `indptr`, `inputs` and `amounts` arrays
+    """
+    _, exchanges = get_database_metadata(database)
+
+    columns = pd.MultiIndex.from_frame(metadata[["database", "code"]])
+    outputs = columns.get_indexer(
+        pd.MultiIndex.from_frame(exchanges[["output_database", "output_code"]])
+    )
+    inputs = columns.get_indexer(
+        pd.MultiIndex.from_frame(exchanges[["input_database", "input_code"]])
+    )
+    amounts = exchanges["amount"].to_numpy(dtype=float)
+
+    # ignore exchanges with activities that are not in the matrices
+    mask = (outputs >= 0) & (inputs >= 0)
+    outputs, inputs, amounts = outputs[mask], inputs[mask], amounts[mask]
+
+    order = np.argsort(outputs, kind="stable")
+    indptr = np.searchsorted(outputs[order], np.arange(len(metadata) + 1))
+
+    return indptr, inputs[order], amounts[order]
+
+
+def get_activity_metadata(activity: Activity, method: tuple) -> pd.DataFrame:
+    """
+    Get the metadata table of the activities in the supply chain of an activity,
+    indexed by the columns of the LCA object returned by `lca_cache` for `method`.
+    :param activity: a brightway2 activity
+    :param method: a tuple representing a brightway2 method
+    :return: a pandas dataframe
+    """
+    return lca_cache.get_derived(
+        activity,
+        method,
+        "metadata",
+        lambda lca: build_activity_metadata(lca, activity["database"]),
+    )
+
+
+def get_technosphere_exchanges(
+    activity: Activity, method: tuple
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Get the technosphere exchanges of the activities in the supply chain of an activity,
+    by column of the LCA object returned by `lca_cache` for `method`.
+    See `build_technosphere_exchanges`.
+    :param activity: a brightway2 activity
+    :param method: a tuple representing a brightway2 method
+    :return: `indptr`, `inputs` and `amounts` arrays
+    """
+    metadata = get_activity_metadata(activity, method)
+    return lca_cache.get_derived(
+        activity,
+        method,
+        "technosphere_exchanges",
+        lambda lca: build_technosphere_exchanges(activity["database"], metadata),
+    )
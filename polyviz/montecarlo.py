@@ -0,0 +1,441 @@
+"""
+Parallel and reproducible Monte Carlo simulations.
+
+Iterations are split in chunks, each sampled with its own random number
+generator, seeded from the user-supplied seed, the index of the activity
+and the index of the chunk. Chunks are distributed over a pool of processes,
+and their results are put back in order, so that the results only depend
+on the seed, and not on the number of worker processes.
+"""
+
+import logging
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator
+
+import bw2calc
+import bw2data
+import numpy as np
+
+from .batch import init_worker
+from .profiling import count, stage
+from .utils import get_unit_scores
+
+try:
+    from bw2data.backends.peewee import Activity
+except ImportError:
+    from bw2data.backends import Activity
+
+logger = logging.getLogger(__name__)
+
+
+def get_chunk_seed(seed: int, activity_index: int, chunk_index: int) -> int:
+    """
+    Derive the seed of a chunk of iterations. Streams derived for different
+    activities or chunks are statistically independent.
+    :param seed: seed of the simulation
+    :param activity_index: index of the activity
+    :param chunk_index: index of the chunk of iterations
+    :return: a seed
+    """
+    return int(
+        np.random.SeedSequence(
+            seed, spawn_key=(activity_index, chunk_index)
+        ).generate_state(1)[0]
+    )
+
+
+def sample_scores(
+    activity_id: int, method: tuple, iterations: int, seed: int
+) -> np.ndarray:
+    """
+    Sample the LCIA score of an activity, with an LCA object
+    using the uncertainty distributions of the matrices.
+    :param activity_id: id of a brightway2 activity
+    :param method: tuple representing a brightway2 method
+    :param iterations: number of samples
+    :param seed: seed of the random number generator
+    :return: a numpy array of scores
+    """
+    lca = bw2calc.LCA(
+        {activity_id: 1}, method, use_distributions=True, seed_override=seed
+    )
+    # the first sample is drawn when the matrices are built
+    lca.lci(factorize=False)
+    lca.lcia()
+
+    scores = np.zeros(iterations)
+    scores[0] = lca.score
+    for i in range(1, iterations):
+        next(lca)
+        scores[i] = lca.score
+
+    return scores
+
+
+def sample_paired_scores(
+    activity_ids: tuple, method: tuple, iterations: int, seed: int
+) -> np.ndarray:
+    """
+    Sample the LCIA scores of several activities against the same samples
+    of the matrices, so that their differences can be compared iteration
+    by iteration. For each sample, the technosphere matrix is factorized once
+    for all activities (see `get_unit_scores`).
+    :param activity_ids: ids of brightway2 activities
+    :param method: tuple representing a brightway2 method
+    :param iterations: number of samples
+    :param seed: seed of the random number generator
+    :return: a numpy array of scores, with one row per activity
+    """
+    lca = bw2calc.LCA(
+        {activity_id: 1 for activity_id in activity_ids},
+        method,
+        use_distributions=True,
+        seed_override=seed,
+    )
+    # only load (and sample) the matrices: scores are calculated below
+    lca.load_lci_data()
+    lca.load_lcia_data()
+    rows = [lca.dicts.product[activity_id] for activity_id in activity_ids]
+
+    scores = np.zeros((len(activity_ids), iterations))
+    for i in range(iterations):
+        if i > 0:
+            next(lca)
+        scores[:, i] = get_unit_scores(lca)[rows]
+
+    return scores
+
+
+def add_differences(scores: np.ndarray) -> np.ndarray:
+    """
+    Append to the scores of several activities the differences
+    between the score of each activity and the score of the first one.
+    :param scores: a numpy array of scores, with one row per activity
+    :return: a numpy array of scores and differences
+    """
+    return np.vstack([scores, scores[1:] - scores[0]])
+
+
+def iterate_chunks(
+    activities: list,
+    method: tuple,
+    iterations: int,
+    seed: int,
+    workers: int = None,
+    chunk_size: int = 100,
+    paired: bool = False,
+) -> Iterator[np.ndarray]:
+    """
+    Sample the LCIA scores of several activities, chunk by chunk.
+    Chunks are sampled in a pool of processes, a few chunks ahead of the one
+    being consumed, and yielded in order. Pending chunks are cancelled
+    if the iteration is stopped early. Progress is logged at the INFO level
+    after each chunk.
+    :param activities: a list of brightway2 activities
+    :param method: tuple representing a brightway2 method
+    :param iterations: number of iterations
+    :param seed: seed of the simulation
+    :param workers: number of worker processes (default: number of processors).
+    If 1, iterations are run in the current process.
+    :param chunk_size: number of iterations sampled by a worker at once
+    :param paired: whether all activities are calculated with the same samples
+    of the matrices (see `sample_paired_scores`)
+    :return: an iterator of numpy arrays of scores, with one row per activity
+    and one column per iteration of the chunk
+    """
+
+    def get_tasks(chunk_index: int) -> list:
+        size = min(chunk_size, iterations - chunk_index * chunk_size)
+        if paired:
+            ids = tuple(activity.id for activity in activities)
+            return [(ids, method, size, get_chunk_seed(seed, 0, chunk_index))]
+        return [
+            (activity.id, method, size, get_chunk_seed(seed, a, chunk_index))
+            for a, activity in enumerate(activities)
+        ]
+
+    sample = sample_paired_scores if paired else sample_scores
+
+    chunks = range(-(-iterations // chunk_size))
+    done = 0
+
+    if workers == 1:
+        try:
+            for c in chunks:
+                scores = np.vstack([sample(*task) for task in get_tasks(c)])
+                done += scores.shape[1]
+                count("iterations", scores.shape[1])
+                logger.info(f"Monte Carlo: {done}/{iterations} iterations")
+                yield scores
+        finally:
+            if done < iterations:
+                logger.info(
+                    f"Monte Carlo: stopped after {done}/{iterations} iterations"
+                )
+        return
+
+    # process modified databases once, rather than in each worker (see `batch`)
+    bw2data.databases.clean()
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=init_worker,
+        initargs=(bw2data.projects.current,),
+    ) as executor:
+        # keep all the workers busy, without sampling too far ahead
+        ahead = 2 * (workers or os.cpu_count() or 1)
+        pending = deque()
+
+        try:
+            for c in chunks:
+                pending.append(
+                    [executor.submit(sample, *task) for task in get_tasks(c)]
+                )
+                while pending and (sum(map(len, pending)) >= ahead or c == chunks[-1]):
+                    scores = np.vstack(
+                        [future.result() for future in pending.popleft()]
+                    )
+                    done += scores.shape[1]
+                    count("iterations", scores.shape[1])
+                    logger.info(f"Monte Carlo: {done}/{iterations} iterations")
+                    yield scores
+        finally:
+            for futures in pending:
+                for future in futures:
+                    future.cancel()
+            if done < iterations:
+                logger.info(
+                    f"Monte Carlo: stopped after {done}/{iterations} iterations"
+                )
+
+
+@stage("monte carlo")
+def monte_carlo(
+    activities: list,
+    method: tuple,
+    iterations: int = 100,
+    seed: int = None,
+    workers: int = None,
+    chunk_size: int = 100,
+    paired: bool = False,
+) -> np.ndarray:
+    """
+    Run a Monte Carlo simulation of the LCIA scores of several activities,
+    in a pool of processes.
+    :param activities: a list of brightway2 activities
+    :param method: tuple representing a brightway2 method
+    :param iterations: number of iterations
+    :param seed: seed of the simulation. If None, a random seed is used.
+    :param workers: number of worker processes (default: number of processors).
+    If 1, iterations are run in the current process.
+    :param chunk_size: number of iterations sampled by a worker at once
+    :param paired: whether all activities are calculated with the same samples
+    of the matrices, at each iteration (see `sample_paired_scores`)
+    :return: a numpy array of scores, with one row per activity and one column per iteration
+    """
+
+    assert isinstance(method, tuple), "`method` should be a tuple."
+
+    for act in activities:
+        assert isinstance(act, Activity), "`activity` should be a Brightway activity."
+
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+
+    return np.hstack(
+        list(
+            iterate_chunks(
+                activities, method, iterations, seed, workers, chunk_size, paired
+            )
+        )
+    )
+
+
+class ScoreDistribution:
+    """
+    Summary of the distribution of a score, updated as samples are drawn:
+    running moments, and a histogram with a fixed number of bins from which
+    quantiles are estimated. The range of the histogram is doubled (and pairs
+    of bins merged) whenever a sample falls out of it, so that memory
+    does not depend on the number of samples. Non-finite samples (e.g., from
+    a singular technosphere matrix) are only counted, in `invalid`.
+    """
+
+    def __init__(self, bins: int = 100):
+        """
+        :param bins: number of bins of the histogram (an even number)
+        """
+        assert bins >= 2 and bins % 2 == 0, "`bins` should be an even number."
+
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self.low = None
+        self.width = None
+        self.count = 0
+        self.invalid = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    @property
+    def bins(self) -> int:
+        return len(self.counts)
+
+    @property
+    def high(self) -> float:
+        return self.low + self.width * self.bins
+
+    @property
+    def variance(self) -> float:
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    @property
+    def std(self) -> float:
+        return float(np.sqrt(self.variance))
+
+    def update(self, values: np.ndarray):
+        """
+        Add samples to the distribution.
+        :param values: a numpy array of samples
+        """
+        values = np.asarray(values, dtype=float).ravel()
+        finite = np.isfinite(values)
+        if not finite.all():
+            # the range of the histogram would be doubled forever
+            self.invalid += int((~finite).sum())
+            values = values[finite]
+        if len(values) == 0:
+            return
+
+        # merge moments (Chan et al.)
+        count, mean = len(values), values.mean()
+        m2 = ((values - mean) ** 2).sum()
+        delta = mean - self.mean
+        total = self.count + count
+        self.mean += delta * count / total
+        self.m2 += m2 + delta**2 * self.count * count / total
+        self.count = total
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+
+        if self.low is None:
+            self.low = values.min()
+            self.width = (values.max() - values.min()) / self.bins
+            if self.width == 0:
+                self.width = max(abs(self.low), 1.0) * 1e-6
+
+        while values.min() < self.low or values.max() > self.high:
+            self._expand(values.min() < self.low)
+
+        indices = np.minimum(
+            ((values - self.low) / self.width).astype(int), self.bins - 1
+        )
+        self.counts += np.bincount(indices, minlength=self.bins)
+
+    def _expand(self, downwards: bool):
+        """
+        Double the range of the histogram, merging pairs of bins.
+        :param downwards: whether to extend the range below, rather than above, the current range
+        """
+        merged = self.counts.reshape(-1, 2).sum(1)
+        self.counts = np.zeros_like(self.counts)
+        if downwards:
+            self.counts[self.bins // 2 :] = merged
+            self.low -= self.width * self.bins
+        else:
+            self.counts[: self.bins // 2] = merged
+        self.width *= 2
+
+    def quantile(self, q) -> np.ndarray:
+        """
+        Estimate quantiles of the distribution, interpolating within bins.
+        :param q: a quantile level, or an array of levels, between 0 and 1
+        :return: the estimated quantiles
+        """
+        edges = self.low + self.width * np.arange(self.bins + 1)
+        cdf = np.concatenate([[0], np.cumsum(self.counts)]) / self.count
+        # skip empty bins, so that the cdf strictly increases
+        keep = np.concatenate([[True], self.counts > 0])
+        return np.clip(np.interp(q, cdf[keep], edges[keep]), self.min, self.max)
+
+
+@stage("monte carlo")
+def streaming_monte_carlo(
+    activities: list,
+    method: tuple,
+    iterations: int = 10000,
+    seed: int = None,
+    workers: int = None,
+    chunk_size: int = 100,
+    bins: int = 100,
+    tolerance: float = None,
+    quantiles: tuple = (0.05, 0.25, 0.5, 0.75, 0.95),
+    paired: bool = False,
+) -> list:
+    """
+    Run a Monte Carlo simulation of the LCIA scores of several activities,
+    summarizing the samples as they are drawn instead of keeping them.
+    If `tolerance` is given, the simulation stops once no quantile of any
+    activity has moved by more than `tolerance` standard deviations over a chunk.
+    As chunks are folded in order, results do not depend on the number of workers.
+    :param activities: a list of brightway2 activities
+    :param method: tuple representing a brightway2 method
+    :param iterations: maximum number of iterations
+    :param seed: seed of the simulation. If None, a random seed is used.
+    :param workers: number of worker processes (default: number of processors).
+    If 1, iterations are run in the current process.
+    :param chunk_size: number of iterations sampled by a worker at once
+    :param bins: number of bins of the histograms
+    :param tolerance: tolerance of the stopping rule, in standard deviations
+    :param quantiles: quantile levels checked by the stopping rule
+    :param paired: whether all activities are calculated with the same samples
+    of the matrices, at each iteration (see `sample_paired_scores`). If True,
+    the distributions of the differences between the score of each activity
+    and the score of the first one are also returned.
+    :return: a list of `ScoreDistribution`, one per activity
+    (followed, if `paired`, by one per difference)
+    """
+
+    assert isinstance(method, tuple), "`method` should be a tuple."
+
+    for act in activities:
+        assert isinstance(act, Activity), "`activity` should be a Brightway activity."
+
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+
+    distributions = [
+        ScoreDistribution(bins)
+        for _ in range(2 * len(activities) - 1 if paired else len(activities))
+    ]
+    previous = None
+
+    chunks = iterate_chunks(
+        activities, method, iterations, seed, workers, chunk_size, paired
+    )
+    for scores in chunks:
+        if paired:
+            scores = add_differences(scores)
+        for distribution, values in zip(distributions, scores):
+            distribution.update(values)
+
+        if tolerance is not None:
+            current = np.array([d.quantile(quantiles) for d in distributions])
+            scale = np.array([[d.std] for d in distributions])
+            if previous is not None and np.all(
+                np.abs(current - previous) <= tolerance * scale
+            ):
+                chunks.close()
+                logger.info(f"Converged after {distributions[0].count} iterations.")
+                break
+            previous = current
+
+    invalid = sum(d.invalid for d in distributions[: len(activities)])
+    if invalid:
+        logger.warning(
+            f"{invalid} non-finite scores were left out of the distributions."
+        )
+
+    return distributions
@@ -0,0 +1,188 @@
+"""
+Instrumentation of the stages of chart generation.
+
+Chart functions are split in stages (e.g., the LCA calculation, the traversal
+of the supply chain, the formatting of the dataframe and the generation of
+the HTML file). Within a `profile`, the wall time, the number of calls
+to costly operations (LCA calculations, database queries, etc.) and,
+optionally, the peak memory of each stage are recorded::
+
+    with profile(memory=True) as result:
+        sankey(activity, method)
+    print(result.to_dataframe())
+
+Each finished stage is also logged to the "polyviz" logger, at the DEBUG level.
+"""
+
+import logging
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Iterator
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# the active profile, if any
+_current = ContextVar("profile", default=None)
+
+
+class Stage:
+    """
+    A stage of chart generation, as recorded in a `Profile`.
+    `calls` include those of the stages run within this stage,
+    and `peak_memory` is the peak of the memory allocated
+    during the stage, above the memory allocated when it started
+    (None if memory is not traced).
+    """
+
+    __slots__ = ("name", "path", "time", "calls", "peak_memory")
+
+    def __init__(self, name: str, path: str):
+        self.name = name
+        self.path = path
+        self.time = 0.0
+        self.calls = Counter()
+        self.peak_memory = None
+
+    def __repr__(self) -> str:
+        return f"Stage({self.path!r}, time={self.time:.3f})"
+
+
+class Profile:
+    """
+    Stages recorded within a `profile` block, in the order they started.
+    """
+
+    def __init__(self, memory: bool = False, callback: Callable = None):
+        self.memory = memory
+        self.callback = callback
+        self.stages = []
+        self._stack = []
+        self._peaks = []
+
+    def _start(self, name: str) -> Stage:
+        path = "/".join([stage.name for stage in self._stack] + [name])
+        stage = Stage(name, path)
+        self.stages.append(stage)
+
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            # the peak of the enclosing stage is kept before being reset
+            if self._peaks:
+                self._peaks[-1][1] = max(self._peaks[-1][1], peak)
+            tracemalloc.reset_peak()
+            self._peaks.append([current, current])
+
+        self._stack.append(stage)
+        return stage
+
+    def _stop(self, stage: Stage, start: float):
+        stage.time = time.perf_counter() - start
+        self._stack.pop()
+
+        if self._stack:
+            self._stack[-1].calls.update(stage.calls)
+
+        if self.memory:
+            _, peak = tracemalloc.get_traced_memory()
+            baseline, running = self._peaks.pop()
+            peak = max(peak, running)
+            stage.peak_memory = peak - baseline
+            if self._peaks:
+                self._peaks[-1][1] = max(self._peaks[-1][1], peak)
+
+        if self.callback is not None:
+            self.callback(stage)
+
+    def count(self, name: str, n: int = 1):
+        if self._stack:
+            self._stack[-1].calls[name] += n
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """
+        Return the recorded stages as a dataframe.
+        :return: a pandas dataframe with one row per stage,
+        with its wall time, peak memory and one column per type of call
+        """
+        dataframe = pd.DataFrame(
+            [
+                {
+                    "stage": stage.path,
+                    "time": stage.time,
+                    "peak_memory": stage.peak_memory,
+                }
+                for stage in self.stages
+            ],
+            columns=["stage", "time", "peak_memory"],
+        )
+        calls = pd.DataFrame([stage.calls for stage in self.stages])
+        return pd.concat([dataframe, calls.fillna(0).astype(int)], axis=1)
+
+
+@contextmanager
+def profile(memory: bool = False, callback: Callable = None) -> Iterator[Profile]:
+    """
+    Record the stages of the chart functions called within the block.
+    :param memory: whether to trace the peak memory of each stage,
+    with `tracemalloc` (which slows down Python code significantly)
+    :param callback: function called with each `Stage`, when it finishes
+    :return: a `Profile`, filled as the stages finish
+    """
+    result = Profile(memory, callback)
+    token = _current.set(result)
+    started = memory and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+
+    try:
+        yield result
+    finally:
+        if started:
+            tracemalloc.stop()
+        _current.reset(token)
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Record a stage of chart generation in the active profile, if any,
+    and log its duration. Can also be used as a function decorator.
+    :param name: name of the stage
+    """
+    current = _current.get()
+    if current is None and not logger.isEnabledFor(logging.DEBUG):
+        yield
+        return
+
+    start = time.perf_counter()
+    if current is None:
+        try:
+            yield
+        finally:
+            logger.debug(f"{name}: {time.perf_counter() - start:.3f} s")
+        return
+
+    recorded = current._start(name)
+    try:
+        yield
+    finally:
+        current._stop(recorded, start)
+        calls = ", ".join(f"{n} {call}" for call, n in recorded.calls.items())
+        logger.debug(
+            f"{recorded.path}: {recorded.time:.3f} s" + (f" ({calls})" if calls else "")
+        )
+
+
+def count(name: str, n: int = 1):
+    """
+    Count calls to a costly operation in the current stage of the active profile.
+    :param name: name of the operation, e.g., "lci" or "queries"
+    :param n: number of calls
+    """
+    current = _current.get()
+    if current is not None:
+        current.count(name, n)
@@ -0,0 +1,180 @@
+"""
+This module contains the code to render the data of a chart to HTML, with D3Blocks.
+
+Chart functions called with `render=False` return the data of the chart
+without rendering it (and without importing ``d3blocks``). The data can be
+sent to another frontend (see `ChartData.to_dict`), or pickled and rendered
+later, possibly in another process, with `render`.
+"""
+
+import logging
+from collections import namedtuple
+
+import pandas as pd
+
+from .compact import compact_html
+from .profiling import count, stage
+from .utils import check_filepath
+
+logger = logging.getLogger(__name__)
+
+# charts whose dataframe is a list of links, from `source` to `target`,
+# the first of which is the activity itself
+NETWORK_CHARTS = ("sankey", "chord", "force")
+
+
+class ChartData(
+    namedtuple(
+        "ChartData",
+        ["chart", "dataframe", "title", "unit", "method", "flow_type", "figsize"],
+    )
+):
+    """
+    Data of a chart: the type of chart, the dataframe to plot, the title
+    of the chart, the unit of the values, the method (or flow type)
+    they are calculated for, and the size of the figure.
+    """
+
+    __slots__ = ()
+
+    def to_dict(self) -> dict:
+        """
+        Return the data of the chart as a JSON-serializable dictionary.
+        Networks (Sankey, Chord and Force-directed diagrams) are described
+        by a list of nodes and a list of links between the indices of nodes.
+        Other charts are described by the records of their dataframe.
+        :return: a dictionary
+        """
+        data = {
+            "chart": self.chart,
+            "title": self.title,
+            "unit": self.unit,
+            "method": list(self.method) if self.method else None,
+            "flow_type": self.flow_type,
+        }
+
+        if self.chart not in NETWORK_CHARTS:
+            records = self.dataframe.drop(columns="unit", errors="ignore")
+            data["records"] = records.to_dict(orient="records")
+            return data
+
+        links = self.dataframe[1:]
+        nodes = pd.Index(pd.unique(links[["source", "target"]].to_numpy().ravel("K")))
+        data["nodes"] = nodes.tolist()
+        data["links"] = [
+            {"source": int(source), "target": int(target), "value": float(value)}
+            for source, target, value in zip(
+                nodes.get_indexer(links["source"]),
+                nodes.get_indexer(links["target"]),
+                links["weight"],
+            )
+        ]
+        return data
+
+
+def render_sankey(d3_graph, data: ChartData, filepath: str, notebook: bool):
+    d3_graph.sankey(
+        df=data.dataframe[1:],
+        link={"color": "source-target"},
+        title=data.title,
+        filepath=filepath,
+        notebook=notebook,
+        figsize=data.figsize,
+    )
+
+
+def render_chord(d3_graph, data: ChartData, filepath: str, notebook: bool):
+    d3_graph.chord(
+        df=data.dataframe[1:],
+        title=data.title,
+        filepath=filepath,
+        notebook=notebook,
+        figsize=data.figsize,
+    )
+
+
+def render_force(d3_graph, data: ChartData, filepath: str, notebook: bool):
+    d3_graph.d3graph(
+        df=data.dataframe[1:],
+        title=data.title,
+        filepath=filepath,
+        notebook=notebook,
+        figsize=data.figsize,
+    )
+
+
+def render_treemap(d3_graph, data: ChartData, filepath: str, notebook: bool):
+    d3_graph.treemap(
+        df=data.dataframe,
+        title=data.title,
+        filepath=filepath,
+        notebook=notebook,
+        figsize=data.figsize,
+    )
+
+
+def render_choro(d3_graph, data: ChartData, filepath: str, notebook: bool):
+    d3_graph.choro(
+        df=data.dataframe,
+        title=data.title,
+        filepath=filepath,
+        notebook=notebook,
+        figsize=data.figsize,
+    )
+
+
+def render_violin(d3_graph, data: ChartData, filepath: str, notebook: bool):
+    d3_graph.violin(
+        x=data.dataframe["name"].values,
+        y=data.dataframe["val"].values,
+        unit=data.unit,
+        bins=50,  # Bins used for the histogram
+        figsize=data.figsize,
+        filepath=filepath,  # Path to save the HTML file
+        notebook=notebook,  # If True, the HTML file is displayed in the notebook.
+    )
+
+
+RENDERERS = {
+    "sankey": render_sankey,
+    "chord": render_chord,
+    "force": render_force,
+    "treemap": render_treemap,
+    "choro": render_choro,
+    "violin": render_violin,
+}
+
+
+def render(
+    data: ChartData, filepath: str = None, notebook: bool = False, compact: bool = False
+) -> str:
+    """
+    Render the data of a chart to an HTML file.
+    :param data: data of a chart, as returned by a chart function called with `render=False`
+    :param filepath: Path to save the HTML file
+    (default: named after the title, the method and the type of chart)
+    :param notebook: Whether to display the chart in a Jupyter notebook
+    :param compact: Whether to write the data of the chart in a side file,
+    and the scripts, styles and images in assets shared by the charts
+    of the directory (see `polyviz.compact`)
+    :return: Path to the generated HTML file
+    """
+    assert isinstance(data, ChartData), "`data` should be a `ChartData`."
+
+    filepath = check_filepath(
+        filepath, data.title, data.chart, data.method, data.flow_type
+    )
+
+    with stage("html"):
+        from d3blocks import D3Blocks
+
+        # Create a new D3Blocks object
+        RENDERERS[data.chart](D3Blocks(), data, filepath, notebook)
+
+    if compact:
+        with stage("compact"):
+            saved = compact_html(filepath)
+            count("bytes saved", saved)
+        logger.info(f"Compact HTML: {saved:,} bytes saved.")
+
+    return str(filepath)
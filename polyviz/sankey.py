@@ -2,103 +2,126 @@
 This module contains the code to generate a Sankey diagram for a given activity and method.
 """
 
+import logging
 from typing import Optional, Tuple, Union
 
 import bw2data
-from d3blocks import D3Blocks
 from pandas import DataFrame
 
-from .dataframe import format_supply_chain_dataframe
-from .utils import calculate_supply_chain, check_filepath
+from .dataframe import format_supply_chain_table
+from .profiling import stage
+from .render import ChartData
+from .render import render as render_chart
+from .utils import SupplyChain, calculate_supply_chain
 
 try:
     from bw2data.backends.peewee import Activity
 except ImportError:
     from bw2data.backends import Activity
 
+logger = logging.getLogger(__name__)
 
+
+@stage("sankey")
 def sankey(
     activity: Activity,
     method: tuple = None,
     flow_type: str = None,
     amount: int = 1,
-    level: int = 3,
-    cutoff: float = 0.01,
+    level: int = None,
+    cutoff: float = None,
     filepath: str = None,
     title: str = None,
     notebook: bool = False,
     labels_swap: dict = None,
     figsize: tuple = None,
-) -> Optional[tuple[str, DataFrame]]:
+    supply_chain: SupplyChain = None,
+    render: bool = True,
+    compact: bool = False,
+) -> Optional[Union[tuple[str, DataFrame], ChartData]]:
     """
     Generate a Sankey diagram for a given activity and method.
     :param activity: Brightway2 activity
     :param method: tuple representing a Brightway2 method
     :param flow_type: string representing a flow type e.g., "kilogram", "kilowatt hour", "cubic meter", "liter"
     :param level: number of levels to display in the Sankey diagram
+    (default: 3, or the levels of `supply_chain`)
     :param cutoff: cutoff value for the Sankey diagram
+    (default: 0.01, or the cutoff of `supply_chain`)
     :param filepath: Path to save the HTML file
     :param title: Title of the Sankey diagram
     :param notebook: Whether to display the Sankey diagram in a Jupyter notebook
     :param labels_swap: Dictionary to swap labels in the diagram
     :param figsize: Size of the figure
-    :return: Path to the generated HTML file
+    :param supply_chain: a multi-method supply chain, as returned by `calculate_supply_chain`
+    for a list of methods, to render for `method` instead of traversing the supply chain again.
+    It is cut at `level` and `cutoff`, if given, which cannot be finer than those of its traversal
+    (see `SupplyChain.to_array`)
+    :param render: If False, the chart is not rendered, and its data is returned
+    instead (see `polyviz.render`)
+    :param compact: Whether to write the data of the chart in a side file, and
+    its scripts and styles in assets shared by the charts of the directory
+    :return: Path to the generated HTML file and the plotted dataframe,
+    or the data of the chart if `render` is False
     """
 
-    if level < 2:
+    if level is not None and level < 2:
         raise ValueError("The level of recursion should be at least 2.")
 
     title = title or f"{activity['name']} ({activity['unit']}, {activity['location']})"
-    filepath = check_filepath(filepath, title, "sankey", method, flow_type)
-
-    result, amount = calculate_supply_chain(
-        activity=activity,
-        method=method,
-        level=level,
-        cutoff=cutoff,
-        amount=amount,
+    if supply_chain is None:
+        # defaults of the traversal: a given supply chain is only cut if they are given
+        level = 3 if level is None else level
+        cutoff = 0.01 if cutoff is None else cutoff
+        supply_chain, _ = calculate_supply_chain(
+            activity=activity,
+            method=[method or list(bw2data.methods)[0]],
+            level=level,
+            cutoff=cutoff,
+            amount=amount,
+        )
+    table = supply_chain.to_array(
+        method or supply_chain.methods[0], level=level, cutoff=cutoff
     )
+    amount = supply_chain.amount
 
     if method:
         assert isinstance(method, tuple), "`method` should be a tuple."
-        dataframe = format_supply_chain_dataframe(result, amount)
+        dataframe = format_supply_chain_table(table, supply_chain.metadata, amount)
         # fetch unit of method
         unit = bw2data.Method(method).metadata["unit"]
     else:
         assert isinstance(flow_type, str), "`flow_type` should be a string."
         assert flow_type in ["kilogram", "kilowatt hour", "cubic meter", "liter"]
-        dataframe = format_supply_chain_dataframe(result, amount, flow_type)
+        dataframe = format_supply_chain_table(
+            table, supply_chain.metadata, amount, flow_type
+        )
         # fetch unit of method
         unit = flow_type
 
     dataframe["unit"] = unit
 
     if figsize is None:
-        if level != 3:
-            figsize = (800 / 3 * level, 600)
+        depth = level if level is not None else int(table["level"].max(initial=0))
+        if depth != 3:
+            figsize = (800 / 3 * depth, 600)
         else:
             figsize = (800, 600)
 
     # dataframe should at least be 3 rows
     if len(dataframe) < 3:
-        print("Not enough data to generate a Sankey diagram.")
+        logger.warning("Not enough data to generate a Sankey diagram.")
         return
 
     if labels_swap:
         dataframe = dataframe.replace(labels_swap, regex=True)
 
-    # Create a new D3Blocks object
-    d3_graph = D3Blocks()
+    data = ChartData("sankey", dataframe, title, unit, method, flow_type, figsize)
+    if not render:
+        return data
 
-    d3_graph.sankey(
-        df=dataframe[1:],
-        link={"color": "source-target"},
-        title=title,
-        filepath=filepath,
-        notebook=notebook,
-        figsize=figsize,
-    )
+    filepath = render_chart(data, filepath, notebook, compact)
 
-    print("Sankey diagram generated.")
+    logger.info("Sankey diagram generated.")
 
-    return str(filepath), dataframe
+    return filepath, dataframe
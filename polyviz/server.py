@@ -0,0 +1,320 @@
+"""
+This module contains a local HTTP service generating charts on demand,
+for interactive exploration::
+
+    python -m polyviz.server --project "my project" --port 8000
+
+Charts are requested by type, activity, method and parameters, as HTML
+(e.g., ``/sankey``) or as the JSON data of the chart (e.g., ``/sankey.json``,
+see `ChartData.to_dict`)::
+
+    http://localhost:8000/sankey?database=db&code=abc&method=IPCC&method=simple&level=4
+
+Rendered charts, their data and the supply chains (or impacts) they are
+calculated from are held in memory, in a LRU cache capped in bytes
+and keyed on all the parameters of the chart, so that a chart viewed again
+(e.g., when the page is refreshed) is served without being calculated
+or rendered again, and that the Sankey, Chord and Force-directed diagrams
+of an activity share the traversal of its supply chain.
+"""
+
+import argparse
+import inspect
+import json
+import logging
+import tempfile
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+import bw2data
+
+from .cache import (
+    MemoryCache,
+    get_database_fingerprint,
+    get_method_fingerprint,
+    get_size,
+)
+from .dashboard import CHARTS as _CHARTS
+from .render import NETWORK_CHARTS, ChartData, render
+from .utils import calculate_supply_chain, get_impacts_per_activity
+from .violin import violin
+
+try:
+    from bw2data.backends.peewee import Activity
+except ImportError:
+    from bw2data.backends import Activity
+
+logger = logging.getLogger(__name__)
+
+CHARTS = {**_CHARTS, "violin": violin}
+
+# parameters of chart functions that can be given in the query string
+PARAMETERS = {
+    "level": int,
+    "cutoff": float,
+    "max_nodes": int,
+    "flow_type": str,
+    "title": str,
+    "iterations": int,
+    "seed": int,
+    "points": int,
+}
+
+
+class ChartService:
+    """
+    Charts generated on demand, and the memory cache of the rendered charts,
+    of their data and of the supply chains and impacts they are calculated from.
+    """
+
+    def __init__(self, max_memory: int = 256 * 1024**2):
+        """
+        :param max_memory: maximum memory, in bytes, used by the cached values
+        """
+        self.cache = MemoryCache(max_memory)
+
+    @staticmethod
+    def parse(chart: str, query: dict) -> tuple:
+        """
+        Get the activity, the method and the parameters of a chart
+        from the query string of a request.
+        :param chart: type of chart
+        :param query: query string, as parsed by `urllib.parse.parse_qs`
+        :return: a brightway2 activity, a tuple representing a brightway2 method
+        and a dictionary of parameters
+        """
+        if chart not in CHARTS:
+            raise KeyError(
+                f"Unknown chart {chart!r}, should be among {', '.join(CHARTS)}."
+            )
+
+        for name in ("database", "code", "method"):
+            if name not in query:
+                raise ValueError(f"The `{name}` parameter is missing.")
+
+        activity = bw2data.get_activity((query["database"][0], query["code"][0]))
+        method = tuple(query["method"])
+        if method not in bw2data.methods:
+            raise KeyError(f"Unknown method {method!r}.")
+
+        accepted = inspect.signature(CHARTS[chart]).parameters
+        params = {}
+        for name, values in query.items():
+            if name in ("database", "code", "method"):
+                continue
+            if name not in PARAMETERS or name not in accepted:
+                raise ValueError(f"Unknown parameter {name!r} for {chart}.")
+            params[name] = PARAMETERS[name](values[0])
+
+        return activity, method, params
+
+    def get_data(
+        self, chart: str, activity: Activity, method: tuple, params: dict
+    ) -> ChartData:
+        """
+        Get the data of a chart, from the cache if possible.
+        Network charts are calculated from a cached supply chain,
+        and tree maps and choropleth maps from cached impacts.
+        :param chart: type of chart
+        :param activity: a brightway2 activity
+        :param method: a tuple representing a brightway2 method
+        :param params: parameters of the chart function
+        :return: the data of the chart, or None if there is not enough data
+        """
+        key = get_key(activity, method)
+        kwargs = dict(params)
+
+        if chart in NETWORK_CHARTS:
+            level, cutoff = params.get("level", 3), params.get("cutoff", 0.01)
+            kwargs["supply_chain"] = self.cache.get(
+                ("supply chain", key, level, cutoff),
+                lambda: calculate_supply_chain(activity, [method], level, cutoff)[
+                    0
+                ].collect(),
+                lambda supply_chain: get_size(supply_chain.arrays),
+            )
+        elif chart in ("treemap", "choro"):
+            kwargs["impacts"] = self.cache.get(
+                ("impacts", key), lambda: get_impacts_per_activity(activity, method)
+            )
+
+        def calculate():
+            if chart == "violin":
+                return violin(
+                    activities=[activity], method=method, render=False, **params
+                )
+            return CHARTS[chart](
+                activity=activity, method=method, render=False, **kwargs
+            )
+
+        return self.cache.get(
+            ("data", chart, key, tuple(sorted(params.items()))), calculate
+        )
+
+    def get(self, chart: str, query: dict, fmt: str = "html") -> bytes:
+        """
+        Get a chart, rendered as HTML or as JSON data, from the cache if possible.
+        :param chart: type of chart
+        :param query: query string, as parsed by `urllib.parse.parse_qs`
+        :param fmt: "html" or "json"
+        :return: the content of the response, or None if there is not enough data
+        """
+        if fmt not in ("html", "json"):
+            raise ValueError(f"Unknown format {fmt!r}, should be 'html' or 'json'.")
+
+        activity, method, params = self.parse(chart, query)
+
+        def to_html():
+            data = self.get_data(chart, activity, method, params)
+            if data is None:
+                return None
+            # D3Blocks writes the chart to a file, which is only read once
+            with tempfile.TemporaryDirectory() as directory:
+                filepath = render(data, filepath=Path(directory) / f"{chart}.html")
+                return Path(filepath).read_bytes()
+
+        def to_json():
+            data = self.get_data(chart, activity, method, params)
+            if data is None:
+                return None
+            return json.dumps(data.to_dict()).encode("utf-8")
+
+        return self.cache.get(
+            (fmt, chart, get_key(activity, method), tuple(sorted(params.items()))),
+            to_html if fmt == "html" else to_json,
+        )
+
+
+def get_key(activity: Activity, method: tuple) -> tuple:
+    """
+    Get the part of cache keys identifying an activity and a method, with
+    the fingerprints of the database and of the method, so that charts
+    are calculated again when one of them is modified.
+    :param activity: a brightway2 activity
+    :param method: a tuple representing a brightway2 method
+    :return: a tuple
+    """
+    return (
+        activity.key,
+        method,
+        # processing a database does not change the results
+        tuple(
+            (database, modified)
+            for database, modified, _ in get_database_fingerprint(activity["database"])
+        ),
+        get_method_fingerprint(method),
+    )
+
+
+class ChartRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handler of requests for charts: ``/<chart>`` for HTML, ``/<chart>.json``
+    for the data of the chart, and ``/stats`` for the statistics of the cache.
+    """
+
+    service: ChartService = None
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        chart, _, fmt = url.path.strip("/").partition(".")
+
+        if chart == "stats":
+            return self.respond(
+                HTTPStatus.OK,
+                json.dumps(self.service.cache.stats()).encode("utf-8"),
+                "application/json",
+            )
+
+        try:
+            content = self.service.get(chart, parse_qs(url.query), fmt or "html")
+        except (KeyError, bw2data.errors.UnknownObject) as err:
+            return self.error(HTTPStatus.NOT_FOUND, err)
+        except (ValueError, TypeError, AssertionError) as err:
+            return self.error(HTTPStatus.BAD_REQUEST, err)
+        except Exception as err:
+            logger.exception(f"Could not generate {self.path}")
+            return self.error(HTTPStatus.INTERNAL_SERVER_ERROR, err)
+
+        if content is None:
+            return self.error(HTTPStatus.NOT_FOUND, "Not enough data to plot.")
+
+        content_type = "application/json" if fmt == "json" else "text/html"
+        self.respond(HTTPStatus.OK, content, f"{content_type}; charset=utf-8")
+
+    def respond(self, status: HTTPStatus, content: bytes, content_type: str):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def error(self, status: HTTPStatus, err):
+        self.respond(status, str(err).encode("utf-8"), "text/plain; charset=utf-8")
+
+    def log_message(self, format: str, *args):
+        logger.info(f"{self.address_string()} - {format % args}")
+
+
+def make_server(
+    host: str = "127.0.0.1", port: int = 8000, max_memory: int = 256 * 1024**2
+) -> ThreadingHTTPServer:
+    """
+    Create the HTTP server, without starting it.
+    :param host: host to listen on (by default, only local connections are accepted)
+    :param port: port to listen on (0 for any free port)
+    :param max_memory: maximum memory, in bytes, used by the cached charts
+    and supply chains
+    :return: a `ThreadingHTTPServer`, whose `service` is the `ChartService`
+    """
+    service = ChartService(max_memory)
+    handler = type("ChartRequestHandler", (ChartRequestHandler,), {"service": service})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.service = service
+    return server
+
+
+def serve(
+    project: str = None,
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    max_memory: int = 256 * 1024**2,
+):
+    """
+    Serve charts over HTTP, until interrupted.
+    :param project: brightway2 project (default: the current project)
+    :param host: host to listen on (by default, only local connections are accepted)
+    :param port: port to listen on
+    :param max_memory: maximum memory, in bytes, used by the cached charts
+    and supply chains
+    """
+    if project is not None:
+        bw2data.projects.set_current(project)
+
+    with make_server(host, port, max_memory) as server:
+        logger.info(f"Serving charts on http://{host}:{server.server_port}/")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve polyviz charts over HTTP.")
+    parser.add_argument("--project", help="brightway2 project")
+    parser.add_argument("--host", default="127.0.0.1", help="host to listen on")
+    parser.add_argument("--port", type=int, default=8000, help="port to listen on")
+    parser.add_argument(
+        "--max-memory",
+        type=int,
+        default=256,
+        help="maximum memory used by the cache, in MiB",
+    )
+    args = parser.parse_args()
+
+    serve(args.project, args.host, args.port, args.max_memory * 1024**2)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,10 +5,14 @@ This module contains the function to generate a treemap.
 from typing import Union
 
 import bw2data
-from d3blocks import D3Blocks
 
-from .dataframe import get_geo_distribution_of_impacts
-from .utils import check_filepath
+from .dataframe import (
+    get_geo_distribution_of_impacts,
+    group_impacts_by_location_and_activity,
+)
+from .profiling import stage
+from .render import ChartData
+from .render import render as render_chart
 
 try:
     from bw2data.backends.peewee import Activity
@@ -16,6 +20,7 @@ except ImportError:
     from bw2data.backends import Activity
 
 
+@stage("treemap")
 def treemap(
     activity: Activity,
     method: tuple,
@@ -24,7 +29,9 @@ def treemap(
     title: str = None,
     notebook: bool = False,
     figsize: tuple = (1000, 500),
-) -> str:
+    impacts: tuple = None,
+    render: bool = True,
+) -> Union[str, ChartData]:
     """
     Generate a choropleth diagram for a given activity and method.
     :param activity: Brightway2 activity
@@ -34,11 +41,14 @@ def treemap(
     :param title: Title of the plot
     :param notebook: Whether to display the plot in a notebook
     :param figsize: Size of the plot
-    :return: Path to the generated HTML file
+    :param impacts: direct impacts of activities and LCIA score, as returned by
+    `get_impacts_per_activity`, to use instead of calculating them again
+    :param render: If False, the chart is not rendered, and its data is returned
+    instead (see `polyviz.render`)
+    :return: Path to the generated HTML file, or the data of the chart if `render` is False
     """
 
     title = title or f"{activity['name']} ({activity['unit']}, {activity['location']})"
-    filepath = check_filepath(filepath, title, "treemap", method)
 
     assert isinstance(method, tuple), "`method` should be a tuple."
     assert isinstance(activity, Activity), "`activity` should be a brightway2 activity."
@@ -48,17 +58,14 @@ def treemap(
 
     # create a pandas dataframe
     # and categorize impacts per country
-    dataframe = get_geo_distribution_of_impacts(activity, method, cutoff)
+    if impacts is None:
+        dataframe = get_geo_distribution_of_impacts(activity, method, cutoff)
+    else:
+        dataframe = group_impacts_by_location_and_activity(*impacts, cutoff)
     dataframe["unit"] = unit
 
-    # Create a new D3Blocks object
-    d3_graph = D3Blocks()
-    d3_graph.treemap(
-        df=dataframe,
-        title=title,
-        filepath=filepath,
-        notebook=notebook,
-        figsize=figsize,
-    )
+    data = ChartData("treemap", dataframe, title, unit, method, None, figsize)
+    if not render:
+        return data
 
-    return str(filepath)
+    return render_chart(data, filepath, notebook)
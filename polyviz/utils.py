@@ -2,59 +2,138 @@
 Utility functions for polyviz.
 """
 
-from collections import defaultdict
+import hashlib
+import heapq
+import logging
+import os
+import pickle
+import sys
+import threading
+import time
+from functools import lru_cache
 from io import StringIO
 from pathlib import Path
-from typing import Union
+from typing import Iterable, Iterator, List, Union
 
 import bw2calc
 import bw2data
 import numpy as np
 import pandas as pd
 import yaml
-from packaging.version import Version
+from scipy import sparse
+from scipy.sparse.linalg import spsolve
+
+from .cache import lca_cache, result_cache
+from .metadata import (
+    get_activity_column,
+    get_activity_metadata,
+    get_database_metadata,
+    get_technosphere_exchanges,
+)
+from .profiling import count, stage
 
 try:
     from bw2data.backends.peewee import Activity
 except ImportError:
     from bw2data.backends import Activity
 
+logger = logging.getLogger(__name__)
+
 
+@stage("supply chain")
 def calculate_supply_chain(
     activity: Activity,
-    method: tuple,
+    method: Union[tuple, List[tuple]],
     level: int = 3,
     cutoff: float = 0.01,
     amount: int = 1,
+    engine: str = "unit_score",
+    cutoff_method: tuple = None,
+    cache: str = "use",
+    max_nodes: int = None,
+    time_budget: float = None,
 ) -> [StringIO, int]:
     """
     Calculate the supply chain of an activity.
     :param activity: a brightway2 activity
-    :param method: a tuple representing a brightway2 method
+    :param method: a tuple representing a brightway2 method, or a list of those
     :param level: the maximum level of the supply chain
     :param cutoff: the cutoff value for the supply chain
-    :return: a StringIO object and the reference amount
+    :param engine: "unit_score" (default) or "redo_lcia", see `recursive_calculation`
+    :param cutoff_method: with several methods, the method on which the cutoff is applied.
+    If None, the cutoff is applied to each method.
+    :param cache: "use" (default), "refresh" or "bypass" the on-disk cache of results
+    :param max_nodes: if given (or if `time_budget` is), the supply chain is traversed
+    best-first, up to `max_nodes` nodes (see `best_first_traversal`), instead of
+    down to `level` and `cutoff`
+    :param time_budget: maximum time spent traversing the supply chain best-first, in seconds
+    :return: the rows of the supply chain (a `SupplyChain` if several methods are given)
+    and the reference amount
     """
 
     assert isinstance(activity, Activity), "`activity` should be a brightway2 activity."
 
     amount = amount * -1 if identify_waste_process(activity) else amount
+    method = method or list(bw2data.methods)[0]
 
-    print("Calculating supply chain score...")
+    logger.info("Calculating supply chain score...")
 
-    try:
-        results = recursive_calculation(
-            activity,
-            method or list(bw2data.methods)[0],
-            cutoff=cutoff,
-            max_level=level,
-            amount=amount,
-        )
-    except ZeroDivisionError as err:
-        raise ZeroDivisionError(
-            "Could not compute the recursive calculation because "
-            "one of the flows has a null impact value."
-        ) from err
+    @stage("traversal")
+    def calculate():
+        if max_nodes is not None or time_budget is not None:
+            supply_chain = best_first_traversal(
+                activity,
+                method,
+                amount=amount,
+                max_nodes=max_nodes or sys.maxsize,
+                time_budget=time_budget,
+                cutoff_method=cutoff_method,
+            )
+            if isinstance(method, tuple):
+                return supply_chain.for_method(method)
+            return supply_chain
+
+        try:
+            return recursive_calculation(
+                activity,
+                method,
+                cutoff=cutoff,
+                max_level=level,
+                amount=amount,
+                engine=engine,
+                cutoff_method=cutoff_method,
+            )
+        except ZeroDivisionError as err:
+            raise ZeroDivisionError(
+                "Could not compute the recursive calculation because "
+                "one of the flows has a null impact value."
+            ) from err
+
+    def calculate_without_metadata():
+        results = calculate()
+        if isinstance(results, SupplyChain):
+            # the metadata of the database is not written with each supply chain
+            results.metadata = None
+        return results
+
+    results = result_cache.get(
+        "supply_chain",
+        activity,
+        [method] if isinstance(method, tuple) else method,
+        calculate_without_metadata,
+        mode=cache,
+        single_method=isinstance(method, tuple),
+        level=level,
+        cutoff=cutoff,
+        amount=amount,
+        engine=engine,
+        cutoff_method=cutoff_method,
+        max_nodes=max_nodes,
+        time_budget=time_budget,
+    )
+    if isinstance(results, SupplyChain):
+        _, reference_method = get_traversal_methods(method, cutoff_method)
+        results.metadata = get_activity_metadata(activity, reference_method)
 
     return results, amount
 
@@ -71,16 +150,16 @@ def calculate_lcia_score(
     """
     assert isinstance(activity, Activity), "`activity` should be a brightway2 activity."
 
-    print("Calculating LCIA score...")
+    logger.info("Calculating LCIA score...")
 
     amount = -1 if identify_waste_process(activity) else 1
-    lca = bw2calc.LCA({activity: amount}, method)
-    lca.lci()
-    lca.lcia()
-    rev, _, _ = lca.reverse_dict()
-    c_matrix = lca.characterized_inventory.sum(0)
+    with lca_cache.lock:
+        lca = lca_cache.get(activity, method, amount)
+        rev, _, _ = lca.reverse_dict()
+        c_matrix = lca.characterized_inventory.sum(0)
+        score = lca.score
 
-    return lca.score, c_matrix, rev
+    return score, c_matrix, rev
 
 
 def make_name_safe(filename: str) -> str:
@@ -101,57 +180,163 @@ def identify_waste_process(activity: Activity) -> bool:
     :param activity: a brightway2 activity
     :return: boolean
     """
-    # check if reference flow amount is negative
-    for exc in activity.production():
-        if exc["amount"] < 0:
-            return True
-    return False
+    # check if reference flow amount is negative,
+    # from the bulk-loaded metadata of the database
+    activities, _ = get_database_metadata(activity["database"])
+    return bool(activities.at[activity.key, "waste"])
 
 
-def get_geo_distribution_of_impacts_for_choro_graph(
+def get_characterization_vectors(lca: bw2calc.LCA, methods: List[tuple]) -> np.ndarray:
+    """
+    Get the characterization factors of several methods,
+    for the biosphere flows of an LCA object.
+    The LCA object is switched back to its own method afterwards.
+    :param lca: a brightway2 LCA object, after `lci()` and `lcia()`
+    :param methods: a list of tuples representing brightway2 methods
+    :return: a numpy array (methods x biosphere flows)
+    """
+    original_method = lca.method
+    vectors = []
+
+    for method in methods:
+        if method != lca.method:
+            lca.switch_method(method)
+        vectors.append(lca.characterization_matrix.diagonal())
+
+    if lca.method != original_method:
+        lca.switch_method(original_method)
+
+    return np.vstack(vectors)
+
+
+def get_unit_scores(
+    lca: bw2calc.LCA, characterizations: np.ndarray = None
+) -> np.ndarray:
+    """
+    Calculate the LCIA score of one unit of every product of the technosphere.
+
+    The score of a demand vector f is c^T B A^-1 f, which is linear in f.
+    Solving the transposed system A^T x = B^T c once therefore gives
+    the score per unit of each product, and the score of any amount of any
+    product is then a lookup in x times the amount.
+
+    :param lca: a brightway2 LCA object, after `lci()` and `lcia()`
+    :param characterizations: characterization factors of several methods
+    (see `get_characterization_vectors`), solved for at once.
+    If None, the method of the LCA object is used.
+    :return: a numpy array of unit scores, indexed by technosphere row
+    (and by method, if `characterizations` is given)
+    """
+    if characterizations is None:
+        characterization = lca.characterization_matrix.diagonal()
+    else:
+        characterization = characterizations.T
+    rhs = np.asarray(lca.biosphere_matrix.T @ characterization, dtype=np.float64)
+
+    count("solves")
+
+    # reuse the factorization of the technosphere matrix, if any
+    factorization = getattr(getattr(lca, "solver", None), "__self__", None)
+    if hasattr(factorization, "solve"):
+        return factorization.solve(rhs, trans="T")
+
+    unit_scores = spsolve(lca.technosphere_matrix.T.tocsc(), rhs)
+    return unit_scores.reshape(rhs.shape)
+
+
+@stage("impacts")
+def get_impacts_per_activity(
     activity: Activity,
     method: tuple,
-    cutoff: float = 0.0001,
-) -> pd.DataFrame:
+    cache: str = "use",
+) -> tuple[pd.DataFrame, float]:
     """
-    Get the geographic distribution of impacts for a given activity and method.
+    Calculate the direct impacts of each activity in the supply chain of an activity.
+    The result can be grouped in different ways (see `group_impacts_by_location`
+    and `group_impacts_by_location_and_activity`) without calculating it again.
     :param activity: a brightway2 activity
     :param method: a tuple representing a brightway2 method
-    :param cutoff: a cutoff value for the impact
-    :return: a pandas dataframe with the geographic distribution of impacts
+    :param cache: "use" (default), "refresh" or "bypass" the on-disk cache of results
+    :return: a pandas dataframe with the location, name and direct impact (`weight`)
+    of each activity, indexed by matrix column, and the LCIA score
     """
 
-    amount = -1 if identify_waste_process(activity) else 1
-    lca = bw2calc.LCA({activity: amount}, method)
-    lca.lci()
-    lca.lcia()
+    def calculate():
+        amount = -1 if identify_waste_process(activity) else 1
+        metadata = get_activity_metadata(activity, method)
 
-    rev, _, _ = lca.reverse_dict()
+        with lca_cache.lock:
+            lca = lca_cache.get(activity, method, amount)
+            weights = np.asarray(lca.characterized_inventory.sum(0)).ravel()
+            score = lca.score
 
-    c_matrix = lca.characterized_inventory.sum(0)
+        impacts = pd.DataFrame(
+            {
+                "location": metadata["location"],
+                "name": metadata["name"],
+                "weight": weights,
+            }
+        )
 
-    results = defaultdict(float)
+        return impacts, score
 
-    for nz_idx in np.argwhere(c_matrix > cutoff * lca.score):
-        results[bw2data.get_activity(rev[nz_idx[1]])["location"]] += c_matrix[
-            0, nz_idx[1]
-        ]
+    return result_cache.get("impacts", activity, [method], calculate, mode=cache)
+
+
+@stage("dataframe")
+def group_impacts_by_location(
+    impacts: pd.DataFrame, score: float, cutoff: float = 0.0001
+) -> pd.DataFrame:
+    """
+    Sum the direct impacts of activities per location.
+    :param impacts: direct impacts of activities, from `get_impacts_per_activity`
+    :param score: the LCIA score
+    :param cutoff: a cutoff value for the impact
+    :return: a pandas dataframe with the geographic distribution of impacts
+    """
 
-    dataframe = pd.DataFrame.from_dict(results, orient="index", columns=["weight"])
+    impacts = impacts.loc[impacts["weight"] > cutoff * score]
+    dataframe = (
+        impacts[["location", "weight"]]
+        .groupby("location", sort=False, dropna=False)
+        .sum()
+    )
 
     # make index a column
     # and name it "country"
-    dataframe = dataframe.reset_index().rename(columns={"index": "country"})
+    dataframe = dataframe.reset_index().rename(columns={"location": "country"})
 
     return dataframe
 
 
+def get_geo_distribution_of_impacts_for_choro_graph(
+    activity: Activity,
+    method: tuple,
+    cutoff: float = 0.0001,
+    cache: str = "use",
+) -> pd.DataFrame:
+    """
+    Get the geographic distribution of impacts for a given activity and method.
+    :param activity: a brightway2 activity
+    :param method: a tuple representing a brightway2 method
+    :param cutoff: a cutoff value for the impact
+    :param cache: "use" (default), "refresh" or "bypass" the on-disk cache of results
+    :return: a pandas dataframe with the geographic distribution of impacts
+    """
+
+    impacts, score = get_impacts_per_activity(activity, method, cache)
+
+    return group_impacts_by_location(impacts, score, cutoff)
+
+
 def check_filepath(
     filepath: str,
     title: str,
     graph_type: str,
     method: tuple = None,
     flow_type: str = None,
+    directory: str = None,
+    code: str = None,
 ) -> Path:
     """
     Check if a filepath exists.
@@ -160,34 +345,670 @@ def check_filepath(
     :param graph_type: a graph type
     :param method: an LCIA method
     :param flow_type: a flow type
+    :param directory: directory of the file, if no filepath is given (default: current directory)
+    :param code: code of the activity, added to the name of the file, so that
+    activities with the same name, unit and location (e.g., co-products)
+    do not overwrite each other's files
     :return: filepath
     """
     if filepath is None:
         method = method or flow_type
+        name = make_name_safe(title)
+        if code is not None:
+            name += f" {make_name_safe(str(code))}"
         filepath = (
-            Path.cwd()
-            / f"{make_name_safe(title)} {make_name_safe(''.join(method))} {graph_type}.html"
+            Path(directory or Path.cwd())
+            / f"{name} {make_name_safe(''.join(method))} {graph_type}.html"
         )
     else:
         filepath = Path(filepath)
 
-    if not filepath.parent.exists():
-        filepath.parent.mkdir(parents=True)
+    filepath.parent.mkdir(parents=True, exist_ok=True)
 
     return filepath
 
 
+# fields of the rows of a supply chain, as returned by `SupplyChain.to_array`
+SUPPLY_CHAIN_DTYPE = np.dtype(
+    [
+        ("level", np.int32),
+        ("parent", np.int64),
+        ("column", np.int64),
+        ("amount", np.float64),
+        ("score", np.float64),
+        ("flag", np.int8),
+    ]
+)
+ACTIVITY, BELOW_CUTOFF, LOSS, OTHER = 0, 1, 2, 3
+
+
+def get_parents(levels: np.ndarray) -> np.ndarray:
+    """
+    Get the parent of each node of a tree, from the levels of its nodes
+    in depth-first order: the parent of a node is the last node before it
+    one level up.
+    :param levels: a numpy array of levels
+    :return: a numpy array of node indices, -1 for the root
+    """
+    parents = np.full(len(levels), -1, dtype=np.int64)
+    positions = np.arange(len(levels))
+
+    for level in range(1, int(levels.max(initial=0)) + 1):
+        previous = positions[levels == level - 1]
+        current = positions[levels == level]
+        parents[current] = previous[np.searchsorted(previous, current) - 1]
+
+    return parents
+
+
+class SupplyChain:
+    """
+    Result of the traversal of a supply chain for one or several methods.
+    Each node carries a vector of scores, one per method, so that the supply chain
+    can be rendered for each method without being traversed again.
+
+    Nodes are in depth-first order, as (level, matrix column, amount, scores,
+    below cutoff flags, is loss) tuples. A node is expanded if it is above
+    the cutoff for `cutoff_method`, or, if `cutoff_method` is None, for any method.
+    Nodes are an iterator, as returned by `traverse_supply_chain`, that calculates
+    them as they are consumed (and can only be consumed once), until `collect`
+    stores them in parallel arrays.
+
+    A supply chain traversed once down to a deep level and a low cutoff can be
+    rendered at any higher level and cutoff (see `to_array`), without being
+    traversed again. `max_level` and `cutoff` are those of the traversal
+    (None if the supply chain was traversed best-first).
+    """
+
+    max_level = None
+    cutoff = None
+
+    def __init__(
+        self,
+        methods: List[tuple],
+        totals: np.ndarray,
+        nodes: Iterable[tuple],
+        metadata: pd.DataFrame,
+        amount: float = 1,
+        cutoff_method: tuple = None,
+        max_level: int = None,
+        cutoff: float = None,
+    ):
+        self.methods = methods
+        self.totals = totals
+        self.nodes = nodes
+        self.metadata = metadata
+        self.amount = amount
+        self.cutoff_method = cutoff_method
+        self.max_level = max_level
+        self.cutoff = cutoff
+        self.arrays = None
+
+    def __len__(self) -> int:
+        if self.arrays is None:
+            return len(self.nodes)
+        return len(self.arrays["level"])
+
+    def collect(self) -> "SupplyChain":
+        """
+        Consume the nodes, and store them in parallel arrays of levels, parents,
+        columns, amounts, scores (one column per method), below cutoff flags
+        (one column per method) and loss flags.
+        :return: the supply chain itself
+        """
+        if self.arrays is not None:
+            return self
+
+        levels, columns, amounts, scores, below, is_loss = [], [], [], [], [], []
+        for level, column, amount, node_scores, node_below, node_is_loss in self.nodes:
+            levels.append(level)
+            columns.append(column)
+            amounts.append(amount)
+            scores.append(node_scores)
+            below.append(node_below)
+            is_loss.append(node_is_loss)
+
+        shape = (len(levels), len(self.methods))
+        self.arrays = {
+            "level": np.array(levels, dtype=np.int32),
+            "column": np.array(columns, dtype=np.int64),
+            "amount": np.array(amounts, dtype=np.float64),
+            "scores": np.array(scores, dtype=np.float64).reshape(shape),
+            "below": np.array(below, dtype=bool).reshape(shape),
+            "is_loss": np.array(is_loss, dtype=bool),
+        }
+        self.arrays["parent"] = get_parents(self.arrays["level"])
+        self.nodes = None
+
+        return self
+
+    def get_method_indices(self, method: tuple) -> tuple[int, int]:
+        """
+        Get the index of a method, and the index of the method
+        whose cutoff applies when rendering the supply chain for it.
+        :param method: a tuple representing a brightway2 method
+        :return: two indices
+        """
+        index = self.methods.index(tuple(method))
+
+        if float(self.totals[index]) == 0:
+            raise ZeroDivisionError(f"The total score for {method} is null.")
+
+        if self.cutoff_method is not None:
+            return index, self.methods.index(tuple(self.cutoff_method))
+
+        return index, index
+
+    def to_array(
+        self, method: tuple, level: int = None, cutoff: float = None
+    ) -> np.ndarray:
+        """
+        Get the supply chain for one method, as a structured array (see
+        `SUPPLY_CHAIN_DTYPE`) with one row per node, in depth-first order:
+        its level, the index of its parent row, its matrix column (-1 for
+        aggregated nodes), amount and score, and whether it is an activity,
+        activities below cutoff or a loss. Nodes below the cutoff for `method`
+        are not expanded.
+        With `level` and `cutoff`, nodes deeper than `level` are removed,
+        and nodes below `cutoff` are not expanded, as if the supply chain
+        had been traversed with them.
+        :param method: a tuple representing a brightway2 method
+        :param level: maximum level (default: that of the traversal),
+        which cannot be deeper than that of the traversal
+        :param cutoff: cutoff (default: that of the traversal),
+        which cannot be lower than that of the traversal
+        :return: a numpy structured array
+        """
+        if level is not None and self.max_level is not None and level > self.max_level:
+            raise ValueError(
+                f"The supply chain was traversed down to level {self.max_level}, "
+                f"not {level}."
+            )
+        if cutoff is not None and self.cutoff is not None and cutoff < self.cutoff:
+            raise ValueError(
+                f"The supply chain was traversed with a cutoff of {self.cutoff}, "
+                f"not {cutoff}."
+            )
+
+        index, flag = self.get_method_indices(method)
+        arrays = self.collect().arrays
+        levels, parents = arrays["level"], arrays["parent"]
+
+        below = arrays["below"][:, flag]
+        if cutoff is not None:
+            # same test as in `traverse_supply_chain`
+            threshold = np.abs(self.totals[flag] * cutoff)
+            below = below | (np.abs(arrays["scores"][:, flag]) <= threshold)
+        below = below & (levels > 0)
+
+        # hide the descendants of nodes below the cutoff, and the nodes below `level`
+        hidden = np.zeros(len(levels), dtype=bool)
+        if level is not None:
+            hidden[levels > level] = True
+        for depth in range(2, int(levels.max(initial=0)) + 1):
+            current = levels == depth
+            hidden[current] |= hidden[parents[current]] | below[parents[current]]
+        visible = ~hidden
+
+        rows = np.cumsum(visible) - 1
+        table = np.zeros(int(visible.sum()), dtype=SUPPLY_CHAIN_DTYPE)
+        table["level"] = levels[visible]
+        table["parent"] = np.where(
+            parents[visible] >= 0, rows[np.maximum(parents[visible], 0)], -1
+        )
+        table["column"] = arrays["column"][visible]
+        table["amount"] = arrays["amount"][visible]
+        table["score"] = arrays["scores"][visible, index]
+        table["flag"] = np.select(
+            [below[visible], arrays["is_loss"][visible]], [BELOW_CUTOFF, LOSS], ACTIVITY
+        )
+
+        return table
+
+    def iter_rows(self, method: tuple) -> Iterator[list]:
+        """
+        Iterate over the supply chain for one method, yielding one list
+        per row of the output table (see `recursive_calculation`).
+        :param method: a tuple representing a brightway2 method
+        :return: an iterator of lists
+        """
+        index, flag = self.get_method_indices(method)
+        total_score = float(self.totals[index])
+
+        names = self.metadata["name"].to_numpy()
+        locations = self.metadata["location"].to_numpy()
+        units = self.metadata["unit"].to_numpy()
+
+        if self.arrays is not None:
+            for level, _, column, amount, score, node_flag in self.to_array(method):
+                row = [int(level), float(score) / total_score, float(score)]
+                row.append(float(amount))
+
+                if node_flag == BELOW_CUTOFF:
+                    yield row + ["activities below cutoff", None, None]
+                elif node_flag == LOSS:
+                    yield row + ["loss", None, None]
+                else:
+                    yield row + [names[column], locations[column], units[column]]
+            return
+
+        # level of the node whose subtree is skipped, if any
+        skipped_level = None
+
+        for level, column, amount, scores, below, is_loss in self.nodes:
+            if skipped_level is not None:
+                if level > skipped_level:
+                    continue
+                skipped_level = None
+
+            score = float(scores[index])
+            row = [level, score / total_score, score, float(amount)]
+
+            if level > 0 and below[flag]:
+                yield row + ["activities below cutoff", None, None]
+                skipped_level = level
+            elif is_loss:
+                yield row + ["loss", None, None]
+            else:
+                yield row + [names[column], locations[column], units[column]]
+
+    def for_method(self, method: tuple) -> List[list]:
+        """
+        Get the supply chain for one method, as a list of lists, where each
+        list is a row in the output table (see `recursive_calculation`).
+        :param method: a tuple representing a brightway2 method
+        :return: a list of lists
+        """
+        return list(self.iter_rows(method))
+
+
+@stage("reduction")
+def keep_largest_nodes(table: np.ndarray, max_nodes: int) -> np.ndarray:
+    """
+    Reduce a supply chain, as a structured array (see `SupplyChain.to_array`),
+    to the k activities with the largest scores of each level, where k is
+    the largest number such that at most `max_nodes` activities are kept.
+    If the supply chain has more than `max_nodes - 1` levels, one activity
+    is kept on each of the first `max_nodes - 1` levels only.
+    The other activities of each parent, and their suppliers, are folded
+    into one node flagged as `OTHER`, whose score and amount are their sums,
+    so that the flows to each parent are conserved.
+    :param table: a numpy structured array
+    :param max_nodes: maximum number of activities to keep, including the root
+    (nodes of other activities, activities below cutoff and losses not included)
+    :return: a numpy structured array
+    """
+    assert max_nodes >= 2, "`max_nodes` should be at least 2."
+
+    levels, parents = table["level"], table["parent"]
+    is_activity = (table["flag"] == ACTIVITY) & (levels > 0)
+
+    # k is chosen on the number of activities of each level,
+    # an upper bound of those left once the smaller ones are folded
+    counts = np.bincount(levels[is_activity], minlength=1)[1:]
+    if counts.sum() < max_nodes:
+        return table
+    ks = np.arange(1, counts.max() + 1)
+    fits = np.minimum(counts[:, None], ks).sum(axis=0) <= max_nodes - 1
+    if fits.any():
+        k, depth = int(ks[fits][-1]), len(counts)
+    else:
+        # deeper levels are folded, so that the chain fits
+        k, depth = 1, max_nodes - 1
+
+    keep = levels == 0
+    folded = np.zeros(len(table), dtype=bool)
+    positions = np.arange(len(table))
+
+    for level in range(1, int(levels.max(initial=0)) + 1):
+        current = positions[levels == level]
+        current = current[keep[parents[current]]]
+        candidates = current[is_activity[current]]
+        largest = candidates[
+            np.argsort(-np.abs(table["score"][candidates]), kind="stable")[
+                : k if level <= depth else 0
+            ]
+        ]
+        keep[current[~is_activity[current]]] = True
+        keep[largest] = True
+        folded[np.setdiff1d(candidates, largest)] = True
+
+    # one node per parent, in place of its first folded supplier
+    other_parents, first, inverse = np.unique(
+        parents[folded], return_index=True, return_inverse=True
+    )
+    others = np.zeros(len(other_parents), dtype=table.dtype)
+    others["level"] = levels[folded][first]
+    others["parent"] = other_parents
+    others["column"] = table["column"][other_parents]
+    others["amount"] = np.bincount(inverse, weights=table["amount"][folded])
+    others["score"] = np.bincount(inverse, weights=table["score"][folded])
+    others["flag"] = OTHER
+
+    # rows are kept in depth-first order
+    sources = np.r_[positions[keep], positions[folded][first]]
+    order = np.argsort(sources, kind="stable")
+    reduced = np.concatenate([table[keep], others])[order]
+
+    # parents are indices of rows of the reduced table
+    rows = np.full(len(table), -1, dtype=np.int64)
+    rows[sources[order]] = np.arange(len(reduced))
+    reduced["parent"] = np.where(
+        reduced["parent"] >= 0, rows[np.maximum(reduced["parent"], 0)], -1
+    )
+
+    return reduced
+
+
+def get_traversal_methods(
+    lcia_method: Union[tuple, List[tuple]], cutoff_method: tuple = None
+) -> tuple[List[tuple], tuple]:
+    """
+    Get the methods of a traversal, and the method whose LCA object
+    (and cutoff, if `cutoff_method` is given) the traversal is based on.
+    :param lcia_method: a tuple representing a brightway2 method, or a list of those
+    :param cutoff_method: with several methods, the method on which the cutoff is applied
+    :return: a list of methods, and the reference method
+    """
+    methods = (
+        [lcia_method]
+        if isinstance(lcia_method, tuple)
+        else [tuple(m) for m in lcia_method]
+    )
+    reference_method = tuple(cutoff_method) if cutoff_method else methods[0]
+    if reference_method not in methods:
+        raise ValueError("`cutoff_method` should be one of the methods.")
+
+    return methods, reference_method
+
+
+def get_column_unit_scores(
+    activity: Activity, methods: List[tuple], reference_method: tuple
+) -> np.ndarray:
+    """
+    Get the score of one unit of the product of every activity,
+    for several methods, indexed by matrix column (see `get_unit_scores`).
+    :param activity: a brightway2 activity
+    :param methods: tuples representing brightway2 methods
+    :param reference_method: the method whose LCA object is used
+    :return: a numpy array, with one row per column and one column per method
+    """
+    metadata = get_activity_metadata(activity, reference_method)
+    characterizations = lca_cache.get_derived(
+        activity,
+        reference_method,
+        ("characterizations", tuple(methods)),
+        lambda lca: get_characterization_vectors(lca, methods),
+    )
+    unit_scores = lca_cache.get_derived(
+        activity,
+        reference_method,
+        ("unit_scores", tuple(methods)),
+        lambda lca: get_unit_scores(lca, characterizations),
+    )
+
+    return unit_scores[metadata["row"].to_numpy()]
+
+
+def traverse_supply_chain(
+    activity: Activity,
+    lcia_method: Union[tuple, List[tuple]],
+    amount: float = 1,
+    max_level: int = 3,
+    cutoff: float = 1e-2,
+    engine: str = "unit_score",
+    cutoff_method: tuple = None,
+) -> SupplyChain:
+    """
+    Traverse a supply chain graph, and calculate the LCA scores of each component.
+    The nodes of the returned `SupplyChain` are calculated lazily, as they are
+    consumed: the caller can stop early, and the memory used by the traversal
+    is bounded by the depth of the graph (one frame per level) rather than
+    by the number of nodes. See `recursive_calculation` for the arguments.
+    :return: a `SupplyChain`, whose nodes are an iterator
+    """
+
+    if engine not in ("unit_score", "redo_lcia"):
+        raise ValueError(
+            f"`engine` should be 'unit_score' or 'redo_lcia', not {engine!r}."
+        )
+
+    methods, reference_method = get_traversal_methods(lcia_method, cutoff_method)
+    flag = methods.index(reference_method) if cutoff_method else None
+
+    metadata = get_activity_metadata(activity, reference_method)
+    indptr, inputs, amounts = get_technosphere_exchanges(activity, reference_method)
+
+    characterizations = lca_cache.get_derived(
+        activity,
+        reference_method,
+        ("characterizations", tuple(methods)),
+        lambda lca: get_characterization_vectors(lca, methods),
+    )
+
+    def score_inventory(lca):
+        return characterizations @ np.asarray(lca.inventory.sum(axis=1)).ravel()
+
+    with lca_cache.lock:
+        lca_obj = lca_cache.get(activity, reference_method, amount)
+        totals = score_inventory(lca_obj)
+    thresholds = np.abs(totals * cutoff)
+
+    if engine == "unit_score":
+        unit_scores = get_column_unit_scores(activity, methods, reference_method)
+
+    identities = list(zip(metadata["name"], metadata["product"], metadata["location"]))
+    keys = metadata["key"].to_numpy()
+
+    def iterate_nodes():
+        column = get_activity_column(metadata, activity)
+        below = np.abs(totals) <= thresholds
+        yield 0, column, amount, totals, below, False
+
+        if max_level < 1 or not totals.any():
+            return
+
+        # one frame per level: the column and amount of the node being expanded,
+        # and the position of its next and last exchanges
+        stack = [[column, amount, indptr[column], indptr[column + 1]]]
+
+        while stack:
+            frame = stack[-1]
+            previous_column, previous_amount, position, end = frame
+            if position == end:
+                stack.pop()
+                continue
+            frame[2] += 1
+
+            level = len(stack)
+            column = inputs[position]
+            node_amount = previous_amount * amounts[position]
+
+            if engine == "unit_score":
+                scores = unit_scores[column] * node_amount
+            else:
+                with lca_cache.lock:
+                    lca_obj.redo_lci({keys[column]: node_amount})
+                    scores = score_inventory(lca_obj)
+                count("redo_lci")
+
+            below = np.abs(scores) <= thresholds
+            is_loss = identities[column] == identities[previous_column]
+            yield level, column, node_amount, scores, below, is_loss
+
+            if (
+                level < max_level
+                and not is_loss
+                and not (below.all() if flag is None else below[flag])
+            ):
+                stack.append([column, node_amount, indptr[column], indptr[column + 1]])
+
+    return SupplyChain(
+        methods,
+        totals,
+        iterate_nodes(),
+        metadata,
+        amount,
+        cutoff_method=cutoff_method,
+        max_level=max_level,
+        cutoff=cutoff,
+    )
+
+
+def iterate_supply_chain(
+    activity: Activity,
+    lcia_method: tuple,
+    amount: float = 1,
+    max_level: int = 3,
+    cutoff: float = 1e-2,
+    engine: str = "unit_score",
+) -> Iterator[list]:
+    """
+    Traverse a supply chain graph for one method, yielding the rows of the
+    output table (see `recursive_calculation`) as they are calculated.
+    Stopping the iteration stops the traversal.
+    :param activity: the starting point of the supply chain graph
+    :param lcia_method: a tuple representing a brightway2 method
+    :param amount: amount of `activity` to assess
+    :param max_level: maximum depth to traverse
+    :param cutoff: fraction of total score to use as cutoff when deciding whether to traverse deeper
+    :param engine: "unit_score" (default) or "redo_lcia", see `recursive_calculation`
+    :return: an iterator of lists
+    """
+    supply_chain = traverse_supply_chain(
+        activity, lcia_method, amount, max_level, cutoff, engine
+    )
+    return supply_chain.iter_rows(lcia_method)
+
+
+def best_first_traversal(
+    activity: Activity,
+    lcia_method: Union[tuple, List[tuple]],
+    amount: float = 1,
+    max_nodes: int = 100,
+    time_budget: float = None,
+    max_level: int = None,
+    cutoff_method: tuple = None,
+) -> SupplyChain:
+    """
+    Traverse a supply chain graph, always expanding next the node
+    with the largest absolute score, until `max_nodes` nodes are drawn
+    or `time_budget` is spent. For each drawn node, the inputs that are
+    not drawn are aggregated into one "activities below cutoff" node.
+    Unlike with a cutoff, the number of nodes, and therefore the runtime,
+    is known in advance.
+    :param activity: the starting point of the supply chain graph
+    :param lcia_method: a tuple representing a brightway2 method, or a list of those
+    :param amount: amount of `activity` to assess
+    :param max_nodes: maximum number of nodes drawn, besides the aggregated ones
+    :param time_budget: maximum time spent traversing the graph, in seconds
+    :param max_level: maximum depth to traverse, if any
+    :param cutoff_method: with several methods, the method whose scores set
+    the order of the traversal (default: the first method)
+    :return: a `SupplyChain`
+    """
+
+    assert max_nodes >= 1, "`max_nodes` should be at least 1."
+
+    methods, reference_method = get_traversal_methods(lcia_method, cutoff_method)
+    index = methods.index(reference_method)
+
+    metadata = get_activity_metadata(activity, reference_method)
+    indptr, inputs, amounts = get_technosphere_exchanges(activity, reference_method)
+    unit_scores = get_column_unit_scores(activity, methods, reference_method)
+    identities = list(zip(metadata["name"], metadata["product"], metadata["location"]))
+
+    start = time.perf_counter()
+    not_below = np.zeros(len(methods), dtype=bool)
+
+    column = get_activity_column(metadata, activity)
+    totals = unit_scores[column] * amount
+
+    # drawn nodes, as [level, column, amount, scores, is loss, drawn children],
+    # and, for each of them, the scores and amounts of the inputs not drawn,
+    # and the number of those with a non-zero score
+    nodes = [[0, column, amount, totals, False, []]]
+    remainders = []
+    # inputs of the drawn nodes, by decreasing absolute score
+    candidates = []
+
+    def add_inputs(node_index: int):
+        level, column, node_amount, _, is_loss, _ = nodes[node_index]
+        positions = np.arange(indptr[column], indptr[column + 1])
+        input_amounts = node_amount * amounts[positions]
+        input_scores = unit_scores[inputs[positions]] * input_amounts[:, None]
+        remainders.append(
+            [
+                input_scores.sum(0),
+                input_amounts.sum(),
+                np.count_nonzero(input_scores[:, index]),
+            ]
+        )
+
+        if is_loss or (max_level is not None and level >= max_level):
+            return
+
+        for position, input_amount, scores in zip(
+            positions, input_amounts, input_scores
+        ):
+            if scores[index] == 0:
+                continue
+            heapq.heappush(
+                candidates,
+                (-abs(scores[index]), int(position), node_index, input_amount, scores),
+            )
+
+    add_inputs(0)
+
+    while candidates and len(nodes) < max_nodes:
+        if time_budget is not None and time.perf_counter() - start > time_budget:
+            break
+
+        _, position, parent, input_amount, scores = heapq.heappop(candidates)
+        column = inputs[position]
+        is_loss = identities[column] == identities[nodes[parent][1]]
+
+        nodes[parent][5].append((position, len(nodes)))
+        remainders[parent][0] = remainders[parent][0] - scores
+        remainders[parent][1] -= input_amount
+        remainders[parent][2] -= 1
+
+        nodes.append([nodes[parent][0] + 1, column, input_amount, scores, is_loss, []])
+        add_inputs(len(nodes) - 1)
+
+    # emit the drawn nodes in depth-first order, inputs in the order of the database
+    ordered = []
+    stack = [0]
+    while stack:
+        node_index = stack.pop()
+        if node_index < 0:
+            # aggregated inputs of node -node_index - 1
+            level = nodes[-node_index - 1][0] + 1
+            scores, remainder_amount, _ = remainders[-node_index - 1]
+            ordered.append((level, -1, remainder_amount, scores, ~not_below, False))
+            continue
+
+        level, column, node_amount, scores, is_loss, children = nodes[node_index]
+        ordered.append((level, column, node_amount, scores, not_below, is_loss))
+
+        # nodes none of whose inputs are drawn are leaves, as with a cutoff
+        if children and remainders[node_index][2] > 0:
+            stack.append(-node_index - 1)
+        stack.extend(child for _, child in sorted(children, reverse=True))
+
+    return SupplyChain(
+        methods, totals, ordered, metadata, amount, cutoff_method=reference_method
+    ).collect()
+
+
 def recursive_calculation(
     activity,
     lcia_method,
     amount=1,
     max_level=3,
     cutoff=1e-2,
-    lca_obj=None,
-    total_score=None,
-    level=0,
-    previous_activity=None,
-    results=None,
+    engine="unit_score",
+    cutoff_method=None,
 ):
     """
     ADAPTED FROM BRIGHTWAY2-ANALYZER:
@@ -196,112 +1017,98 @@ def recursive_calculation(
     Traverse a supply chain graph, and calculate the LCA scores of each component.
     Return the results as a list of lists.
 
+    The graph is traversed by matrix column, using the bulk-loaded metadata
+    and technosphere exchanges of the database (see ``polyviz.metadata``),
+    so that no database query is made per node. The traversal uses an explicit
+    stack rather than recursion (see ``traverse_supply_chain``), so that deep
+    supply chains do not hit the recursion limit of Python.
+
     Args:
         activity: ``Activity``. The starting point of the supply chain graph.
         lcia_method: tuple. LCIA method to use when traversing supply chain graph.
+            A list of methods can be given, in which case the graph is traversed once
+            for all of them, and a ``SupplyChain`` is returned.
         amount: int. Amount of ``activity`` to assess.
         max_level: int. Maximum depth to traverse.
         cutoff: float. Fraction of total score to use as cutoff when deciding whether to traverse deeper.
-        lca_obj: ``LCA``. Internal argument (used during recursion, do not touch).
-        total_score: float. Internal argument (used during recursion, do not touch).
-        level: int. Internal argument (used during recursion, do not touch).
-
-    Internal args (used during recursion, do not touch);
-        level: int.
-        lca_obj: ``LCA``.
-        total_score: float.
-        first: bool.
+        engine: str. How the score of each node is obtained. With "unit_score" (default),
+            the score per unit of every product is calculated once (see ``get_unit_scores``)
+            and each node is scored with a lookup. With "redo_lcia", a new LCI is
+            calculated for each node, which is much slower but can be used for validation.
+        cutoff_method: tuple. With several methods, the method on which the cutoff is applied.
+            If None, a node is traversed if it is above the cutoff for any method,
+            and the cutoff is applied to each method in ``SupplyChain.for_method``.
 
     Returns:
-        A list of lists, where each list is a row in the output table.
+        A list of lists, where each list is a row in the output table,
+        or a ``SupplyChain`` if several methods are given.
 
     """
 
-    if lca_obj is None:
-        lca_obj = bw2calc.LCA({activity: amount}, lcia_method)
-        lca_obj.lci()
-        lca_obj.lcia()
-        total_score = lca_obj.score
-        results = []
-    elif total_score is None:
-        raise ValueError
-    elif total_score == 0:
-        return results
-    else:
-        bw2calc_version = (
-            ".".join(map(str, bw2calc.__version__))
-            if isinstance(bw2calc.__version__, tuple)
-            else bw2calc.__version__
-        )
-        if Version(bw2calc_version) >= Version("2.0.DEV1") and not getattr(
-            lca_obj, "_remapped", False
-        ):
-            lca_obj.remap_inventory_dicts()
-        lca_obj.redo_lcia({activity: amount})
-        if abs(lca_obj.score) <= abs(total_score * cutoff):
-            results.append(
-                [
-                    level,
-                    lca_obj.score / total_score,
-                    lca_obj.score,
-                    float(amount),
-                    "activities below cutoff",
-                    None,
-                    None,
-                ]
-            )
-            return results
-
-    if (
-        activity["name"],
-        activity["reference product"],
-        activity["location"],
-    ) == previous_activity:
-        results.append(
-            [
-                level,
-                lca_obj.score / total_score,
-                lca_obj.score,
-                float(amount),
-                "loss",
-                None,
-                None,
-            ]
-        )
-        return results
-
-    results.append(
-        [
-            level,
-            lca_obj.score / total_score,
-            lca_obj.score,
-            float(amount),
-            activity["name"],
-            activity["location"],
-            activity["unit"],
-        ]
+    supply_chain = traverse_supply_chain(
+        activity, lcia_method, amount, max_level, cutoff, engine, cutoff_method
     )
+    supply_chain.collect()
 
-    if level < max_level:
-        for exc in activity.technosphere():
-            recursive_calculation(
-                activity=exc.input,
-                lcia_method=lcia_method,
-                amount=amount * exc["amount"],
-                max_level=max_level,
-                cutoff=cutoff,
-                lca_obj=lca_obj,
-                total_score=total_score,
-                level=level + 1,
-                previous_activity=(
-                    activity["name"],
-                    activity["reference product"],
-                    activity["location"],
-                ),
-                results=results,
-            )
+    if isinstance(lcia_method, tuple):
+        return supply_chain.for_method(lcia_method)
+
+    return supply_chain
+
+
+DATA_DIR = Path(__file__).parent / "data"
+
+
+def get_compiled_data_dir() -> Path:
+    """
+    Directory of the precompiled reference data, next to the cached results
+    (see `ResultCache`), rather than in the (possibly installed) package.
+    :return: a directory
+    """
+    return Path(bw2data.projects.dir) / "polyviz" / "reference"
+
+
+@lru_cache(maxsize=None)
+def load_reference_data(name: str):
+    """
+    Load a yaml file from the data folder, at most once per process.
+    The parsed content is also stored in a precompiled pickle file (see
+    `get_compiled_data_dir`), along with the hash of the yaml file, so that later
+    processes can skip the (slow) yaml parsing as long as the yaml file is unchanged.
+    The returned object is shared: it should not be modified in place.
+    :param name: name of the yaml file, without extension
+    :return: content of the yaml file
+    """
+    source = (DATA_DIR / f"{name}.yaml").read_bytes()
+    digest = hashlib.sha256(source).hexdigest()
+    compiled = get_compiled_data_dir() / f"{name}.pickle"
+
+    try:
+        with open(compiled, "rb") as file:
+            compiled_digest, data = pickle.load(file)
+        if compiled_digest == digest:
+            return data
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+        pass
+
+    data = yaml.safe_load(source)
+
+    # the directory may not be writable, in which case
+    # the yaml file will be parsed again by the next process
+    try:
+        compiled.parent.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file first, so that other processes
+        # (e.g., batch workers) never read a partially written file
+        tmp_compiled = compiled.with_suffix(
+            f".{os.getpid()}.{threading.get_ident()}.tmp"
+        )
+        with open(tmp_compiled, "wb") as file:
+            pickle.dump((digest, data), file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_compiled, compiled)
+    except OSError:
+        pass
 
-    return results
+    return data
 
 
 def get_gdp_per_country():
@@ -309,12 +1116,7 @@ def get_gdp_per_country():
     Get GDP per country from yaml file
     :return: dictionary with GDP per country
     """
-    # load yaml file GDP_countries.yaml
-    # in data folder
-    with open(Path(__file__).parent / "data" / "GDP_countries.yaml", "r") as file:
-        gdp_per_country = yaml.safe_load(file)
-
-    return gdp_per_country
+    return load_reference_data("GDP_countries")
 
 
 def get_region_definitions():
@@ -322,9 +1124,34 @@ def get_region_definitions():
     Get region definitions from yaml file
     :return: dictionary with region definitions
     """
-    # load yaml file regions.yaml
-    # in data folder
-    with open(Path(__file__).parent / "data" / "regions.yaml", "r") as file:
-        region_definitions = yaml.safe_load(file)
+    return load_reference_data("regions")
+
+
+@lru_cache(maxsize=None)
+def get_region_to_country_matrix() -> tuple:
+    """
+    Build a sparse matrix of the shares of each country in each region,
+    weighted by their GDP. The matrix is built once and cached:
+    it should not be modified in place.
+    :return: a sparse matrix (regions x countries), the index of regions and the index of countries
+    """
+    regions = get_region_definitions()
+    gdp = get_gdp_per_country()
+
+    countries = pd.Index(list(gdp))
+    rows, cols, shares = [], [], []
+
+    for r, members in enumerate(regions.values()):
+        members = [country for country in members or [] if country in gdp]
+        gdp_sum = sum(gdp[country] for country in members)
+
+        for country in members:
+            rows.append(r)
+            cols.append(countries.get_loc(country))
+            shares.append(gdp[country] / gdp_sum)
+
+    matrix = sparse.csr_matrix(
+        (shares, (rows, cols)), shape=(len(regions), len(countries))
+    )
 
-    return region_definitions
+    return matrix, pd.Index(list(regions)), countries
@@ -4,7 +4,6 @@ Violin plot for a given activity and method.
 
 from typing import Union
 
-import bw2calc
 import bw2data
 import numpy as np
 import pandas as pd
@@ -14,9 +13,10 @@ try:
 except ModuleNotFoundError:
     MultiMonteCarlo = None
 
-from d3blocks import D3Blocks
-
-from .utils import check_filepath
+from .montecarlo import add_differences, monte_carlo, streaming_monte_carlo
+from .profiling import stage
+from .render import ChartData
+from .render import render as render_chart
 
 try:
     from bw2data.backends.peewee import Activity
@@ -24,6 +24,7 @@ except ImportError:
     from bw2data.backends import Activity
 
 
+@stage("violin")
 def violin(
     activities: list,
     method: tuple,
@@ -31,16 +32,37 @@ def violin(
     filepath: str = None,
     title: str = None,
     notebook: bool = False,
-) -> str:
+    seed: int = None,
+    workers: int = None,
+    streaming: bool = False,
+    tolerance: float = None,
+    points: int = 500,
+    paired: bool = False,
+    render: bool = True,
+) -> Union[str, ChartData]:
     """
     Generate a Sankey diagram for a given activity and method.
+    With brightway2, simulations are run with `MultiMonteCarlo`, and `seed`, `workers`,
+    `streaming`, `tolerance` and `points` raise a ValueError.
     :param activity: Brightway2 activity
     :param method: tuple representing a Brightway2 method
     :param iterations: Number of iterations for Monte Carlo simulation
     :param filepath: Path to save the HTML file
     :param notebook: If True, the HTML file is displayed in the notebook.
     :param title: Title of the plot
-    :return: Path to the generated HTML file
+    :param seed: Seed of the Monte Carlo simulation, for reproducible results
+    :param workers: Number of processes to run the Monte Carlo simulation in
+    :param streaming: If True, samples are summarized as they are drawn, and the plot
+    is drawn from `points` quantiles of each distribution rather than from all samples
+    :param tolerance: If given (with `streaming`), stop the simulation once the quantiles
+    move by less than `tolerance` standard deviations from one chunk of iterations to the next
+    :param points: Number of quantiles plotted per activity, with `streaming`
+    :param paired: If True, all activities are calculated with the same samples of the
+    matrices at each iteration, and the differences between each activity and
+    the first one are plotted as well
+    :param render: If False, the chart is not rendered, and its data is returned
+    instead (see `polyviz.render`)
+    :return: Path to the generated HTML file, or the data of the chart if `render` is False
     """
 
     assert isinstance(method, tuple), "`method` should be a tuple."
@@ -61,53 +83,66 @@ def violin(
 
     title = title or make_name(activities)
 
-    filepath = check_filepath(filepath, title, "violin", method)
-
     if MultiMonteCarlo:
+        # the simulations of `polyviz.montecarlo` need brightway2.5
+        ignored = [
+            name
+            for name, value, default in (
+                ("seed", seed, None),
+                ("workers", workers, None),
+                ("streaming", streaming, False),
+                ("tolerance", tolerance, None),
+                ("points", points, 500),
+            )
+            if value != default
+        ]
+        if ignored:
+            raise ValueError(
+                f"{', '.join(ignored)} cannot be used with brightway2, "
+                "whose Monte Carlo simulations are neither seeded nor streamed."
+            )
+
+        # MultiMonteCarlo uses the same samples for all activities
         res = MultiMonteCarlo(
             [{act: 1} for act in activities],
             method,
             iterations,
         ).calculate()
-    else:
-        lca = bw2calc.LCA(
-            demand={activities[0]: 1}, method=method, use_distributions=True
+        if paired:
+            res = add_differences(res)
+    elif streaming:
+        distributions = streaming_monte_carlo(
+            activities,
+            method,
+            iterations,
+            seed=seed,
+            workers=workers,
+            tolerance=tolerance,
+            paired=paired,
         )
-        lca.lci()
-        lca.lcia()
-        res = np.zeros((len(activities), iterations))
-        for a, activity in enumerate(activities):
-            lca.lci({activity.id: 1})
-            res[a, :] = [lca.score for _ in zip(range(iterations), lca)]
-
-    list_res = []
-    for r in range(0, res.shape[0]):
-        vals = res[r, :]
-        list_res.extend(
-            [
-                [
-                    v,
-                    f"{activities[r]['name']} ({activities[r]['location']})",
-                ]
-                for v in vals
-            ]
+        levels = (np.arange(points) + 0.5) / points
+        res = np.vstack([d.quantile(levels) for d in distributions])
+    else:
+        res = monte_carlo(
+            activities, method, iterations, seed=seed, workers=workers, paired=paired
         )
+        if paired:
+            res = add_differences(res)
+
+    names = [f"{act['name']} ({act['location']})" for act in activities]
+    if paired:
+        names += [f"{name} - {names[0]}" for name in names[1:]]
 
-    dataframe = pd.DataFrame(list_res, columns=["val", "name"])
+    dataframe = pd.DataFrame(
+        {"val": res.ravel(), "name": np.repeat(names, res.shape[1])}
+    )
 
     # fetch unit of method
     unit = bw2data.Method(method).metadata["unit"]
 
-    # Create a new D3Blocks object
-    d3_graph = D3Blocks()
-    d3_graph.violin(
-        x=dataframe["name"].values,
-        y=dataframe["val"].values,
-        unit=unit,
-        bins=50,  # Bins used for the histogram
-        figsize=[None, None],  # Figure size is automatically determined.
-        filepath=filepath,  # Path to save the HTML file
-        notebook=notebook,  # If True, the HTML file is displayed in the notebook.
-    )
+    # figure size is automatically determined
+    data = ChartData("violin", dataframe, title, unit, method, None, [None, None])
+    if not render:
+        return data
 
-    return str(filepath)
+    return render_chart(data, filepath, notebook)
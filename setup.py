@@ -21,11 +21,12 @@ for dirpath, dirnames, filenames in os.walk("polyviz"):
         packages.append(pkg)
 
 
-def package_files(directory):
+def package_files(directory, extension=".yaml"):
     paths = []
     for path, directories, filenames in os.walk(directory):
         for filename in filenames:
-            paths.append(os.path.join("..", path, filename))
+            if filename.endswith(extension):
+                paths.append(os.path.join("..", path, filename))
     return paths
 
 
@@ -42,6 +43,7 @@ setup(
     install_requires=[
         "pandas",
         "numpy",
+        "scipy",
         "country_converter",
         "pyyaml",
         "d3blocks @ git+https://github.com/romainsacchi/d3blocks.git",
@@ -0,0 +1,151 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from polyviz.dataframe import (
+    distribute_impacts_to_countries,
+    distribute_region_impacts,
+    find_downstream_emissions,
+    format_supply_chain_dataframe,
+)
+
+
+def format_supply_chain_dataframe_reference(results, amount=1):
+    """
+    Row-by-row implementation of `format_supply_chain_dataframe`,
+    used as a reference for the vectorized one.
+    """
+    list_res = []
+    last_supplier = {}
+
+    for result in results:
+        level, _, impact, amount, name, location, unit = result
+        last_supplier[level] = f"{name} ({location})"
+        list_res.append(
+            [
+                f"{name} ({location})" if location else name,
+                f"{name} ({location})" if level == 0 else last_supplier[level - 1],
+                impact,
+                level,
+            ]
+        )
+
+    dataframe = pd.DataFrame(list_res, columns=["source", "target", "weight", "level"])
+    dataframe = dataframe.replace("market for", "m. for", regex=True)
+    dataframe = dataframe.replace("market group for", "m. gr. for", regex=True)
+    dataframe = dataframe.groupby(["source", "target", "level"]).sum().reset_index()
+    dataframe = dataframe.sort_values(by=["level", "target"])
+
+    if amount > 0:
+        dataframe = dataframe[dataframe["weight"] > 0]
+    else:
+        dataframe.loc[dataframe["weight"] < 0, "weight"] *= -1
+
+    for level in dataframe["level"].unique():
+        for i, row in dataframe.loc[dataframe["level"] == level].iterrows():
+            if (
+                row["source"] not in ["loss", "activities below cutoff", "emissions"]
+                and level + 1 in dataframe["level"].unique()
+            ):
+                sum_emissions = row["weight"]
+                downstream_emissions = find_downstream_emissions(
+                    dataframe, row["source"], level
+                )
+
+                if downstream_emissions < sum_emissions:
+                    dataframe = pd.concat(
+                        [
+                            dataframe,
+                            pd.DataFrame(
+                                {
+                                    "source": "emissions",
+                                    "target": row["source"],
+                                    "weight": sum_emissions - downstream_emissions,
+                                    "level": level + 1,
+                                },
+                                index=[0],
+                            ),
+                        ],
+                        ignore_index=True,
+                    )
+
+    dataframe = dataframe.sort_values(by=["level", "target"])
+
+    return dataframe.drop(labels="level", axis=1)
+
+
+def make_synthetic_results(seed, n_nodes, max_level=5, n_names=40):
+    """
+    Generate the output of a recursive calculation on a random supply chain tree,
+    in depth-first order, with recurring activity names.
+    """
+    rng = np.random.default_rng(seed)
+    names = [f"market for product {i}" for i in range(n_names // 2)] + [
+        f"production of product {i}" for i in range(n_names // 2)
+    ]
+    locations = ["CH", "DE", "RER", "GLO"]
+    results = []
+
+    def visit(level, score, name, location):
+        results.append([level, 0, score, 1.0, name, location, "kilogram"])
+        if level >= max_level or len(results) >= n_nodes:
+            return
+        shares = rng.dirichlet(np.ones(rng.integers(2, 10))) * rng.uniform(0.5, 1.0)
+        for share in shares:
+            kind = rng.random()
+            if kind < 0.1:
+                name = "activities below cutoff"
+                results.append([level + 1, 0, score * share, 1.0, name, None, None])
+            elif kind < 0.15:
+                results.append([level + 1, 0, score * share, 1.0, "loss", None, None])
+            else:
+                name = names[rng.integers(len(names))]
+                location = locations[rng.integers(len(locations))]
+                visit(level + 1, score * share, name, location)
+
+    visit(0, 100.0, "root", "GLO")
+
+    return results
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_format_supply_chain_dataframe_matches_reference(seed):
+    results = make_synthetic_results(seed, n_nodes=3000)
+
+    expected = format_supply_chain_dataframe_reference(results)
+    actual = format_supply_chain_dataframe(results)
+
+    assert (expected["source"] == "emissions").sum() > 100
+
+    pd.testing.assert_frame_equal(actual, expected, check_exact=False, rtol=1e-9)
+
+
+def test_distribute_impacts_to_countries():
+    impacts = pd.DataFrame(
+        {"method 1": [5.0, 3.0, 1.0, 2.0], "method 2": [1.0, 0.0, 4.0, 0.5]},
+        index=["RoW", "GLO", "CH", "RER"],
+    )
+
+    distributed = distribute_impacts_to_countries(impacts)
+
+    # regions are replaced by countries, and totals are conserved
+    assert not distributed.index.isin(["RoW", "GLO", "RER"]).any()
+    np.testing.assert_allclose(distributed.sum(), impacts.sum())
+
+    # distributing several impact vectors at once
+    # is the same as distributing them one by one
+    for column in impacts.columns:
+        pd.testing.assert_series_equal(
+            distributed[column],
+            distribute_impacts_to_countries(impacts[[column]])[column].reindex(
+                distributed.index, fill_value=0.0
+            ),
+        )
+
+    # impacts without a location are kept
+    dataframe = pd.DataFrame(
+        {"country": ["FR", None, "RER"], "weight": [1.0, 5.0, 2.0]}
+    )
+    distributed = distribute_region_impacts(dataframe, 0)
+    assert np.isclose(distributed["weight"].sum(), 8.0)
+    assert distributed["country"].isna().sum() == 1
@@ -1,7 +1,55 @@
+import asyncio
+import importlib
+import json
+import pickle
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from pathlib import Path
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
 import bw2data
 import bw2io
+import numpy as np
+import pandas as pd
+import pytest
 
-from polyviz import chord, choro, force, sankey, treemap, violin
+from polyviz import (
+    aio,
+    batch,
+    chord,
+    choro,
+    dashboard,
+    force,
+    render,
+    sankey,
+    treemap,
+    violin,
+)
+from polyviz.cache import MemoryCache, lca_cache, result_cache
+from polyviz.dataframe import format_supply_chain_dataframe, format_supply_chain_table
+from polyviz.metadata import get_activity_column, get_activity_metadata
+from polyviz.montecarlo import (
+    ScoreDistribution,
+    monte_carlo,
+    sample_paired_scores,
+    sample_scores,
+    streaming_monte_carlo,
+)
+from polyviz.profiling import profile, stage
+from polyviz.render import ChartData
+from polyviz.server import make_server
+from polyviz.utils import (
+    ACTIVITY,
+    OTHER,
+    best_first_traversal,
+    calculate_supply_chain,
+    iterate_supply_chain,
+    keep_largest_nodes,
+    recursive_calculation,
+)
 
 if "polyviz" in bw2data.projects:
     bw2data.projects.delete_project("polyviz", delete_dir=True)
@@ -18,15 +66,697 @@ bw2data.Method(method).metadata["unit"] = "kg CO2-eq."
 
 act = bw2data.get_activity(("Mobility example", "Electricity"))
 
+other_method = ("IPCC", "doubled")
+bw2data.Method(other_method).register(unit="kg CO2-eq.")
+bw2data.Method(other_method).write([(("Mobility example", "CO2"), 2.0)])
+
+bw2data.Database("Uncertain example").write(
+    {
+        ("Uncertain example", "steel"): {
+            "name": "steel",
+            "unit": "kilogram",
+            "location": "GLO",
+            "exchanges": [
+                {
+                    "input": ("Uncertain example", "steel"),
+                    "type": "production",
+                    "amount": 1,
+                },
+                {
+                    "input": ("Mobility example", "CO2"),
+                    "type": "biosphere",
+                    "amount": 2,
+                    "uncertainty type": 2,
+                    "loc": np.log(2),
+                    "scale": 0.2,
+                },
+            ],
+        },
+        ("Uncertain example", "bike"): {
+            "name": "bike",
+            "unit": "unit",
+            "location": "GLO",
+            "exchanges": [
+                {
+                    "input": ("Uncertain example", "bike"),
+                    "type": "production",
+                    "amount": 1,
+                },
+                {
+                    "input": ("Uncertain example", "steel"),
+                    "type": "technosphere",
+                    "amount": 10,
+                    "uncertainty type": 2,
+                    "loc": np.log(10),
+                    "scale": 0.1,
+                },
+            ],
+        },
+    }
+)
+
+bw2data.Database("Loop example").write(
+    {
+        ("Loop example", "hen"): {
+            "name": "hen",
+            "unit": "unit",
+            "location": "GLO",
+            "exchanges": [
+                {"input": ("Loop example", "hen"), "type": "production", "amount": 1},
+                {
+                    "input": ("Loop example", "egg"),
+                    "type": "technosphere",
+                    "amount": 0.9,
+                },
+                {
+                    "input": ("Mobility example", "CO2"),
+                    "type": "biosphere",
+                    "amount": 1,
+                },
+            ],
+        },
+        ("Loop example", "egg"): {
+            "name": "egg",
+            "unit": "unit",
+            "location": "GLO",
+            "exchanges": [
+                {"input": ("Loop example", "egg"), "type": "production", "amount": 1},
+                {
+                    "input": ("Loop example", "hen"),
+                    "type": "technosphere",
+                    "amount": 0.9,
+                },
+            ],
+        },
+    }
+)
+
 
 def test_force():
     force(activity=act, cutoff=0.001, method=method, level=2)
 
 
+def test_render_data(tmp_path):
+    car = bw2data.get_activity(("Mobility example", "Driving an electric car"))
+    data = sankey(activity=car, method=method, level=4, cutoff=0.0001, render=False)
+
+    assert isinstance(data, ChartData)
+    assert data.chart == "sankey" and data.unit == "kg CO2-eq."
+    assert not list(tmp_path.iterdir())
+
+    # nodes and links, for another frontend
+    network = json.loads(json.dumps(data.to_dict()))
+    assert len(network["links"]) == len(data.dataframe) - 1
+    link = network["links"][0]
+    assert network["nodes"][link["source"]] == data.dataframe["source"].iloc[1]
+    assert network["nodes"][link["target"]] == data.dataframe["target"].iloc[1]
+
+    # rendered later, e.g., in another process
+    data = pickle.loads(pickle.dumps(data))
+    filepath = render(data, filepath=tmp_path / "sankey.html")
+    assert Path(filepath).exists()
+
+
+def test_compact(tmp_path):
+    car = bw2data.get_activity(("Mobility example", "Driving an electric car"))
+    data = sankey(activity=car, method=method, level=4, cutoff=0.0001, render=False)
+    size = Path(render(data, filepath=tmp_path / "full.html")).stat().st_size
+
+    with profile() as result:
+        filepath = Path(render(data, filepath=tmp_path / "a.html", compact=True))
+    assert filepath.stat().st_size < size / 4
+    assert filepath.with_suffix(".data.js").exists()
+    assets = set((tmp_path / "assets").iterdir())
+    assert result.stages[-1].calls["bytes saved"] > 0
+
+    # assets are shared by the charts of the directory
+    render(data, filepath=tmp_path / "b.html", compact=True)
+    assert set((tmp_path / "assets").iterdir()) == assets
+    assert (tmp_path / "b.data.js").read_text() == (tmp_path / "a.data.js").read_text()
+
+
+def test_unit_score_engine():
+    car = bw2data.get_activity(("Mobility example", "Driving an electric car"))
+    fast = recursive_calculation(car, method, max_level=4, cutoff=0.0001)
+    slow = recursive_calculation(
+        car, method, max_level=4, cutoff=0.0001, engine="redo_lcia"
+    )
+
+    assert len(fast) == len(slow)
+    for row_fast, row_slow in zip(fast, slow):
+        assert row_fast[0] == row_slow[0]
+        assert row_fast[3:] == row_slow[3:]
+        assert abs(row_fast[2] - row_slow[2]) <= 1e-6 * abs(row_slow[2]) + 1e-12
+
+
+def test_iterate_supply_chain():
+    car = bw2data.get_activity(("Mobility example", "Driving an electric car"))
+    rows = recursive_calculation(car, method, max_level=4, cutoff=0.0001)
+
+    assert list(iterate_supply_chain(car, method, max_level=4, cutoff=0.0001)) == rows
+    assert (
+        list(islice(iterate_supply_chain(car, method, max_level=4, cutoff=0.0001), 3))
+        == rows[:3]
+    )
+
+    # deeper than the recursion limit of Python
+    hen = bw2data.get_activity(("Loop example", "hen"))
+    rows = recursive_calculation(hen, method, max_level=2000, cutoff=0)
+    assert len(rows) == 2001
+    assert [row[4] for row in rows[:3]] == ["hen", "egg", "hen"]
+
+
+def test_best_first_traversal():
+    car = bw2data.get_activity(("Mobility example", "Driving an electric car"))
+
+    rows = best_first_traversal(car, method, max_nodes=6).for_method(method)
+    drawn = [row for row in rows if row[4] != "activities below cutoff"]
+    assert len(drawn) == 6
+
+    # the inputs of each node, drawn or aggregated, add up to its score
+    for i, row in enumerate(rows):
+        children = []
+        for other in rows[i + 1 :]:
+            if other[0] <= row[0]:
+                break
+            if other[0] == row[0] + 1:
+                children.append(other[2])
+        if children:
+            assert np.isclose(sum(children), row[2])
+
+    # the largest contributors are drawn first
+    full = best_first_traversal(car, method, max_nodes=1000).for_method(method)
+    scores = sorted((abs(row[2]) for row in full[1:]), reverse=True)
+    assert sorted((abs(row[2]) for row in drawn[1:]), reverse=True) == scores[:5]
+
+    rows, _ = calculate_supply_chain(car, method, time_budget=0)
+    assert len(rows) == 1
+
+
+def test_keep_largest_nodes():
+    car = bw2data.get_activity(("Mobility example", "Driving an electric car"))
+    supply_chain, _ = calculate_supply_chain(car, [method], level=5, cutoff=0.0001)
+    table = supply_chain.to_array(method)
+    reduced = keep_largest_nodes(table, 5)
+
+    activities = reduced[reduced["flag"] == ACTIVITY]
+    assert len(activities) <= 5 < (table["flag"] == ACTIVITY).sum()
+    assert (reduced["flag"] == OTHER).any()
+
+    # the flows to each activity are conserved
+    def inputs(table):
+        parents = table["parent"][1:]
+        return np.bincount(parents, weights=table["score"][1:], minlength=len(table))
+
+    original = {
+        (row["level"], row["column"], row["score"]): total
+        for row, total in zip(table, inputs(table))
+    }
+    for row, total in zip(reduced, inputs(reduced)):
+        if row["flag"] == ACTIVITY:
+            assert np.isclose(
+                total, original[row["level"], row["column"], row["score"]]
+            )
+
+    data = force(car, method, level=5, cutoff=0.0001, max_nodes=5, render=False)
+    assert data.dataframe["source"].str.startswith("other suppliers of ").any()
+
+    # with more levels than `max_nodes`, the deepest levels are folded
+    hen = bw2data.get_activity(("Loop example", "hen"))
+    supply_chain, _ = calculate_supply_chain(hen, [method], level=20, cutoff=0)
+    table = supply_chain.to_array(method)
+    reduced = keep_largest_nodes(table, 5)
+    assert (reduced["flag"] == ACTIVITY).sum() == 5
+    assert reduced["level"].max() == 5
+    assert reduced[reduced["level"] == 5]["flag"] == OTHER
+    assert np.isclose(reduced["score"][reduced["level"] == 5], table["score"][5])
+
+
+def test_multi_method_supply_chain(tmp_path):
+    car = bw2data.get_activity(("Mobility example", "Driving an electric car"))
+    supply_chain, _ = calculate_supply_chain(
+        car, [method, other_method], level=4, cutoff=0.0001
+    )
+
+    for m in (method, other_method):
+        assert supply_chain.for_method(m) == recursive_calculation(
+            car, m, max_level=4, cutoff=0.0001
+        )
+
+    # the typed arrays give the same dataframe as the rows
+    best_first = best_first_traversal(car, [method, other_method], max_nodes=8)
+    for chain, m, flow_type in (
+        (supply_chain, method, None),
+        (supply_chain, other_method, None),
+        (supply_chain, method, "kilowatt hour"),
+        (best_first, other_method, None),
+    ):
+        pd.testing.assert_frame_equal(
+            format_supply_chain_table(
+                chain.to_array(m), chain.metadata, chain.amount, flow_type
+            ),
+            format_supply_chain_dataframe(chain.for_method(m), chain.amount, flow_type),
+        )
+
+    sankey(
+        activity=car,
+        method=other_method,
+        supply_chain=supply_chain,
+        filepath=tmp_path / "sankey.html",
+    )
+
+
+def test_requery_supply_chain():
+    car = bw2data.get_activity(("Mobility example", "Driving an electric car"))
+    fine, _ = calculate_supply_chain(
+        car, [method], level=5, cutoff=0.00001, cache="bypass"
+    )
+
+    # a supply chain cut at a coarser level and cutoff is the same
+    # as a supply chain traversed with them
+    for level, cutoff in ((5, 0.00001), (4, 0.001), (3, 0.01), (2, 0.1)):
+        coarse, _ = calculate_supply_chain(
+            car, [method], level=level, cutoff=cutoff, cache="bypass"
+        )
+        np.testing.assert_array_equal(
+            fine.to_array(method, level=level, cutoff=cutoff),
+            coarse.to_array(method),
+        )
+
+    with pytest.raises(ValueError):
+        fine.to_array(method, level=6)
+    with pytest.raises(ValueError):
+        fine.to_array(method, cutoff=0.000001)
+
+    # a best-first supply chain is only cut at a level and cutoff given explicitly
+    hen = bw2data.get_activity(("Loop example", "hen"))
+    best_first = best_first_traversal(hen, [method], max_nodes=10)
+    assert best_first.to_array(method)["level"].max() > 3
+    for chart in (sankey, force):
+        full = chart(hen, method, supply_chain=best_first, render=False)
+        cut = chart(hen, method, level=3, supply_chain=best_first, render=False)
+        assert len(full.dataframe) > len(cut.dataframe)
+
+
+def test_lca_cache():
+    lca_cache.clear()
+    first = lca_cache.get(act, method)
+    score = first.score
+    second = lca_cache.get(act, method, amount=2)
+
+    assert first is second
+    assert abs(second.score - 2 * score) < 1e-6
+    stats = lca_cache.stats()
+    assert stats["misses"] >= 1 and stats["hits"] >= 1
+    assert stats["entries"] == 1 and stats["memory"] > 0
+
+    lca_cache.clear()
+    assert lca_cache.stats()["entries"] == 0
+
+
+def test_activity_metadata():
+    metadata = get_activity_metadata(act, method)
+
+    for activity in bw2data.Database("Mobility example"):
+        if activity.get("type", "process") != "process":
+            continue
+        row = metadata.loc[get_activity_column(metadata, activity)]
+        assert row["name"] == activity["name"]
+        assert row["location"] == activity["location"]
+        assert row["unit"] == activity["unit"]
+        assert not row["waste"]
+
+
+def test_result_cache():
+    car = bw2data.get_activity(("Mobility example", "Driving an electric car"))
+    result_cache.clear()
+
+    misses = result_cache.stats()["misses"]
+    first, _ = calculate_supply_chain(car, method, level=4, cutoff=0.0001)
+    second, _ = calculate_supply_chain(car, method, level=4, cutoff=0.0001)
+    assert first == second
+    assert result_cache.stats()["misses"] == misses + 1
+    assert result_cache.stats()["entries"] == 1
+
+    # other parameters, or bypassing the cache, do not hit it
+    calculate_supply_chain(car, method, level=3, cutoff=0.0001)
+    calculate_supply_chain(car, method, level=2, cutoff=0.0001, cache="bypass")
+    assert result_cache.stats()["misses"] == misses + 2
+    assert result_cache.stats()["entries"] == 2
+
+    calculate_supply_chain(car, method, level=4, cutoff=0.0001, cache="refresh")
+    assert result_cache.stats()["misses"] == misses + 3
+
+    # the metadata of the database is not written with a supply chain,
+    # but attached again when it is read
+    result_cache.clear()
+    written, _ = calculate_supply_chain(car, [method], level=4, cutoff=0.0001)
+    (filepath,) = result_cache.directory.glob("*.pickle")
+    with open(filepath, "rb") as file:
+        assert pickle.load(file).metadata is None
+    read, _ = calculate_supply_chain(car, [method], level=4, cutoff=0.0001)
+    assert read.metadata is written.metadata is not None
+
+    max_size = result_cache.max_size
+    try:
+        result_cache.max_size = 0
+        calculate_supply_chain(car, method, level=3, cutoff=0.001)
+        assert result_cache.stats()["entries"] == 1
+    finally:
+        result_cache.max_size = max_size
+        result_cache.clear()
+
+
+def test_profile(tmp_path):
+    car = bw2data.get_activity(("Mobility example", "Driving an electric car"))
+    finished = []
+
+    with profile(memory=True, callback=finished.append) as result:
+        sankey(
+            activity=car,
+            method=method,
+            level=4,
+            cutoff=0.0001,
+            filepath=tmp_path / "sankey.html",
+            supply_chain=calculate_supply_chain(
+                car, [method], level=4, cutoff=0.0001, cache="bypass"
+            )[0],
+        )
+
+    stages = result.to_dataframe().set_index("stage")
+    assert {
+        "supply chain",
+        "supply chain/traversal",
+        "sankey",
+        "sankey/dataframe",
+        "sankey/html",
+    } <= set(stages.index)
+    assert "sankey/supply chain" not in stages.index
+    assert len(finished) == len(stages)
+    # calls of a stage include those of the stages run within it
+    assert stages.at["supply chain", "redo_lcia"] >= 1
+    assert stages.at["sankey", "redo_lcia"] == 0
+    assert stages.at["sankey", "time"] >= stages.at["sankey/html", "time"]
+    assert (stages["peak_memory"] > 0).all()
+
+
 def test_violin():
     acts = [act, act]
     violin(activities=acts, method=method, iterations=5)
 
 
+def test_violin_brightway2(monkeypatch):
+    # with brightway2, options of `polyviz.montecarlo` are not silently ignored
+    monkeypatch.setattr(
+        importlib.import_module("polyviz.violin"), "MultiMonteCarlo", object
+    )
+    for options in ({"seed": 42}, {"workers": 2}, {"streaming": True}, {"points": 100}):
+        with pytest.raises(ValueError):
+            violin(activities=[act, act], method=method, iterations=5, **options)
+
+
+def test_monte_carlo(caplog):
+    bike = bw2data.get_activity(("Uncertain example", "bike"))
+    steel = bw2data.get_activity(("Uncertain example", "steel"))
+
+    with caplog.at_level("INFO", logger="polyviz"):
+        serial = monte_carlo(
+            [bike, steel], method, 25, seed=42, workers=1, chunk_size=10
+        )
+    # progress is reported after each chunk
+    assert [
+        record.getMessage()
+        for record in caplog.records
+        if record.getMessage().startswith("Monte Carlo")
+    ] == [f"Monte Carlo: {done}/25 iterations" for done in (10, 20, 25)]
+
+    parallel = monte_carlo([bike, steel], method, 25, seed=42, workers=2, chunk_size=10)
+    other = monte_carlo([bike, steel], method, 25, seed=43, workers=1, chunk_size=10)
+
+    assert serial.shape == (2, 25)
+    assert np.array_equal(serial, parallel)
+    assert not np.array_equal(serial, other)
+    # samples differ within and across chunks
+    assert len(np.unique(serial[0])) == 25
+
+
+def test_paired_monte_carlo():
+    bike = bw2data.get_activity(("Uncertain example", "bike"))
+    steel = bw2data.get_activity(("Uncertain example", "steel"))
+
+    # the same seed gives the same samples of the matrices,
+    # whatever the activities calculated
+    paired = sample_paired_scores((bike.id, steel.id), method, 10, 7)
+    assert np.allclose(paired[0], sample_scores(bike.id, method, 10, 7))
+    assert np.allclose(paired[1], sample_scores(steel.id, method, 10, 7))
+
+    serial = monte_carlo(
+        [bike, steel], method, 25, seed=42, workers=1, chunk_size=10, paired=True
+    )
+    parallel = monte_carlo(
+        [bike, steel], method, 25, seed=42, workers=2, chunk_size=10, paired=True
+    )
+    assert np.allclose(serial, parallel)
+    assert np.corrcoef(serial)[0, 1] > 0.9
+
+    distributions = streaming_monte_carlo(
+        [bike, steel], method, 100, seed=42, workers=1, paired=True
+    )
+    assert len(distributions) == 3
+    assert np.isclose(
+        distributions[2].mean, distributions[1].mean - distributions[0].mean
+    )
+
+
+def test_score_distribution():
+    values = np.random.default_rng(0).lognormal(size=10000)
+    distribution = ScoreDistribution(bins=200)
+    for chunk in np.array_split(values, 100):
+        distribution.update(chunk)
+
+    assert distribution.count == len(values)
+    assert len(distribution.counts) == 200
+    assert np.isclose(distribution.mean, values.mean())
+    assert np.isclose(distribution.variance, values.var(ddof=1))
+
+    levels = np.array([0.05, 0.5, 0.95])
+    width = distribution.width
+    assert np.all(
+        np.abs(distribution.quantile(levels) - np.quantile(values, levels)) <= width
+    )
+
+    # non-finite samples are counted, not added to the histogram
+    distribution.update([np.inf, np.nan, -np.inf, 1.0])
+    assert distribution.invalid == 3
+    assert distribution.count == len(values) + 1
+
+
+def test_streaming_monte_carlo():
+    bike = bw2data.get_activity(("Uncertain example", "bike"))
+
+    (converged,) = streaming_monte_carlo(
+        [bike], method, 5000, seed=42, workers=1, chunk_size=50, tolerance=0.5
+    )
+    assert 100 <= converged.count < 5000
+
+    (serial,) = streaming_monte_carlo(
+        [bike], method, 120, seed=42, workers=1, chunk_size=50
+    )
+    (parallel,) = streaming_monte_carlo(
+        [bike], method, 120, seed=42, workers=2, chunk_size=50
+    )
+    assert serial.count == 120
+    assert np.array_equal(serial.counts, parallel.counts)
+    assert serial.mean == parallel.mean
+
+
 def choropleth():
     choro(activity=act, cutoff=0.001, method=method)
+
+
+def test_dashboard(tmp_path):
+    car = bw2data.get_activity(("Mobility example", "Driving an electric car"))
+    filepath = dashboard(
+        activity=car,
+        method=method,
+        charts=("sankey",),
+        level=4,
+        cutoff=0.0001,
+        filepath=tmp_path / "dashboard.html",
+    )
+
+    page = (tmp_path / "dashboard.html").read_text(encoding="utf-8")
+    assert filepath == str(tmp_path / "dashboard.html")
+    assert page.count("<iframe") == 1
+
+    filepaths = dashboard(
+        activity=car,
+        method=method,
+        charts=("sankey",),
+        level=4,
+        cutoff=0.0001,
+        directory=tmp_path / "charts",
+    )
+    assert list(filepaths) == ["sankey"]
+
+
+def test_batch(tmp_path):
+    activities = [
+        bw2data.get_activity(("Mobility example", "Driving an electric car")),
+        ("Mobility example", "missing activity"),
+    ]
+    results = {
+        result.activity: result
+        for result in batch(
+            activities,
+            method,
+            charts=("sankey",),
+            directory=tmp_path,
+            workers=2,
+            level=4,
+            cutoff=0.0001,
+        )
+    }
+
+    car = results[("Mobility example", "Driving an electric car")]
+    assert car.error is None
+    assert Path(car.filepaths["sankey"]).parent == tmp_path
+
+    missing = results[("Mobility example", "missing activity")]
+    assert missing.error is not None
+    assert missing.filepaths == {}
+
+
+def test_batch_same_title(tmp_path):
+    car = bw2data.get_activity(("Mobility example", "Driving an electric car"))
+    # an activity with the same name, unit and location, e.g., a co-product
+    twin = car.copy(code="Driving an electric car twin")
+    try:
+        results = list(
+            batch(
+                [car, twin],
+                method,
+                charts=("sankey",),
+                directory=tmp_path,
+                workers=2,
+                level=4,
+                cutoff=0.0001,
+            )
+        )
+    finally:
+        twin.delete()
+
+    assert [result.error for result in results] == [None, None]
+    filepaths = {result.filepaths["sankey"] for result in results}
+    assert len(filepaths) == 2
+    assert all(Path(filepath).exists() for filepath in filepaths)
+
+
+def test_aio():
+    car = bw2data.get_activity(("Mobility example", "Driving an electric car"))
+
+    async def generate():
+        return await asyncio.gather(
+            aio.sankey(car, method, level=4, cutoff=0.0001, render=False),
+            aio.sankey(car, method, level=4, cutoff=0.0001, render=False),
+            aio.treemap(car, method, render=False),
+        )
+
+    first, second, treemap_data = asyncio.run(generate())
+    # identical calls in flight share a calculation
+    assert first is second
+    assert treemap_data.chart == "treemap"
+
+    # a cancelled calculation stops at the end of its current stage
+    started, release, stages = threading.Event(), threading.Event(), []
+
+    @stage("first")
+    def first():
+        started.set()
+        release.wait(10)
+        stages.append("first")
+
+    @stage("second")
+    def second():
+        stages.append("second")
+
+    def chart():
+        first()
+        second()
+
+    async def cancel():
+        task = asyncio.create_task(aio.run(chart))
+        await asyncio.get_running_loop().run_in_executor(None, started.wait, 10)
+        task.cancel()
+        try:
+            await task
+        finally:
+            # the first stage ends once the call is cancelled
+            release.set()
+
+    executor = ThreadPoolExecutor(1)
+    aio.set_executor(executor)
+    try:
+        with pytest.raises(asyncio.CancelledError):
+            asyncio.run(cancel())
+        executor.shutdown(wait=True)
+    finally:
+        aio.set_executor(None)
+    assert stages == ["first"]
+
+
+def test_memory_cache():
+    cache = MemoryCache()
+    calls, started = [], threading.Event()
+
+    def calculate():
+        calls.append(1)
+        started.set()
+        time.sleep(0.2)
+        return np.ones(10)
+
+    # concurrent requests for the same value share its calculation
+    with ThreadPoolExecutor(4) as executor:
+        first = executor.submit(cache.get, "key", calculate)
+        started.wait(10)
+        others = [executor.submit(cache.get, "key", calculate) for _ in range(3)]
+        values = [future.result() for future in [first, *others]]
+
+    assert len(calls) == 1
+    assert all(value is values[0] for value in values)
+    assert cache.stats()["misses"] == 1 and cache.stats()["hits"] == 3
+
+
+def test_server():
+    server = make_server(port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def get(path):
+        url = f"http://127.0.0.1:{server.server_port}{path}"
+        try:
+            with urlopen(url) as response:
+                return response.status, response.read()
+        except HTTPError as err:
+            return err.code, err.read()
+
+    query = (
+        "database=Mobility%20example&code=Driving%20an%20electric%20car"
+        "&method=IPCC&method=simple&level=4&cutoff=0.0001"
+    )
+    try:
+        status, content = get(f"/sankey.json?{query}")
+        assert status == 200 and json.loads(content)["links"]
+        assert get(f"/sankey.json?{query}") == (status, content)
+        status, content = get(f"/chord?{query}")
+        assert status == 200 and content.startswith(b"<!--")
+
+        stats = json.loads(get("/stats")[1])
+        # the second request, and the supply chain of the chord diagram
+        assert stats["hits"] == 2 and stats["memory"] > len(content)
+
+        assert get(f"/sankey?{query}&bins=3")[0] == 400
+        assert get(f"/sankey?{query.replace('Driving', 'Flying')}")[0] == 404
+    finally:
+        server.shutdown()
+        server.server_close()
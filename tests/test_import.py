@@ -0,0 +1,69 @@
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+# upper bound for a cold `import polyviz`, relative to a cold `import logging`
+# (which polyviz imports) measured in the same run, so that the bound does not
+# depend on the speed of the machine
+MAX_IMPORT_TIME_RATIO = 3
+
+HEAVY_MODULES = ("d3blocks", "bw2calc", "bw2data", "pandas")
+
+SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+duration = time.perf_counter() - start
+print(json.dumps({{
+    "duration": duration,
+    "imported": [m for m in {heavy!r} if m in sys.modules],
+}}))
+"""
+
+
+def import_cold(module: str) -> dict:
+    """
+    Import a module in a new Python process.
+    :param module: name of the module
+    :return: the duration of the import, and the heavy modules it imported
+    """
+    output = subprocess.run(
+        [sys.executable, "-c", SCRIPT.format(module=module, heavy=HEAVY_MODULES)],
+        env={**os.environ, "PYTHONPATH": str(Path(__file__).parents[1])},
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def test_cold_import_time():
+    durations, references = [], []
+    for _ in range(5):
+        result = import_cold("polyviz")
+        assert result["imported"] == []
+        durations.append(result["duration"])
+        references.append(import_cold("logging")["duration"])
+
+    assert min(durations) < MAX_IMPORT_TIME_RATIO * min(references)
+
+
+def test_chart_functions_are_importable():
+    import polyviz
+    import polyviz.sankey
+
+    for name in polyviz.__all__:
+        assert callable(getattr(polyviz, name))
+
+
+def test_logging_follows_application_configuration():
+    import logging
+
+    import polyviz
+
+    # the application decides which progress messages are printed
+    logger = logging.getLogger(polyviz.__name__)
+    assert logger.level == logging.NOTSET
+    assert all(isinstance(h, logging.NullHandler) for h in logger.handlers)
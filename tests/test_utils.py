@@ -0,0 +1,28 @@
+import shutil
+
+from polyviz import utils
+
+
+def test_load_reference_data_is_validated_against_yaml(tmp_path, monkeypatch):
+    shutil.copy(utils.DATA_DIR / "regions.yaml", tmp_path / "regions.yaml")
+    monkeypatch.setattr(utils, "DATA_DIR", tmp_path)
+    monkeypatch.setattr(utils, "get_compiled_data_dir", lambda: tmp_path / "compiled")
+    utils.load_reference_data.cache_clear()
+
+    regions = utils.load_reference_data("regions")
+    assert "RER" in regions
+    # the precompiled file is not written in the data folder
+    assert (tmp_path / "compiled" / "regions.pickle").exists()
+    assert not (tmp_path / "regions.pickle").exists()
+    assert not list((tmp_path / "compiled").glob("*.tmp"))
+
+    # the precompiled file is used as long as the yaml file is unchanged
+    utils.load_reference_data.cache_clear()
+    assert utils.load_reference_data("regions") == regions
+
+    # and ignored when the yaml file changes
+    (tmp_path / "regions.yaml").write_text("XX:\n  - CH\n")
+    utils.load_reference_data.cache_clear()
+    assert utils.load_reference_data("regions") == {"XX": ["CH"]}
+
+    utils.load_reference_data.cache_clear()